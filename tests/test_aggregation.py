@@ -3,13 +3,17 @@ import tempfile
 from pathlib import Path
 
 import luigi
+import netCDF4
+import numpy as np
 import pytest
 import xarray as xr
 
 import uclales
+from uclales.output.extraction import UCLALESStripGroupMerge
+from uclales.output.partials import decode_partial, open_partial, write_block_partial
 
 USE_CDO = os.environ.get("CDO_VERSION", "") != ""
-EXTRACTION_MODES = ["blocks", "x_strips", "y_strips"]
+EXTRACTION_MODES = ["blocks", "x_strips", "y_strips", "auto"]
 
 
 @pytest.mark.parametrize("extraction_mode", EXTRACTION_MODES)
@@ -83,3 +87,121 @@ def test_extract_2d(testdata_path, extraction_mode):
         Path(testdata_path) / "rico.out.xy.0000.0000.nc"
     ).lwp
     assert da_out.dims == da_firstblock.dims
+
+
+def test_rerun_after_source_change(testdata_path):
+    tmpdir = tempfile.TemporaryDirectory()
+    output_path = Path(tmpdir.name)
+
+    kws = dict(
+        var_name="lwp",
+        kind="2d",
+        orientation="xy",
+        file_prefix="rico",
+        source_path=testdata_path,
+        use_cdo=USE_CDO,
+        dest_path=output_path,
+    )
+    task = uclales.output.Extract(mode="y_strips", **kws)
+    luigi.build([task], local_scheduler=True)
+    assert task.complete()
+
+    block_tasks = [
+        uclales.output.extraction.UCLALESBlockSelectVariable(i=i, j=0, **kws)
+        for i in range(2)
+    ]
+    assert all(t.complete() for t in block_tasks)
+
+    # "rewriting" one of the source blocks should invalidate only the
+    # partials created from it
+    fn_block = Path(testdata_path) / "rico.out.xy.0000.0000.nc"
+    os.utime(fn_block)
+    assert not task.complete()
+    assert not block_tasks[0].complete()
+    assert block_tasks[1].complete()
+
+    luigi.build([task], local_scheduler=True)
+    assert task.complete()
+
+
+@pytest.mark.parametrize("kind", ["3d", "2d"])
+def test_extract_with_npy_partials(testdata_path, kind):
+    kws = dict(
+        var_name="w" if kind == "3d" else "lwp",
+        tn=0,
+        kind=kind,
+        orientation="xy" if kind == "2d" else None,
+        file_prefix="rico",
+        source_path=testdata_path,
+        use_cdo=False,
+        mode="x_strips",
+    )
+    config = luigi.configuration.get_config()
+
+    outputs = {}
+    tmpdirs = []
+    for partials_format in ["netcdf", "npy"]:
+        config.set("partials", "format", partials_format)
+        tmpdirs.append(tempfile.TemporaryDirectory())
+        task = uclales.output.Extract(dest_path=Path(tmpdirs[-1].name), **kws)
+        try:
+            luigi.build([task], local_scheduler=True)
+        finally:
+            config.remove_option("partials", "format")
+        outputs[partials_format] = task.output().open()
+
+    # only the final output is netCDF
+    partials_path = Path(tmpdirs[-1].name) / "partials"
+    assert len(list(partials_path.glob("**/*.nc"))) == 0
+    assert len(list(partials_path.glob("**/*.npy"))) > 0
+
+    xr.testing.assert_identical(outputs["netcdf"], outputs["npy"])
+
+
+@pytest.mark.parametrize("kind", ["3d", "2d"])
+def test_extract_tree_merge(testdata_path, kind):
+    kws = dict(
+        var_name="w" if kind == "3d" else "lwp",
+        tn=0,
+        kind=kind,
+        orientation="xy" if kind == "2d" else None,
+        file_prefix="rico",
+        source_path=testdata_path,
+        use_cdo=USE_CDO,
+        mode="x_strips",
+    )
+
+    outputs = {}
+    tmpdirs = []
+    for fan_in in [0, 2]:
+        tmpdirs.append(tempfile.TemporaryDirectory())
+        task = uclales.output.Extract(
+            dest_path=Path(tmpdirs[-1].name), fan_in=fan_in, **kws
+        )
+        luigi.build([task], local_scheduler=True)
+        outputs[fan_in] = task.output().open()
+
+    # with a fan-in of 2 the final merge should merge two groups of strips
+    merge_parts = task.merge_task().requires()["parts"]
+    assert len(merge_parts) == 2
+    assert all(isinstance(t, UCLALESStripGroupMerge) for t in merge_parts)
+
+    xr.testing.assert_identical(outputs[0], outputs[2])
+
+
+def test_npy_partial_keeps_fill_value():
+    tmpdir = tempfile.TemporaryDirectory()
+    fn_block = Path(tmpdir.name) / "block.nc"
+    with netCDF4.Dataset(fn_block, "w") as fh:
+        for d, n in [("time", 1), ("yt", 2), ("xt", 3)]:
+            fh.createDimension(d, n)
+            fh.createVariable(d, "f4", (d,))[:] = np.arange(n)
+        fh.variables["time"].units = "seconds since 2000-01-01 00:00:00"
+        var = fh.createVariable("lwp", "f4", ("time", "yt", "xt"), fill_value=-999.0)
+        var[:] = np.ma.masked_less(np.arange(6.0).reshape(1, 2, 3), 1.0)
+
+    path = Path(tmpdir.name) / "block.lwp.npy"
+    write_block_partial(path, fn_block, "lwp", tn=0)
+    da = decode_partial(open_partial(path)["lwp"])
+    assert np.isnan(da.values[0, 0, 0])
+    np.testing.assert_array_equal(da.values.ravel()[1:], np.arange(1.0, 6.0))
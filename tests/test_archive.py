@@ -0,0 +1,77 @@
+import tarfile
+import tempfile
+from pathlib import Path
+
+import luigi
+import numpy as np
+import pytest
+
+import uclales
+from uclales.output import archive
+from uclales.output.integrity import scan_source_blocks
+from uclales.output.layout import BlockLayout
+
+
+@pytest.fixture
+def testdata_archive(testdata_path):
+    """
+    The test data (3D and 2D source blocks) in an uncompressed tar archive,
+    stored in a subdirectory as when archiving a run directory
+    """
+    tmpdir = tempfile.TemporaryDirectory()
+    archive_path = Path(tmpdir.name) / "rico.tar"
+    with tarfile.open(archive_path, "w") as tf:
+        for path in sorted(Path(testdata_path).glob("rico.*.nc")):
+            tf.add(path, arcname=f"rico/{path.name}")
+    yield archive_path
+    tmpdir.cleanup()
+
+
+def test_read_from_archive(testdata_path, testdata_archive):
+    layout = BlockLayout(source_path=testdata_path, file_prefix="rico")
+    layout_archive = BlockLayout(source_path=testdata_archive, file_prefix="rico")
+    assert (layout_archive.nx_b, layout_archive.ny_b) == (layout.nx_b, layout.ny_b)
+
+    isel = dict(time=0, x=slice(10, 50), y=[0, 33, 70], z=slice(0, 5))
+    np.testing.assert_array_equal(
+        layout_archive.read("w", **isel), layout.read("w", **isel)
+    )
+
+    report = scan_source_blocks(source_path=testdata_archive, file_prefix="rico")
+    assert report.ok
+
+
+@pytest.mark.parametrize("kind", ["3d", "2d"])
+def test_extract_from_archive(testdata_path, testdata_archive, kind):
+    tmpdir = tempfile.TemporaryDirectory()
+    kws = dict(
+        var_name="w" if kind == "3d" else "lwp",
+        kind=kind,
+        orientation=None if kind == "3d" else "xy",
+        tn=0 if kind == "3d" else None,
+        file_prefix="rico",
+        use_cdo=False,
+        mode="x_strips",
+    )
+    task_archive = uclales.output.Extract(
+        source_path=testdata_archive, dest_path=Path(tmpdir.name) / "archive", **kws
+    )
+    task = uclales.output.Extract(
+        source_path=testdata_path, dest_path=Path(tmpdir.name) / "dir", **kws
+    )
+    assert luigi.build([task_archive, task], local_scheduler=True)
+    da_archive = task_archive.output().open()
+    da = task.output().open()
+    np.testing.assert_array_equal(da_archive.values, da.values)
+
+
+def test_archive_duplicate_filenames(testdata_path):
+    tmpdir = tempfile.TemporaryDirectory()
+    archive_path = Path(tmpdir.name) / "rico.tar"
+    fn = Path(testdata_path) / "rico.00000000.nc"
+    with tarfile.open(archive_path, "w") as tf:
+        tf.add(fn, arcname=f"rico/{fn.name}")
+        tf.add(fn, arcname=f"rico/backup/{fn.name}")
+
+    with pytest.raises(Exception, match="more than one"):
+        archive.file_stat(f"{archive_path}/{fn.name}")
@@ -0,0 +1,109 @@
+import shutil
+import tempfile
+from pathlib import Path
+
+import luigi
+import netCDF4
+import numpy as np
+import pytest
+import xarray as xr
+
+import uclales
+from uclales.output import backends
+
+
+def test_orthogonal_read(testdata_path):
+    fn = testdata_path / "rico.00000000.nc"
+    index = (0, [3, 1, 5], slice(2, 9, 3), [0, 10])
+    with netCDF4.Dataset(fn) as fh:
+        fh.set_auto_mask(False)
+        values = fh.variables["w"][:]
+
+    expected = backends.BACKENDS["netcdf4"].read_variable(fn, "w", index=index)
+    np.testing.assert_array_equal(
+        backends._read_orthogonal(values.__getitem__, values.shape, index), expected
+    )
+
+
+def test_choose_backends_and_extract(testdata_path):
+    paths = sorted(testdata_path.glob("rico.0000000?.nc"))
+    reader, writer = backends.choose_backends(paths=paths, var_name="w", repeat=1)
+    assert backends.reader().name == reader
+    assert backends.writer().name == writer
+    backends.set_backends(reader="netcdf4", writer="netcdf4")
+
+    config = luigi.configuration.get_config()
+    outputs = []
+    tmpdirs = []
+    for backend in ["netcdf4", "auto"]:
+        config.set("io", "reader", backend)
+        config.set("io", "writer", backend)
+        tmpdirs.append(tempfile.TemporaryDirectory())
+        task = uclales.output.Extract(
+            var_name="w",
+            tn=0,
+            kind="3d",
+            file_prefix="rico",
+            source_path=testdata_path,
+            use_cdo=False,
+            mode="x_strips",
+            dest_path=Path(tmpdirs[-1].name),
+        )
+        try:
+            luigi.build([task], local_scheduler=True)
+        finally:
+            config.remove_option("io", "reader")
+            config.remove_option("io", "writer")
+            backends.set_backends(reader="netcdf4", writer="netcdf4")
+        outputs.append(task.output().open())
+
+    xr.testing.assert_identical(*outputs)
+    # the benchmark is stored with the output for the other worker processes
+    assert (Path(tmpdirs[-1].name) / "partials" / "io_backends.json").exists()
+
+
+def test_benchmark_skips_undecoded_readers():
+    pytest.importorskip("h5py")
+    tmpdir = tempfile.TemporaryDirectory()
+    fn = Path(tmpdir.name) / "packed.nc"
+    with netCDF4.Dataset(fn, "w") as fh:
+        fh.createDimension("x", 10)
+        var = fh.createVariable("w", "i2", ("x",))
+        var.scale_factor = 0.5
+        var[:] = np.arange(10.0)
+
+    read_times, _, _ = backends.benchmark_backends(paths=[fn], var_name="w", repeat=1)
+    assert "netcdf4" in read_times
+    # h5py reads the packed values without applying the scale-factor
+    assert "h5py" not in read_times
+
+
+def test_choose_backends_uclales_time_units(testdata_path):
+    tmpdir = tempfile.TemporaryDirectory()
+    fn = Path(tmpdir.name) / "rico.00000000.nc"
+    shutil.copy(testdata_path / "rico.00000000.nc", fn)
+    with netCDF4.Dataset(fn, "a") as fh:
+        fh.variables["time"].units = "seconds since 2000-00-00 00:00:00"
+
+    try:
+        reader, writer = backends.choose_backends(paths=[fn], var_name="w", repeat=1)
+        assert backends.reader().name == reader
+    finally:
+        backends.set_backends(reader="netcdf4", writer="netcdf4")
+
+
+def test_read_variables(testdata_path):
+    fn = testdata_path / "rico.00000000.nc"
+    indices = dict(w=(1, slice(None), 3, slice(0, 10)), zt=None)
+    with netCDF4.Dataset(fn) as fh:
+        fh.set_auto_mask(False)
+        expected = dict(
+            (v, fh.variables[v][:] if index is None else fh.variables[v][index])
+            for (v, index) in indices.items()
+        )
+    for name, backend in backends.BACKENDS.items():
+        if not backend.available() or name == "scipy":
+            continue
+        values = backend.read_variables(fn, indices)
+        for v in indices:
+            np.testing.assert_array_equal(values[v], expected[v])
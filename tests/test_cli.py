@@ -0,0 +1,99 @@
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+from uclales.output.cli import main
+
+# runs the command line interface in a fresh interpreter and reports which of
+# the heavy dependencies were imported
+CLI_SCRIPT = """
+import sys
+from uclales.output.cli import main
+try:
+    main(sys.argv[1:])
+except SystemExit:
+    pass
+print("imported:", *(m for m in ["luigi", "xarray"] if m in sys.modules))
+"""
+
+
+def _run_cli_isolated(*args):
+    output = subprocess.run(
+        [sys.executable, "-c", CLI_SCRIPT, *args],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return output, output.strip().splitlines()[-1].split()[1:]
+
+
+def test_help_and_planning_are_lightweight(testdata_path):
+    output, imported = _run_cli_isolated("--help")
+    assert "usage: uclales-extract" in output
+    assert imported == []
+
+    output, imported = _run_cli_isolated(
+        "--kind",
+        "3d",
+        "--file-prefix",
+        "rico",
+        "--var-name",
+        "w",
+        "--tn",
+        "0",
+        "--source-path",
+        str(testdata_path),
+        "--mode",
+        "auto",
+        "--dry-run",
+    )
+    assert "Chosen strategy" in output
+    assert imported == []
+
+
+def test_extract(testdata_path):
+    tmpdir = tempfile.TemporaryDirectory()
+    dest_path = Path(tmpdir.name)
+
+    retcode = main(
+        [
+            "--kind",
+            "3d",
+            "--file-prefix",
+            "rico",
+            "--var-name",
+            "w",
+            "--tn",
+            "0",
+            "1",
+            "--source-path",
+            str(testdata_path),
+            "--dest-path",
+            str(dest_path),
+            "--mode",
+            "x_strips",
+            "--no-cdo",
+        ]
+    )
+    assert retcode == 0
+    assert (dest_path / "rico.w.tn0.nc").exists()
+    assert (dest_path / "rico.w.tn1.nc").exists()
+
+
+def test_luigi_finds_tasks_by_name():
+    # as `python -m luigi --module uclales.output.tasks ...` does, and
+    # importing `uclales.output` after luigi shouldn't import the tasks
+    script = """
+import luigi
+import sys
+import uclales.output
+assert "xarray" not in sys.modules
+import uclales.output.tasks
+from luigi.task_register import Register
+print(Register.get_task_cls("Extract").__module__)
+"""
+    output = subprocess.run(
+        [sys.executable, "-c", script], check=True, capture_output=True, text=True
+    ).stdout
+    assert output.strip() == "uclales.output.extraction"
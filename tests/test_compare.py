@@ -0,0 +1,67 @@
+import shutil
+import tempfile
+from pathlib import Path
+
+import netCDF4
+import numpy as np
+
+from uclales.output.compare import compare_blocks, compare_files
+from uclales.output.layout import BlockLayout
+
+
+def _perturb(path, var_name, index, delta):
+    with netCDF4.Dataset(path, "a") as fh:
+        var = fh.variables[var_name]
+        var[index] = var[index] + delta
+
+
+def test_compare_blocks(testdata_path):
+    tmpdir = tempfile.TemporaryDirectory()
+    source_path_b = Path(tmpdir.name)
+    for fn in Path(testdata_path).glob("rico.????????.nc"):
+        shutil.copy(fn, source_path_b)
+
+    kws = dict(
+        source_path_a=testdata_path,
+        source_path_b=source_path_b,
+        file_prefix="rico",
+        var_names=["w"],
+        n_workers=2,
+    )
+    report = compare_blocks(**kws)
+    assert (report.max_abs_diff == 0.0).all()
+    assert not report.attrs["tolerance_exceeded"]
+
+    # `w` is stored as (time, yt, xt, zm)
+    layout = BlockLayout(source_path=source_path_b, file_prefix="rico")
+    _perturb(layout.block_path(1, 2), "w", (1, 3, 5, 7), 2.0)
+    report = compare_blocks(tolerance=1.0, stop_early=False, **kws)
+    assert report.attrs["tolerance_exceeded"]
+    worst = report.loc[report.max_abs_diff.idxmax()]
+    assert (worst.tn, worst.k) == (1, 7)
+    assert worst.worst_i == layout.block_nx + 5
+    assert worst.worst_j == 2 * layout.block_ny + 3
+    np.testing.assert_allclose(worst.max_abs_diff, 2.0, rtol=1.0e-5)
+    n_horz = layout.nx * layout.ny
+    np.testing.assert_allclose(worst.rms_diff, np.sqrt(4.0 / n_horz), rtol=1.0e-5)
+
+    # only some of the blocks are compared when stopping early
+    report_early = compare_blocks(tolerance=1.0, **kws)
+    assert report_early.attrs["tolerance_exceeded"]
+    assert len(report_early) <= len(report)
+
+
+def test_compare_files(testdata_path):
+    tmpdir = tempfile.TemporaryDirectory()
+    layout = BlockLayout(source_path=testdata_path, file_prefix="rico")
+    path_a = Path(tmpdir.name) / "a.nc"
+    path_b = Path(tmpdir.name) / "b.nc"
+    shutil.copy(layout.block_path(0, 0), path_a)
+    shutil.copy(layout.block_path(0, 0), path_b)
+    _perturb(path_b, "q", (0, 2, 4, 6), -0.5)
+
+    report = compare_files(path_a, path_b, n_workers=2)
+    assert set(report.var_name) == set(["u", "v", "w", "t", "p", "q", "l", "r"])
+    worst = report.loc[report.max_abs_diff.idxmax()]
+    assert (worst.var_name, worst.tn, worst.k) == ("q", 0, 6)
+    assert (worst.worst_i, worst.worst_j) == (4, 2)
@@ -0,0 +1,57 @@
+import os
+import tempfile
+from pathlib import Path
+
+import luigi
+import numpy as np
+import xarray as xr
+
+import uclales
+
+USE_CDO = os.environ.get("CDO_VERSION", "") != ""
+
+
+def test_extract_xz_cross_section(testdata_path):
+    tmpdir = tempfile.TemporaryDirectory()
+    output_path = Path(tmpdir.name)
+
+    das_3d = []
+    for tn in [0, 1]:
+        task_3d = uclales.output.Extract(
+            var_name="w",
+            tn=tn,
+            kind="3d",
+            file_prefix="rico",
+            source_path=testdata_path,
+            use_cdo=USE_CDO,
+            mode="x_strips",
+            dest_path=output_path,
+        )
+        luigi.build([task_3d], local_scheduler=True)
+        das_3d.append(task_3d.output().open())
+    da_3d = xr.concat(das_3d, dim="time")
+
+    y_positions = da_3d.yt.values[[3, 70]]
+    task = uclales.output.ExtractVerticalCrossSection(
+        var_name="w",
+        orientation="xz",
+        # the repeated position should only be extracted once
+        positions=y_positions.tolist() + [float(y_positions[0])],
+        tns=[1, 0],
+        file_prefix="rico",
+        source_path=testdata_path,
+        dest_path=output_path,
+    )
+    # only the rows of blocks the cross-sections pass through should be read
+    n_blocks_x = len(set(t.i for t in task.requires()))
+    assert len(task.requires()) == 2 * n_blocks_x
+    # one file per position with all timesteps stacked in time
+    assert len(task.output()) == 2
+    assert Path(task.output()[0].path).name == "rico.xz.0003.w.tn0-1.nc"
+
+    luigi.build([task], local_scheduler=True)
+    for target, y in zip(task.output(), y_positions):
+        da = target.open()
+        assert "yt" not in da.dims
+        assert da.time.size == 2
+        np.testing.assert_allclose(da, da_3d.sel(yt=y).transpose(*da.dims))
@@ -0,0 +1,63 @@
+import tempfile
+from pathlib import Path
+
+import luigi
+import netCDF4
+import numpy as np
+import pytest
+import xarray as xr
+
+import uclales
+from uclales.output.layout import BlockLayout
+
+
+def _read_full_domain(layout, var_name, tn):
+    with netCDF4.Dataset(layout.block_path(0, 0)) as fh:
+        dims = fh.variables[var_name].dimensions
+    values = layout.read(var_name, time=[tn]).astype(np.float64)
+    return xr.DataArray(values, dims=dims)
+
+
+@pytest.mark.parametrize("var_name", ["vorticity_z", "divergence_h", "ddy_t"])
+def test_extract_derivative_field(testdata_path, var_name):
+    tmpdir = tempfile.TemporaryDirectory()
+    task = uclales.output.Extract(
+        var_name=var_name,
+        tn=1,
+        kind="3d",
+        file_prefix="rico",
+        source_path=testdata_path,
+        use_cdo=False,
+        mode="y_strips",
+        dest_path=Path(tmpdir.name),
+    )
+    assert luigi.build([task], local_scheduler=True)
+    da = task.output().open()
+
+    # the same derivatives computed on the full (periodic) domain
+    layout = BlockLayout(source_path=testdata_path, file_prefix="rico")
+    u = _read_full_domain(layout, "u", tn=1)
+    v = _read_full_domain(layout, "v", tn=1)
+    t = _read_full_domain(layout, "t", tn=1)
+    dx = float(da.xm[1] - da.xm[0]) if "xm" in da.dims else float(da.xt[1] - da.xt[0])
+    dy = float(da.ym[1] - da.ym[0]) if "ym" in da.dims else float(da.yt[1] - da.yt[0])
+
+    if var_name == "vorticity_z":
+        # forward differences onto the cell faces
+        dv_dx = (v.roll(xt=-1) - v).rename(xt="xm") / dx
+        du_dy = (u.roll(yt=-1) - u).rename(yt="ym") / dy
+        expected = dv_dx - du_dy
+        assert set(da.dims) == set(["time", "xm", "ym", "zt"])
+    elif var_name == "divergence_h":
+        # backward differences onto the cell centres
+        du_dx = (u - u.roll(xm=1)).rename(xm="xt") / dx
+        dv_dy = (v - v.roll(ym=1)).rename(ym="yt") / dy
+        expected = du_dx + dv_dy
+        assert set(da.dims) == set(["time", "xt", "yt", "zt"])
+    else:
+        expected = (t.roll(yt=-1) - t).rename(yt="ym") / dy
+        assert set(da.dims) == set(["time", "xt", "ym", "zt"])
+
+    np.testing.assert_allclose(
+        da.transpose(*expected.dims).values, expected.values, rtol=1.0e-5, atol=1.0e-8
+    )
@@ -0,0 +1,133 @@
+import tempfile
+from pathlib import Path
+
+import luigi
+import netCDF4
+import numpy as np
+import pytest
+import xarray as xr
+
+import uclales
+from uclales.output import ensemble
+from uclales.output.common import _find_number_of_blocks
+from uclales.output.layout import _dim_kind
+
+
+def _merge_blocks_along_x(fn_a, fn_b, fn_out):
+    """
+    Write the 3D block `fn_out` made of the blocks `fn_a` and `fn_b` side by
+    side in x
+    """
+    with netCDF4.Dataset(fn_a) as fh_a, netCDF4.Dataset(fn_b) as fh_b:
+        with netCDF4.Dataset(fn_out, "w", format=fh_a.data_model) as fh:
+            fh.setncatts(fh_a.__dict__)
+            for d, dim in fh_a.dimensions.items():
+                size = dim.size
+                if _dim_kind(d) == "x":
+                    size += fh_b.dimensions[d].size
+                fh.createDimension(d, None if dim.isunlimited() else size)
+            for v, var_a in fh_a.variables.items():
+                var_a.set_auto_maskandscale(False)
+                fh_b.variables[v].set_auto_maskandscale(False)
+                x_axes = [
+                    n for (n, d) in enumerate(var_a.dimensions) if _dim_kind(d) == "x"
+                ]
+                values = var_a[:]
+                if len(x_axes) > 0:
+                    values = np.concatenate(
+                        [values, fh_b.variables[v][:]], axis=x_axes[0]
+                    )
+                attrs = var_a.__dict__
+                var = fh.createVariable(
+                    v,
+                    var_a.dtype,
+                    var_a.dimensions,
+                    fill_value=attrs.pop("_FillValue", None),
+                )
+                var.set_auto_maskandscale(False)
+                var.setncatts(attrs)
+                var[:] = values
+
+
+@pytest.fixture
+def ensemble_paths(testdata_path):
+    """
+    Three ensemble members with the same (test data) source blocks and a
+    fourth with the same data decomposed into half as many blocks in x
+    """
+    tmpdir = tempfile.TemporaryDirectory()
+    paths = []
+    for n in range(3):
+        path = Path(tmpdir.name) / f"member{n:02d}"
+        path.mkdir()
+        for fn in Path(testdata_path).glob("rico.*.nc"):
+            (path / fn.name).symlink_to(fn)
+        paths.append(path)
+
+    nx_b, ny_b = _find_number_of_blocks(
+        source_path=testdata_path, file_prefix="rico", kind="3d"
+    )
+    if nx_b % 2 != 0:
+        raise Exception("Need an even number of blocks in x to merge them")
+    path = Path(tmpdir.name) / "member03"
+    path.mkdir()
+    for i in range(nx_b // 2):
+        for j in range(ny_b):
+            _merge_blocks_along_x(
+                Path(testdata_path) / f"rico.{2 * i:04d}{j:04d}.nc",
+                Path(testdata_path) / f"rico.{2 * i + 1:04d}{j:04d}.nc",
+                path / f"rico.{i:04d}{j:04d}.nc",
+            )
+    paths.append(path)
+    yield paths
+    tmpdir.cleanup()
+
+
+@pytest.mark.parametrize("member_dim", [False, True])
+def test_extract_ensemble(testdata_path, ensemble_paths, member_dim, monkeypatch):
+    planned = []
+    _plan_extraction = ensemble.plan_extraction
+
+    def plan_extraction(**kwargs):
+        planned.append(Path(kwargs["source_path"]).name)
+        return _plan_extraction(**kwargs)
+
+    monkeypatch.setattr(ensemble, "plan_extraction", plan_extraction)
+    tmpdir = tempfile.TemporaryDirectory()
+    task = uclales.output.ExtractEnsemble(
+        members=[str(p) for p in ensemble_paths],
+        file_prefix="rico",
+        var_names=["w"],
+        tns=[0, 1],
+        kind="3d",
+        mode="auto",
+        use_cdo=False,
+        member_dim=member_dim,
+        dest_path=tmpdir.name,
+    )
+    assert luigi.build([task], local_scheduler=True)
+    # planned once for the members sharing a decomposition and once for the
+    # member with a different one
+    assert sorted(planned) == ["member00", "member03"]
+
+    task_single = uclales.output.Extract(
+        file_prefix="rico",
+        var_name="w",
+        tn=1,
+        kind="3d",
+        source_path=testdata_path,
+        dest_path=tmpdir.name,
+        use_cdo=False,
+    )
+    assert luigi.build([task_single], local_scheduler=True)
+    da_single = task_single.output().open()
+
+    for path in ensemble_paths:
+        da_member = xr.open_dataarray(Path(tmpdir.name) / path.name / "rico.w.tn1.nc")
+        np.testing.assert_array_equal(da_member.values, da_single.values)
+
+    if member_dim:
+        da = xr.open_dataarray(Path(tmpdir.name) / "ensemble.w.tn1.nc")
+        assert list(da.member.values) == [p.name for p in ensemble_paths]
+        for n in range(len(ensemble_paths)):
+            np.testing.assert_array_equal(da.isel(member=n).values, da_single.values)
@@ -0,0 +1,97 @@
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+
+import numpy as np
+
+from uclales.output.extraction import XArrayTargetUCLALES
+from uclales.output.handles import DatasetPool, dataset_pool
+from uclales.output.layout import BlockLayout
+
+
+class _Handle:
+    def __init__(self, path):
+        self.path = path
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_pool_eviction_and_invalidation():
+    tmpdir = tempfile.TemporaryDirectory()
+    paths = [Path(tmpdir.name) / f"{n}.nc" for n in range(3)]
+    for path in paths:
+        path.write_text("a")
+
+    pool = DatasetPool(maxsize=2)
+    first = pool.get(paths[0], open_fn=_Handle)
+    assert pool.get(paths[0], open_fn=_Handle) is first
+    pool.get(paths[1], open_fn=_Handle)
+    pool.get(paths[2], open_fn=_Handle)
+    # the least recently used dataset is closed when the pool is full
+    assert first.closed
+    assert (pool.hits, pool.misses, pool.evictions) == (1, 3, 1)
+
+    # rewritten files are opened again
+    handle = pool.get(paths[2], open_fn=_Handle)
+    paths[2].write_text("changed")
+    assert pool.get(paths[2], open_fn=_Handle) is not handle
+
+
+def test_source_block_opened_once(testdata_path):
+    tmpdir = tempfile.TemporaryDirectory()
+    layout = BlockLayout(source_path=testdata_path, file_prefix="rico")
+    path = Path(tmpdir.name) / layout.block_path(0, 0).name
+    shutil.copy(layout.block_path(0, 0), path)
+
+    pool = dataset_pool()
+    n_misses = pool.misses
+    ds = XArrayTargetUCLALES(str(path)).open()
+    ds_again = XArrayTargetUCLALES(str(path)).open()
+    assert pool.misses == n_misses + 1
+    assert np.issubdtype(ds_again.time.dtype, np.datetime64)
+
+    # changes to the opened dataset aren't shared
+    ds["w"] = ds.w * 2.0
+    np.testing.assert_allclose(ds_again.w * 2.0, ds.w)
+
+
+def test_pool_opens_outside_lock():
+    tmpdir = tempfile.TemporaryDirectory()
+    paths = [Path(tmpdir.name) / f"{n}.nc" for n in range(2)]
+    for path in paths:
+        path.write_text("a")
+    pool = DatasetPool(maxsize=2)
+
+    opening = threading.Event()
+    release = threading.Event()
+
+    def _blocked_open(path):
+        opening.set()
+        release.wait()
+        return _Handle(path)
+
+    handles = {}
+    first = threading.Thread(
+        target=lambda: handles.update(first=pool.get(paths[0], open_fn=_blocked_open))
+    )
+    first.start()
+    opening.wait()
+
+    # while the first dataset is still being opened a different one can be
+    # opened, i.e. the pool isn't locked during opening
+    second = threading.Thread(
+        target=lambda: handles.update(second=pool.get(paths[1], open_fn=_Handle))
+    )
+    second.start()
+    second.join(timeout=10)
+    opened_meanwhile = not second.is_alive()
+
+    release.set()
+    first.join()
+    second.join()
+    assert opened_meanwhile
+    assert "first" in handles and "second" in handles
+    assert pool.get(paths[0], open_fn=_Handle) is handles["first"]
@@ -0,0 +1,58 @@
+import shutil
+import tempfile
+from pathlib import Path
+
+import netCDF4
+import numpy as np
+
+from uclales.output.cli import main
+from uclales.output.integrity import scan_source_blocks
+
+
+def test_scan_source_blocks(testdata_path):
+    tmpdir = tempfile.TemporaryDirectory()
+    source_path = Path(tmpdir.name)
+    for fn in Path(testdata_path).glob("rico.????????.nc"):
+        shutil.copy(fn, source_path)
+
+    report = scan_source_blocks(source_path=source_path, file_prefix="rico")
+    assert report.ok
+
+    # a missing block, a truncated block and a block with an extra variable
+    (source_path / "rico.00010001.nc").unlink()
+    fn_truncated = source_path / "rico.00020001.nc"
+    fn_truncated.write_bytes(fn_truncated.read_bytes()[:1000])
+    with netCDF4.Dataset(source_path / "rico.00000002.nc", "a") as fh:
+        fh.createVariable("extra", "f4", ("zt",))
+
+    report = scan_source_blocks(source_path=source_path, file_prefix="rico")
+    assert not report.ok
+    assert set(Path(p).name for p in report.problems) == set(
+        ["rico.00010001.nc", "rico.00020001.nc", "rico.00000002.nc"]
+    )
+    assert report.problems[str(source_path / "rico.00010001.nc")] == ["missing"]
+    assert "extra" in report.problems[str(source_path / "rico.00000002.nc")][0]
+
+    args = ["--kind", "3d", "--file-prefix", "rico", "--var-name", "w", "--tn", "0"]
+    args += ["--source-path", str(source_path), "--check", "--dry-run"]
+    assert main(args) == 1
+
+
+def test_scan_finds_truncated_data():
+    tmpdir = tempfile.TemporaryDirectory()
+    source_path = Path(tmpdir.name)
+    for i in range(2):
+        fn = source_path / f"rico.{i:04d}0000.nc"
+        with netCDF4.Dataset(fn, "w", format="NETCDF3_CLASSIC") as fh:
+            fh.createDimension("time", None)
+            fh.createDimension("xt", 100)
+            fh.createVariable("w", "f4", ("time", "xt"))[:] = np.ones((5, 100))
+
+    assert scan_source_blocks(source_path=source_path, file_prefix="rico").ok
+
+    # the header (and so the number of timesteps) is intact, but not the data
+    fn_truncated = source_path / "rico.00010000.nc"
+    fn_truncated.write_bytes(fn_truncated.read_bytes()[:1000])
+    report = scan_source_blocks(source_path=source_path, file_prefix="rico")
+    assert list(report.problems) == [str(fn_truncated)]
+    assert "truncated" in report.problems[str(fn_truncated)][0]
@@ -0,0 +1,71 @@
+from pathlib import Path
+
+import netCDF4
+import numpy as np
+
+from uclales.loader import UCLALES_NetCDFHandler
+
+
+def test_load_subregion(testdata_path):
+    fn = Path(testdata_path) / "rico.00000000.nc"
+    fh = UCLALES_NetCDFHandler(fname=fn)
+
+    region = dict(x=slice(2, 10), z=slice(0, 5))
+    data, grid = fh.get_data_and_grid(var_name="w", timestep=0, region=region)
+
+    # data is always returned as (x, y, z)
+    ds = netCDF4.Dataset(fn)
+    ny = ds.dimensions["yt"].size
+    assert data.shape == (8, ny, 5)
+    assert all(c.shape == data.shape for c in grid)
+    np.testing.assert_allclose(grid[0][:, 0, 0], ds.variables["xt"][2:10])
+
+
+def test_derived_fields_reuse_inputs(testdata_path):
+    fn = Path(testdata_path) / "rico.00000000.nc"
+    fh = UCLALES_NetCDFHandler(fname=fn)
+    region = dict(z=slice(0, 3))
+
+    fh.get_data_and_grid(var_name="q_l", timestep=0, region=region)
+    # only the liquid water field is needed for `q_l`
+    assert [k[0] for k in fh._cache] == ["l"]
+
+    fh.get_data_and_grid(var_name="T", timestep=0, region=region)
+    n_cached = len(fh._cache)
+    fh.get_data_and_grid(var_name="T", timestep=0, region=region)
+    assert len(fh._cache) == n_cached
+
+
+def test_load_from_blocks(testdata_path):
+    fh_blocks = UCLALES_NetCDFHandler(source_path=testdata_path, file_prefix="rico")
+    fh_first = UCLALES_NetCDFHandler(fname=Path(testdata_path) / "rico.00000000.nc")
+    nx = fh_first.fhandle.dimensions["xt"].size
+
+    # a region spanning the first two blocks in x
+    region = dict(x=slice(nx - 4, nx + 4), y=slice(0, 4), z=slice(0, 5))
+    data, grid = fh_blocks.get_data_and_grid(var_name="q_l", timestep=0, region=region)
+    assert data.shape[0] == 8
+    assert np.all(np.diff(grid[0][:, 0, 0]) > 0)
+
+    data_first, _ = fh_first.get_data_and_grid(
+        var_name="q_l",
+        timestep=0,
+        region=dict(x=slice(nx - 4, nx), y=slice(0, 4), z=slice(0, 5)),
+    )
+    np.testing.assert_allclose(data[:4], data_first)
+
+
+def test_cached_field_not_modified(testdata_path):
+    fn = Path(testdata_path) / "rico.00000000.nc"
+    fh = UCLALES_NetCDFHandler(fname=fn)
+    region = dict(z=-1)
+
+    data, _ = fh.get_data_and_grid(var_name="w", timestep=0, region=region)
+    assert data.shape[2] == 1
+    expected = data.copy()
+    data -= 1.0
+    data_again, _ = fh.get_data_and_grid(var_name="w", timestep=0, region=region)
+    np.testing.assert_array_equal(data_again, expected)
+    np.testing.assert_array_equal(
+        data_again[..., 0], netCDF4.Dataset(fn).variables["w"][0, :, :, -1].T
+    )
@@ -0,0 +1,60 @@
+import threading
+import time
+
+from uclales.output.pipeline import PipelinedWriter, PrefetchingReader
+
+
+def _slow_square(n):
+    time.sleep(0.01)
+    return n**2
+
+
+def test_prefetching_reader_keeps_order():
+    reader = PrefetchingReader(read_fn=_slow_square, items=range(10), depth=3)
+    assert list(reader) == [(n, n**2) for n in range(10)]
+
+    metrics = reader.metrics.summary()
+    assert metrics["n_items"] == 10
+    assert metrics["max_occupancy"] <= 3
+
+
+def test_prefetching_reader_reads_ahead():
+    depth = 3
+    finished = []
+
+    def _read(n):
+        finished.append(n)
+        return n
+
+    reader = PrefetchingReader(read_fn=_read, items=range(10), depth=depth)
+    for n, _ in reader:
+        # the reads continue while the item is being consumed...
+        time.sleep(0.05)
+        # ...but run at most `depth` items ahead
+        assert max(finished) == min(n + depth, 9)
+    assert reader.metrics.summary()["empty_fraction"] < 0.5
+
+
+def test_pipelined_writer_overlaps_and_is_bounded():
+    depth = 2
+    release = threading.Event()
+    written = []
+
+    def _write(item, data):
+        release.wait()
+        written.append(item)
+
+    writer = PipelinedWriter(write_fn=_write, depth=depth)
+    with writer:
+        # the writes are blocked, but submitting up to `depth` doesn't wait
+        for n in range(depth):
+            writer.submit(n, None)
+        assert written == []
+        # the next submit waits for room in the queue
+        t = threading.Thread(target=writer.submit, args=(depth, None))
+        t.start()
+        t.join(timeout=0.1)
+        assert t.is_alive()
+        release.set()
+        t.join()
+    assert written == list(range(depth + 1))
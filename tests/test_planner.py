@@ -0,0 +1,87 @@
+import tempfile
+from pathlib import Path
+
+import luigi
+
+import uclales
+from uclales.output.planner import (
+    _available_memory,
+    choose_plan,
+    estimate_strategies,
+    plan_extraction,
+)
+
+
+def test_estimate_strategies(testdata_path):
+    plans = estimate_strategies(
+        source_path=testdata_path,
+        file_prefix="rico",
+        var_name="w",
+        kind="3d",
+        allow_cdo=False,
+    )
+    assert set(p.mode for p in plans) == {"blocks", "x_strips", "y_strips"}
+    assert not any(p.use_cdo for p in plans)
+
+    # with very little memory the plan using least memory must be picked
+    plan = choose_plan(plans, memory_available=1)
+    assert plan.peak_memory == min(p.peak_memory for p in plans)
+
+
+def test_dry_run(testdata_path):
+    tmpdir = tempfile.TemporaryDirectory()
+    output_path = Path(tmpdir.name)
+
+    task = uclales.output.Extract(
+        var_name="w",
+        tn=0,
+        kind="3d",
+        file_prefix="rico",
+        source_path=testdata_path,
+        mode="auto",
+        dry_run=True,
+        dest_path=output_path,
+    )
+    assert luigi.build([task], local_scheduler=True)
+    assert len(list(output_path.glob("**/*.nc"))) == 0
+
+
+def test_dry_run_reports_strategy_used(testdata_path, capsys):
+    task = uclales.output.Extract(
+        var_name="w",
+        tn=0,
+        kind="3d",
+        file_prefix="rico",
+        source_path=testdata_path,
+        mode="y_strips",
+        use_cdo=False,
+        dry_run=True,
+    )
+    task.run()
+    assert "Strategy used: mode=y_strips use_cdo=False" in capsys.readouterr().out
+
+
+def test_auto_mode_planned_once(testdata_path, monkeypatch, tmp_path):
+    calls = []
+
+    def _plan_extraction(**kwargs):
+        calls.append(kwargs)
+        return plan_extraction(**kwargs)
+
+    monkeypatch.setattr(uclales.output.extraction, "plan_extraction", _plan_extraction)
+    task = uclales.output.Extract(
+        var_name="w",
+        tn=0,
+        kind="3d",
+        file_prefix="rico",
+        source_path=testdata_path,
+        mode="auto",
+        use_cdo=False,
+        dest_path=tmp_path,
+    )
+    # luigi asks for the requirements and completion repeatedly
+    requirements = [task.requires() for _ in range(3)]
+    task.complete()
+    assert len(calls) == 1
+    assert all(r == requirements[0] for r in requirements)
+    assert _available_memory() > 0
@@ -0,0 +1,102 @@
+import tempfile
+from pathlib import Path
+
+import luigi
+import netCDF4
+import numpy as np
+import pytest
+
+import uclales
+
+pytest.importorskip("matplotlib")
+
+import matplotlib.image  # noqa
+
+from uclales.plots.quicklook import (  # noqa
+    BlockFrames,
+    ExtractedFrames,
+    downsample,
+    downsample_factor,
+    render_frames,
+)
+
+
+def test_downsample():
+    values = np.arange(30, dtype=float).reshape(5, 6)
+    values[0, 0] = np.nan
+    assert downsample_factor(values.shape, (2, 3)) == 3
+    values_ds = downsample(values, 3)
+    assert values_ds.shape == (2, 2)
+    np.testing.assert_allclose(values_ds[0, 0], np.mean([1, 2, 6, 7, 8, 12, 13, 14]))
+    # partial tile at the edge
+    np.testing.assert_allclose(values_ds[1, 1], np.mean([21, 22, 23, 27, 28, 29]))
+
+
+def test_extracted_frames_unpacked():
+    tmpdir = tempfile.TemporaryDirectory()
+    path = Path(tmpdir.name) / "lwp.nc"
+    values = np.array([[[0.0, 0.25], [1.5, -1.0]]])
+    with netCDF4.Dataset(path, "w") as fh:
+        for d, n in zip(["time", "yt", "xt"], values.shape):
+            fh.createDimension(d, n)
+        var = fh.createVariable("lwp", "i2", ("time", "yt", "xt"), fill_value=-32767)
+        var.scale_factor = 0.01
+        var[:] = np.ma.masked_less(values, 0.0)
+
+    frame = ExtractedFrames(path, var_name="lwp").read(0)
+    np.testing.assert_allclose(frame, [[0.0, 0.25], [1.5, np.nan]])
+
+
+def test_render_frames(testdata_path):
+    tmpdir = tempfile.TemporaryDirectory()
+    task = uclales.output.Extract(
+        file_prefix="rico",
+        var_name="lwp",
+        kind="2d",
+        orientation="xy",
+        source_path=testdata_path,
+        dest_path=tmpdir.name,
+        use_cdo=False,
+    )
+    assert luigi.build([task], local_scheduler=True)
+
+    source_file = ExtractedFrames(task.output().path, var_name="lwp")
+    source_blocks = BlockFrames(testdata_path, file_prefix="rico", var_name="lwp")
+    assert source_file.n_frames == source_blocks.n_frames
+    ny, nx = source_blocks.shape
+    size = (ny // 4, nx // 4)
+    tns = [0, source_file.n_frames - 1]
+
+    paths = {}
+    for kind, source in [("file", source_file), ("blocks", source_blocks)]:
+        paths[kind] = render_frames(
+            source,
+            dest_path=Path(tmpdir.name) / kind,
+            size=size,
+            tns=tns,
+            n_workers=2,
+        )
+        assert [Path(p).name for p in paths[kind]] == [
+            f"lwp.{tn:05d}.png" for tn in tns
+        ]
+
+    for path_file, path_blocks in zip(paths["file"], paths["blocks"]):
+        img = matplotlib.image.imread(path_file)
+        assert img.shape[:2] == size
+        np.testing.assert_array_equal(img, matplotlib.image.imread(path_blocks))
+
+
+def test_import_keeps_matplotlib_backend():
+    import importlib
+
+    import matplotlib
+
+    import uclales.plots.quicklook
+
+    backend = matplotlib.get_backend()
+    matplotlib.use("svg")
+    try:
+        importlib.reload(uclales.plots.quicklook)
+        assert matplotlib.get_backend() == "svg"
+    finally:
+        matplotlib.use(backend)
@@ -0,0 +1,61 @@
+import tempfile
+from pathlib import Path
+
+import luigi
+import netCDF4
+import numpy as np
+import pytest
+import xarray as xr
+
+import uclales
+from uclales.loader import calc_derived_field
+from uclales.output.layout import BlockLayout
+from uclales.output.reductions import reduce_columns
+
+
+def test_cloud_base_and_top():
+    z = np.array([10.0, 30.0, 50.0, 70.0])
+    # two columns, the second without cloud
+    q_l = np.array([[0.0, 2.0e-5, 3.0e-5, 0.0], [0.0, 0.0, 1.0e-6, 0.0]])
+    base = reduce_columns(q_l, z=z, axis=1, reduction="cloud_base_height")
+    top = reduce_columns(q_l, z=z, axis=1, reduction="cloud_top_height")
+    np.testing.assert_allclose(base, [30.0, np.nan])
+    np.testing.assert_allclose(top, [50.0, np.nan])
+
+
+@pytest.mark.parametrize("var_name", ["colmax_w", "colint_l"])
+def test_extract_column_reduction(testdata_path, var_name):
+    tmpdir = tempfile.TemporaryDirectory()
+    task = uclales.output.Extract(
+        var_name=var_name,
+        tn=0,
+        kind="3d",
+        file_prefix="rico",
+        source_path=testdata_path,
+        use_cdo=False,
+        mode="x_strips",
+        dest_path=Path(tmpdir.name),
+    )
+    assert luigi.build([task], local_scheduler=True)
+    da = task.output().open()
+
+    layout = BlockLayout(source_path=testdata_path, file_prefix="rico")
+    source_var = var_name.split("_")[1]
+    with netCDF4.Dataset(layout.block_path(0, 0)) as fh:
+        dims = fh.variables[source_var].dimensions
+    values = xr.DataArray(layout.read(source_var, time=[0]), dims=dims).astype(
+        np.float64
+    )
+    if var_name == "colmax_w":
+        expected = values.max("zm")
+    else:
+        zm = layout.read("zm").astype(np.float64)
+        dz = xr.DataArray(np.diff(zm, prepend=0.0), dims=("zt",))
+        fields = dict((v, layout.read(v, time=[0])) for v in ["t", "p", "q", "l", "r"])
+        rho = xr.DataArray(calc_derived_field("rho", dict(fields, i=0.0)), dims=dims)
+        expected = (values * rho * dz).sum("zt")
+
+    assert set(da.dims) == set(["time", "xt", "yt"])
+    if var_name == "colint_l":
+        assert da.units in ["kg/m2", "g/m2"]
+    np.testing.assert_allclose(da.transpose(*expected.dims), expected, rtol=1.0e-5)
@@ -0,0 +1,86 @@
+import netCDF4
+import numpy as np
+import xarray as xr
+
+from uclales.output.layout import BlockLayout
+from uclales.output.sampling import sample_points, sample_trajectories
+
+
+def test_sample_columns_and_trajectories(testdata_path):
+    layout = BlockLayout(source_path=testdata_path, file_prefix="rico")
+    with netCDF4.Dataset(layout.block_path(0, 0)) as fh:
+        dims = fh.variables["w"].dimensions
+    w = xr.DataArray(layout.read("w", time=slice(None)), dims=dims)
+    xt = layout.read("xt")
+    yt = layout.read("yt")
+    zm = layout.read("zm")
+
+    # points spread across different blocks (including two in the same block)
+    ix = np.array([0, 3, layout.nx - 1, layout.block_nx + 1])
+    iy = np.array([1, 2, layout.ny - 1, 0])
+
+    ds = sample_points(
+        source_path=testdata_path,
+        file_prefix="rico",
+        var_names=["w"],
+        x=xt[ix],
+        y=yt[iy],
+        tns=[0],
+    )
+    assert ds.w.dims == ("point", "time", "zm")
+    for n in range(len(ix)):
+        np.testing.assert_allclose(
+            ds.w.isel(point=n, time=0), w.isel(time=0, xt=ix[n], yt=iy[n])
+        )
+
+    iz = np.array([0, 5, 2, 9])
+    tn = np.array([0, 0, 0, 0])
+    ds = sample_trajectories(
+        source_path=testdata_path,
+        file_prefix="rico",
+        var_names="w",
+        tn=tn,
+        x=xt[ix],
+        y=yt[iy],
+        z=zm[iz],
+    )
+    w_samples = w.isel(
+        time=xr.DataArray(tn, dims="sample"),
+        xt=xr.DataArray(ix, dims="sample"),
+        yt=xr.DataArray(iy, dims="sample"),
+        zm=xr.DataArray(iz, dims="sample"),
+    )
+    np.testing.assert_allclose(ds.w, w_samples)
+
+
+def test_sample_trajectories_grouped_reads(testdata_path):
+    layout = BlockLayout(source_path=testdata_path, file_prefix="rico")
+    with netCDF4.Dataset(layout.block_path(0, 0)) as fh:
+        dims = fh.variables["w"].dimensions
+    w = xr.DataArray(layout.read("w", time=slice(None)), dims=dims)
+    xt = layout.read("xt")
+    yt = layout.read("yt")
+    zm = layout.read("zm")
+
+    # a clustered trajectory (read as bounding boxes) across both timesteps
+    # followed by points scattered across one block (read one by one)
+    ix = np.array([4, 5, 5, 6, 4, 5, 0, layout.block_nx - 1, 7])
+    iy = np.array([8, 8, 9, 9, 8, 9, 0, layout.block_ny - 1, 20])
+    iz = np.array([10, 10, 11, 11, 12, 12, 0, 60, 30])
+    tn = np.array([0, 0, 0, 0, 1, 1, 1, 1, 1])
+    ds = sample_trajectories(
+        source_path=testdata_path,
+        file_prefix="rico",
+        var_names="w",
+        tn=tn,
+        x=xt[ix],
+        y=yt[iy],
+        z=zm[iz],
+    )
+    w_samples = w.isel(
+        time=xr.DataArray(tn, dims="sample"),
+        xt=xr.DataArray(ix, dims="sample"),
+        yt=xr.DataArray(iy, dims="sample"),
+        zm=xr.DataArray(iz, dims="sample"),
+    )
+    np.testing.assert_allclose(ds.w, w_samples)
@@ -0,0 +1,57 @@
+import os
+import tempfile
+from pathlib import Path
+
+import luigi
+import pytest
+
+import uclales
+from uclales.output.scheduling import MEMORY_RESOURCE, parse_memory
+
+USE_CDO = os.environ.get("CDO_VERSION", "") != ""
+
+
+@pytest.fixture
+def memory_budget():
+    config = luigi.configuration.get_config()
+    config.set("memory", "budget", "1GB")
+    yield parse_memory("1GB")
+    config.remove_option("memory", "budget")
+    config.remove_option("resources", MEMORY_RESOURCE)
+
+
+def test_parse_memory():
+    assert parse_memory("16GB") == 16 * 1024
+    assert parse_memory("512") == 512
+    assert parse_memory("1.5 gb") == 1536
+
+
+def test_extract_with_memory_budget(testdata_path, memory_budget):
+    tmpdir = tempfile.TemporaryDirectory()
+
+    task = uclales.output.Extract(
+        var_name="w",
+        tn=0,
+        kind="3d",
+        file_prefix="rico",
+        source_path=testdata_path,
+        use_cdo=USE_CDO,
+        mode="x_strips",
+        dest_path=Path(tmpdir.name),
+    )
+    config = luigi.configuration.get_config()
+    assert config.getint("resources", MEMORY_RESOURCE) == memory_budget
+
+    merge_task = task.merge_task()
+    strip_task = merge_task.requires()["parts"][0]
+    block_task = strip_task.requires()[0]
+    amounts = [
+        t.resources[MEMORY_RESOURCE] for t in [merge_task, strip_task, block_task]
+    ]
+    # the estimated memory use grows with the amount of data handled, but no
+    # task may ask for more than the whole budget
+    assert amounts == sorted(amounts, reverse=True)
+    assert all(0 < amount <= memory_budget for amount in amounts)
+
+    assert luigi.build([task], local_scheduler=True, workers=2)
+    assert task.output().exists()
@@ -0,0 +1,72 @@
+import os
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+import luigi
+
+import uclales
+
+USE_CDO = os.environ.get("CDO_VERSION", "") != ""
+
+SHARD_SCRIPT = """
+import sys
+import luigi
+import uclales
+
+task = uclales.output.ExtractShard(
+    shard=sys.argv[1],
+    var_names=["w"],
+    tns=[0],
+    kind="3d",
+    file_prefix="rico",
+    source_path=sys.argv[2],
+    dest_path=sys.argv[3],
+    use_cdo=sys.argv[4] == "True",
+    mode="x_strips",
+)
+assert luigi.build([task], local_scheduler=True)
+"""
+
+
+def test_sharded_extraction(testdata_path):
+    tmpdir = tempfile.TemporaryDirectory()
+    output_path = Path(tmpdir.name)
+    n_shards = 3
+
+    task_assemble = uclales.output.AssembleShards(
+        n_shards=n_shards,
+        var_names=["w"],
+        tns=[0],
+        kind="3d",
+        file_prefix="rico",
+        source_path=testdata_path,
+        dest_path=output_path,
+        use_cdo=USE_CDO,
+        mode="x_strips",
+    )
+    # none of the shards have run yet so the assembly shouldn't start
+    luigi.build([task_assemble], local_scheduler=True)
+    assert not task_assemble.complete()
+
+    # run each shard as a separate process, as if they were array jobs
+    procs = [
+        subprocess.Popen(
+            [
+                sys.executable,
+                "-c",
+                SHARD_SCRIPT,
+                f"{k}/{n_shards}",
+                str(testdata_path),
+                str(output_path),
+                str(USE_CDO),
+            ]
+        )
+        for k in range(n_shards)
+    ]
+    assert all(p.wait() == 0 for p in procs)
+
+    assert luigi.build([task_assemble], local_scheduler=True)
+    da = task_assemble.output()[0].open()
+    assert da.shape == (1, 128, 128, 70)
@@ -0,0 +1,83 @@
+import os
+import tempfile
+from pathlib import Path
+
+import luigi
+import numpy as np
+import pytest
+import xarray as xr
+
+import uclales
+from uclales.output.sparse_output import open_sparse, to_sparse_dataset
+
+
+@pytest.mark.parametrize("layout", ["coo", "blocks"])
+def test_sparse_roundtrip(layout):
+    # domain not a whole number of tiles, so the edge tiles are padded
+    values = np.zeros((2, 5, 20, 18))
+    values[0, 1:3, 2:4, 15:18] = 1.0
+    values[1, 4, 19, 0] = -2.0
+    da = xr.DataArray(
+        values,
+        dims=("time", "zt", "yt", "xt"),
+        coords=dict(xt=np.arange(18) * 25.0, zt=np.arange(5) * 10.0),
+        name="l",
+        attrs=dict(units="kg/kg"),
+    )
+    ds = to_sparse_dataset(da, layout=layout, tile_size=8)
+    # encoding a slab (along `y`) at a time gives the same result
+    ds_slabs = to_sparse_dataset(da, layout=layout, tile_size=8, slab_size=5)
+    xr.testing.assert_identical(ds_slabs, ds)
+
+    tmpdir = tempfile.TemporaryDirectory()
+    path = Path(tmpdir.name) / "l.sparse.nc"
+    ds.to_netcdf(path)
+    da_dense = open_sparse(path)
+    xr.testing.assert_identical(da_dense, da)
+    assert ds["l"].size < da.size
+
+
+@pytest.mark.parametrize("layout", ["coo", "blocks"])
+def test_extract_sparse(testdata_path, layout):
+    tmpdir = tempfile.TemporaryDirectory()
+    kws = dict(
+        file_prefix="rico",
+        var_name="l",
+        tn=1,
+        kind="3d",
+        source_path=testdata_path,
+        use_cdo=False,
+    )
+    task_dense = uclales.output.Extract(dest_path=tmpdir.name + "/dense", **kws)
+    task_sparse = uclales.output.Extract(
+        dest_path=tmpdir.name + "/sparse", sparse=layout, **kws
+    )
+    assert luigi.build([task_dense, task_sparse], local_scheduler=True)
+
+    assert task_sparse.output().path.endswith(f"rico.l.tn1.sparse-{layout}.nc")
+    # only the sparse output is kept, the dense field is removed
+    assert [p.name for p in (Path(tmpdir.name) / "sparse").rglob("rico.l.tn1*.nc")] == [
+        f"rico.l.tn1.sparse-{layout}.nc"
+    ]
+    assert task_sparse.complete()
+    assert list(Path(tmpdir.name).rglob("*.tmp.nc")) == []
+
+    # the sparse output is out-of-date once a source block changes
+    fn_block = Path(testdata_path) / "rico.00000000.nc"
+    stat = fn_block.stat()
+    os.utime(fn_block, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    try:
+        assert not task_sparse.complete()
+    finally:
+        os.utime(fn_block, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert task_sparse.complete()
+
+    da_dense = task_dense.output().open()
+    da_sparse = task_sparse.output().open()
+    np.testing.assert_array_equal(da_sparse.values, da_dense.values)
+    assert da_sparse.dims == da_dense.dims
+
+    sparse = pytest.importorskip("sparse")
+    da_coo = task_sparse.output().open(as_sparse=True)
+    assert isinstance(da_coo.data, sparse.COO)
+    np.testing.assert_array_equal(da_coo.data.todense(), da_dense.values)
@@ -0,0 +1,61 @@
+import tempfile
+from pathlib import Path
+
+import luigi
+import netCDF4
+import numpy as np
+import xarray as xr
+
+import uclales
+from uclales.output.layout import BlockLayout
+from uclales.output.statistics import RunningMoments
+
+
+def test_running_moments():
+    rng = np.random.default_rng(42)
+    w = 1.0e3 + rng.normal(size=(50, 3, 4))
+    q = rng.normal(size=(50, 3, 4)) + 0.5 * w
+
+    moments = RunningMoments(var_names=["w"], covariances=[("w", "q")])
+    for n in range(len(w)):
+        moments.update(dict(w=w[n], q=q[n]))
+
+    np.testing.assert_allclose(moments.mean["w"], w.mean(axis=0))
+    np.testing.assert_allclose(moments.variance("w"), w.var(axis=0))
+    cov = ((w - w.mean(axis=0)) * (q - q.mean(axis=0))).mean(axis=0)
+    np.testing.assert_allclose(moments.covariance("w", "q"), cov)
+
+
+def test_extract_temporal_statistics(testdata_path):
+    tmpdir = tempfile.TemporaryDirectory()
+    task = uclales.output.ExtractTemporalStatistics(
+        file_prefix="rico",
+        source_path=testdata_path,
+        var_names=["w", "q"],
+        covariances=[["w", "q"]],
+        dest_path=Path(tmpdir.name),
+    )
+    assert luigi.build([task], local_scheduler=True)
+    ds = task.output().open()
+
+    layout = BlockLayout(source_path=testdata_path, file_prefix="rico")
+    fields = {}
+    for v in ["w", "q"]:
+        with netCDF4.Dataset(layout.block_path(0, 0)) as fh:
+            dims = fh.variables[v].dimensions
+        fields[v] = xr.DataArray(
+            layout.read(v).astype(np.float64), dims=dims
+        ).transpose("time", ...)
+
+    for v in ["w", "q"]:
+        np.testing.assert_allclose(ds[f"{v}_mean"], fields[v].mean("time"))
+        np.testing.assert_allclose(
+            ds[f"{v}_variance"], fields[v].var("time"), atol=1.0e-10
+        )
+    w_prime = fields["w"] - fields["w"].mean("time")
+    q_prime = fields["q"] - fields["q"].mean("time")
+    np.testing.assert_allclose(
+        ds["w_q_covariance"],
+        (w_prime.values * q_prime.values).mean(axis=0),
+        atol=1.0e-10,
+    )
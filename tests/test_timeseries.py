@@ -0,0 +1,60 @@
+import tempfile
+from pathlib import Path
+
+import luigi
+import netCDF4
+import numpy as np
+import pytest
+import xarray as xr
+
+import uclales
+from uclales.output.layout import BlockLayout
+from uclales.output.timeseries import _batch_shape
+
+
+@pytest.mark.parametrize("source", ["blocks", "extracted"])
+def test_timeseries_store(testdata_path, source):
+    tmpdir = tempfile.TemporaryDirectory()
+    task = uclales.output.ExtractTimeSeriesStore(
+        var_name="w",
+        file_prefix="rico",
+        source_path=testdata_path,
+        dest_path=Path(tmpdir.name),
+        source=source,
+        tile_size=8,
+        # smaller than a single timestep so that the rechunking is done in
+        # slabs of rows of one timestep and one tile at a time
+        max_memory="1MB",
+        use_cdo=False,
+    )
+    assert luigi.build([task], local_scheduler=True)
+
+    layout = BlockLayout(source_path=testdata_path, file_prefix="rico")
+    with netCDF4.Dataset(task.output().path) as fh:
+        var = fh.variables["w"]
+        nt = var.shape[0]
+        assert var.chunking() == [nt, 8, 8, var.shape[-1]]
+        np.testing.assert_array_equal(var[:], layout.read("w"))
+
+    ds = xr.open_dataset(task.output().path)
+    assert np.issubdtype(ds.time.dtype, np.datetime64)
+    assert list(Path(tmpdir.name).rglob("*.timeseries.partial.nc")) == []
+    assert list(Path(tmpdir.name).rglob("*.tmp.nc")) == []
+
+
+def test_batch_shape():
+    # whole timesteps fit
+    assert _batch_shape(nt=10, ny=64, row_nbytes=10, tile_size=8, max_nbytes=2000) == (
+        3,
+        64,
+    )
+    # a single timestep doesn't fit, so slabs of whole tiles of rows are read
+    assert _batch_shape(nt=10, ny=64, row_nbytes=10, tile_size=8, max_nbytes=250) == (
+        1,
+        24,
+    )
+    # but at least one tile of rows
+    assert _batch_shape(nt=10, ny=64, row_nbytes=10, tile_size=8, max_nbytes=1) == (
+        1,
+        8,
+    )
@@ -0,0 +1,169 @@
+import tempfile
+from pathlib import Path
+
+import luigi
+import netCDF4
+import numpy as np
+import xarray as xr
+
+import uclales
+from uclales.output import statistics
+from uclales.output.layout import BlockLayout
+from uclales.output.sampling import sample_where
+from uclales.output.zonemaps import Predicate, ZoneMap, _block_zone_map
+
+
+def test_predicate():
+    predicate = Predicate.parse("l > 1e-5")
+    assert predicate.var_name == "l"
+    assert predicate.slug == "l_gt_1em05"
+    vmin, vmax = np.array([0.0, 0.0, 2.0e-5]), np.array([0.0, 2.0e-5, 3.0e-5])
+    np.testing.assert_array_equal(predicate.may_match(vmin, vmax), [0, 1, 1])
+    np.testing.assert_array_equal(
+        Predicate.parse("w<=-1").may_match(np.array([-2.0, -0.5, 0.0]), vmax), [1, 0, 0]
+    )
+
+
+def test_zone_map_ignores_nan():
+    tmpdir = tempfile.TemporaryDirectory()
+    path = Path(tmpdir.name) / "block.nc"
+    values = np.zeros((1, 2, 2, 4))
+    values[0, :, :, 1] = 1.0e-4
+    values[0, 0, 0, :2] = np.nan
+    values[0, :, :, 3] = np.nan
+    with netCDF4.Dataset(path, "w") as fh:
+        for d, n in zip(["time", "yt", "xt", "zt"], values.shape):
+            fh.createDimension(d, n)
+        fh.createVariable("l", "f8", ("time", "yt", "xt", "zt"))[:] = values
+
+    vmin, vmax, nonzero = _block_zone_map(path, ["l"], band_size=2)["l"]
+    np.testing.assert_array_equal(vmin, [[0.0, 0.0]])
+    np.testing.assert_array_equal(vmax, [[1.0e-4, 0.0]])
+    np.testing.assert_array_equal(
+        Predicate.parse("l > 0").may_match(vmin, vmax, nonzero), [[1, 0]]
+    )
+
+
+def _read_field(layout, var_name):
+    with netCDF4.Dataset(layout.block_path(0, 0)) as fh:
+        dims = fh.variables[var_name].dimensions
+    return xr.DataArray(layout.read(var_name), dims=dims)
+
+
+def test_zone_map_skips_blocks(testdata_path):
+    tmpdir = tempfile.TemporaryDirectory()
+    task = uclales.output.BuildZoneMap(
+        file_prefix="rico",
+        source_path=testdata_path,
+        var_names=["l"],
+        band_size=10,
+        dest_path=tmpdir.name,
+    )
+    assert luigi.build([task], local_scheduler=True)
+    zone_map = ZoneMap(task.output().path)
+
+    layout = BlockLayout(source_path=testdata_path, file_prefix="rico")
+    l_field = _read_field(layout, "l").isel(time=0)
+    cloudy_blocks = [
+        (i, j)
+        for i in range(layout.nx_b)
+        for j in range(layout.ny_b)
+        if np.any(
+            l_field.isel(
+                xt=slice(i * layout.block_nx, (i + 1) * layout.block_nx),
+                yt=slice(j * layout.block_ny, (j + 1) * layout.block_ny),
+            )
+            > 0
+        )
+    ]
+    # the test data should have some blocks without cloud
+    assert 0 < len(cloudy_blocks) < layout.nx_b * layout.ny_b
+    assert zone_map.blocks_matching("l > 0", tn=0) == cloudy_blocks
+
+    # all cloudy levels are within the levels that could match
+    cloudy_levels = np.nonzero((l_field > 0).any(dim=("xt", "yt")).values)[0]
+    i, j = cloudy_blocks[0]
+    levels = zone_map.levels_matching("l > 0", i=i, j=j, tn=0)
+    assert len(levels) < l_field.zt.size
+    assert set(cloudy_levels).issubset(levels)
+
+    # sampling with the zone map gives the same points as without
+    ds = sample_where(
+        testdata_path, "rico", var_names=["l", "q"], where="l > 0", tns=[0]
+    )
+    ds_skipped = sample_where(
+        testdata_path,
+        "rico",
+        var_names=["l", "q"],
+        where="l > 0",
+        tns=[0],
+        zone_map=zone_map,
+    )
+    assert ds.point.size == int((l_field > 0).sum())
+    order = np.lexsort((ds.zt, ds.yt, ds.xt))
+    order_skipped = np.lexsort((ds_skipped.zt, ds_skipped.yt, ds_skipped.xt))
+    for v in ["l", "q", "xt", "yt", "zt"]:
+        np.testing.assert_array_equal(
+            ds[v].values[order], ds_skipped[v].values[order_skipped]
+        )
+    assert np.all(ds.l > 0)
+
+
+def test_conditional_temporal_statistics(testdata_path):
+    tmpdir = tempfile.TemporaryDirectory()
+    task = uclales.output.ExtractTemporalStatistics(
+        file_prefix="rico",
+        source_path=testdata_path,
+        var_names=["q"],
+        where="l > 0",
+        dest_path=Path(tmpdir.name),
+    )
+    assert luigi.build([task], local_scheduler=True)
+    ds = task.output().open()
+
+    layout = BlockLayout(source_path=testdata_path, file_prefix="rico")
+    q = _read_field(layout, "q").astype(np.float64)
+    cloudy = _read_field(layout, "l") > 0
+    np.testing.assert_array_equal(ds.q_count, cloudy.sum("time"))
+    np.testing.assert_allclose(ds.q_mean, q.where(cloudy).mean("time"))
+    assert ds.attrs["where"] == "l > 0"
+    assert "n_timesteps" not in ds.attrs
+
+
+def test_conditional_statistics_needs_same_grid(testdata_path):
+    tmpdir = tempfile.TemporaryDirectory()
+    # `w` is on the cell faces (`zm`) and `l` on the cell centres (`zt`)
+    task = uclales.output.ExtractTemporalStatistics(
+        file_prefix="rico",
+        source_path=testdata_path,
+        var_names=["w"],
+        where="l > 0",
+        dest_path=Path(tmpdir.name),
+    )
+    assert not luigi.build([task], local_scheduler=True)
+
+
+def test_conditional_statistics_skip_levels(testdata_path, monkeypatch):
+    z_slices = []
+    read_timestep = statistics._read_timestep
+
+    def _read_timestep(path, var_dims, item):
+        z_slices.append(item[1])
+        return read_timestep(path, var_dims, item)
+
+    monkeypatch.setattr(statistics, "_read_timestep", _read_timestep)
+    tmpdir = tempfile.TemporaryDirectory()
+    task = uclales.output.ExtractTemporalStatistics(
+        file_prefix="rico",
+        source_path=testdata_path,
+        var_names=["q"],
+        where="l > 0",
+        dest_path=Path(tmpdir.name),
+    )
+    assert luigi.build([task], local_scheduler=True)
+
+    layout = BlockLayout(source_path=testdata_path, file_prefix="rico")
+    nz = layout.read("zt").size
+    # only the bands of levels with cloud are read
+    assert len(z_slices) > 0
+    assert all(len(range(*s.indices(nz))) < nz for s in z_slices)
@@ -1,4 +1,24 @@
-from . import output  # noqa
-from .loader import load_data_and_get_grid  # noqa
+import importlib
 
 __version__ = "0.1.4"
+
+# submodules and functions are only imported on first use so that
+# `import uclales` doesn't pull in luigi, xarray and scipy
+_LAZY_ATTRIBUTES = dict(
+    output=None,
+    loader=None,
+    load_data_and_get_grid="loader",
+)
+
+
+def __getattr__(name):
+    if name not in _LAZY_ATTRIBUTES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    module_name = _LAZY_ATTRIBUTES[name]
+    if module_name is None:
+        return importlib.import_module(f".{name}", __name__)
+    return getattr(importlib.import_module(f".{module_name}", __name__), name)
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_LAZY_ATTRIBUTES))
@@ -3,108 +3,249 @@ Utility for loading data from UCALES 3D datafiles with routines for calculating
 derived fields
 """
 import warnings
+from collections import OrderedDict
 
 import netCDF4
 import numpy as np
-import scipy.optimize
 
+from .output.layout import BlockLayout, _dim_kind
 
-def load_data_and_get_grid(fname, var_name, timestep=0):
-    fh = UCLALES_NetCDFHandler(fname=fname)
+# the raw (per-core output) fields that each derived field is calculated
+# from, ice (`i`) is optional and taken to be zero if missing
+DERIVED_FIELD_INPUTS = {
+    "rho": ["t", "p", "q", "l", "r", "i"],
+    "T": ["t", "p", "l"],
+    "q_v": ["q", "l", "i"],
+    "q_l": ["l"],
+}
 
-    return fh.get_data_and_grid(var_name=var_name, timestep=timestep)
+DERIVED_FIELD_ATTRS = {
+    "rho": ("kg/m3", "mixture density"),
+    "T": ("K", "absolute temperature"),
+    "q_v": ("kg/kg", "water vapour specific concentration"),
+    "q_l": ("kg/kg", "cloud water specific concentration"),
+}
+
+OPTIONAL_FIELDS = ["i"]
+
+
+def load_data_and_get_grid(
+    fname=None,
+    var_name=None,
+    timestep=0,
+    region=None,
+    source_path=None,
+    file_prefix=None,
+):
+    fh = UCLALES_NetCDFHandler(
+        fname=fname, source_path=source_path, file_prefix=file_prefix
+    )
+
+    return fh.get_data_and_grid(var_name=var_name, timestep=timestep, region=region)
+
+
+def _normalise_region(region):
+    """
+    Turn `region` (a dict of index slices for `x`, `y` and/or `z`) into a
+    hashable tuple so that it can be used as part of a cache key
+    """
+    if region is None:
+        region = {}
+
+    unknown_dims = set(region.keys()).difference(["x", "y", "z"])
+    if len(unknown_dims) > 0:
+        raise NotImplementedError(
+            f"Can only select a subregion along `x`, `y` and `z`, not {unknown_dims}"
+        )
+
+    def _as_tuple(s):
+        if isinstance(s, slice):
+            return (s.start, s.stop, s.step)
+        # a negative index counts from the end, `-1` is the last element
+        return (s, s + 1 if s != -1 else None, None)
+
+    return tuple(
+        (d, _as_tuple(region[d])) for d in ["x", "y", "z"] if region.get(d) is not None
+    )
+
+
+def calc_derived_field(var_name, fields):
+    """
+    Calculate the derived field `var_name` from the raw `fields` (a dict
+    with the fields in `DERIVED_FIELD_INPUTS[var_name]`, optional fields may
+    be given as scalars)
+    """
+    if "q" in fields and 1000 * fields["q"].max() < 1.0:
+        warnings.warn(
+            "The `r_t` may actually be in g/kg, but we're assuming "
+            "that the bug in UCLALES where the mixing ratios are mislabelled"
+        )
+
+    q_l = fields["l"] / (fields["l"] + 1.0)
+    if var_name == "q_l":
+        return q_l
+
+    if "i" in fields:
+        q_i = fields["i"] / (fields["i"] + 1.0)
+    if "q" in fields:
+        q_t = fields["q"] / (fields["q"] + 1.0)
+        # XXX: according to Axel Seifert rain is currently not considered
+        # as part of the "total water" mixing ratio
+        q_v = q_t - q_l - q_i
+        if var_name == "q_v":
+            return q_v
+
+    T = UCLALES_NetCDFHandler.calc_temperature(
+        q_l=q_l, theta_l=fields["t"], p=fields["p"]
+    )
+    if var_name == "T":
+        return T
+    elif var_name == "rho":
+        q_r = fields["r"] / (fields["r"] + 1.0)
+        q_d = 1.0 - q_t
+        return UCLALES_NetCDFHandler.calc_density(
+            q_d=q_d, q_v=q_v, T=T, p=fields["p"], q_l=q_l, q_i=q_i, q_r=q_r
+        )
+    else:
+        raise NotImplementedError(var_name)
 
 
 class UCLALES_NetCDFHandler:
-    def __init__(self, fname):
-        self.fname = fname
+    """
+    Loads raw and derived fields from a UCLALES 3D datafile, either a single
+    (stitched) file `fname` or directly from the per-core blocks with prefix
+    `file_prefix` in `source_path`. Raw fields read from file are kept in a
+    least-recently-used cache (holding at most `cache_size` fields) so that
+    calculating several derived fields at the same timestep only reads each
+    of the inputs once
+    """
+
+    def __init__(self, fname=None, source_path=None, file_prefix=None, cache_size=8):
+        if fname is not None:
+            self.fname = fname
+            self.layout = None
+        elif file_prefix is not None:
+            self.layout = BlockLayout(
+                source_path=source_path or ".", file_prefix=file_prefix, kind="3d"
+            )
+            # the first block is used for the variable metadata
+            self.fname = self.layout.block_path(0, 0)
+        else:
+            raise Exception(
+                "Either `fname` or `file_prefix` (and optionally `source_path`)"
+                " must be given"
+            )
         self.fhandle = netCDF4.Dataset(self.fname)
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
 
-    def get_data_and_grid(self, var_name, timestep):
-        derived_field = False
+    def _read_field(self, var_name, timestep, region=()):
+        """
+        Read the raw field `var_name` at `timestep` within `region` (as
+        returned by `_normalise_region`) keeping the ordering of dimensions
+        as in the source file
+        """
+        key = (var_name, int(timestep), region)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
 
-        if var_name in ["rho", "T", "q_v", "q_l"]:
-            derived_field = True
-            tn_ = timestep
-            theta_l = self.fhandle.variables["t"][tn_, :]
-            p = self.fhandle.variables["p"][tn_, :]
-            assert p.shape == theta_l.shape
-            r_t = self.fhandle.variables["q"][tn_, :]
-            r_l = self.fhandle.variables["l"][tn_, :]
-            r_r = self.fhandle.variables["r"][tn_, :]
-            if "i" in self.fhandle.variables:
-                r_i = self.fhandle.variables["i"][tn_, :]
-            else:
-                r_i = np.zeros_like(r_r)
-
-            if 1000 * r_t.max() < 1.0:
-                warnings.warn(
-                    "The `r_t` may actually be in g/kg, but we're assuming "
-                    "that the bug in UCLALES where the mixing ratios are mislabelled"
-                )
-            q_t = r_t / (r_t + 1.0)
-            q_l = r_l / (r_l + 1.0)
-            q_r = r_r / (r_r + 1.0)
-            q_i = r_i / (r_i + 1.0)
-            # XXX: according to Axel Seifert rain is currently not considered
-            # as part of the "total water" mixing ratio
-            q_v = q_t - q_l - q_i
-            q_d = 1.0 - q_t - q_r
-
-            T = self.calc_temperature(q_l=q_l, theta_l=theta_l, p=p)
-            if var_name == "rho":
-                q_d = 1.0 - q_t
-                data = self.calc_density(
-                    q_d=q_d, q_v=q_v, T=T, p=p, q_l=q_l, q_i=q_i, q_r=q_r
-                )
-            elif var_name == "T":
-                data = T
-            elif var_name == "q_v":
-                data = q_v
-            elif var_name == "q_l":
-                data = q_l
-            else:
-                raise NotImplementedError()
+        slices = dict((d, slice(*s)) for (d, s) in region)
+        if self.layout is not None:
+            data = self.layout.read(var_name, time=int(timestep), **slices)
         else:
-            data = self.fhandle.variables[var_name][timestep]
+            var = self.fhandle.variables[var_name]
+            idx = []
+            for d in var.dimensions:
+                if d == "time":
+                    idx.append(int(timestep))
+                else:
+                    idx.append(slices.get(_dim_kind(d), slice(None)))
+            data = var[tuple(idx)]
+
+        # the cached field is shared by later reads, so mustn't be modified
+        data.setflags(write=False)
+        self._cache[key] = data
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return data
+
+    def _spatial_dims(self, var_name):
+        """
+        Spatial dimensions of `var_name`, derived fields are all defined on
+        cell-centers
+        """
+        if var_name in DERIVED_FIELD_INPUTS:
+            var_name = "t"
+        return [d for d in self.fhandle.variables[var_name].dimensions if d != "time"]
+
+    def _calc_derived_field(self, var_name, timestep, region):
+        fields = {}
+        for v in DERIVED_FIELD_INPUTS[var_name]:
+            if v in OPTIONAL_FIELDS and v not in self.fhandle.variables:
+                # a scalar broadcasts in all the calculations below so that
+                # we avoid allocating a field of zeros
+                fields[v] = 0.0
+            else:
+                fields[v] = self._read_field(v, timestep, region)
+
+        return calc_derived_field(var_name, fields)
+
+    def get_data_and_grid(self, var_name, timestep, region=None):
+        """
+        Get field `var_name` at `timestep` optionally only within `region`,
+        a dict of index slices along `x`, `y` and/or `z`, e.g. `dict(z=slice(0,
+        10))`. The data is returned with dimensions ordered as (x, y, z) and
+        the grid as read-only broadcast views of the 1D coordinates (i.e.
+        without allocating the full 3D grid)
+        """
+        region = _normalise_region(region)
 
-        data = np.swapaxes(data, 0, 1)
-        # XXX: quick hack, masked arrays let us set attributes (like `units`)
-        data = np.ma.masked_array(data)
+        if var_name in DERIVED_FIELD_INPUTS:
+            derived_field = True
+            data = self._calc_derived_field(
+                var_name=var_name, timestep=timestep, region=region
+            )
+        else:
+            derived_field = False
+            data = self._read_field(var_name, timestep, region)
 
-        x_ = self.fhandle.variables["xt"][:]
-        y_ = self.fhandle.variables["yt"][:]
-        z_ = self.fhandle.variables["zt"][:]
+        # reorder to (x, y, z), this creates a view rather than a copy
+        dims = self._spatial_dims(var_name)
+        dim_kinds = [_dim_kind(d) for d in dims]
+        data = np.transpose(data, [dim_kinds.index(d) for d in ["x", "y", "z"]])
+        # XXX: quick hack, masked arrays let us set attributes (like `units`).
+        # Raw fields are copied so that the cached (read-only) field isn't
+        # returned
+        data = np.ma.masked_array(data, copy=not derived_field)
 
         if not derived_field:
             data.units = self.fhandle.variables[var_name].units
             data.long_name = self.fhandle.variables[var_name].longname
-        elif var_name == "rho":
-            data.units = "kg/m3"
-            data.long_name = "mixture density"
-        elif var_name == "rho_g":
-            data.units = "kg/m3"
-            data.long_name = "gas density"
-        elif var_name == "T":
-            data.units = "K"
-            data.long_name = "absolute temperature"
-        elif var_name == "q_v":
-            data.units = "kg/kg"
-            data.long_name = "water vapour specific concentration"
-        elif var_name == "q_l":
-            data.units = "kg/kg"
-            data.long_name = "cloud water specific concentration"
+        elif var_name in DERIVED_FIELD_ATTRS:
+            data.units, data.long_name = DERIVED_FIELD_ATTRS[var_name]
         else:
             raise NotImplementedError()
 
         data.time = "0"  # TODO: fix this
         data.time_units = "seconds"  # TODO: fix this
 
-        grid = np.meshgrid(x_, y_, z_, indexing="ij")
+        slices = dict((d, slice(*s)) for (d, s) in region)
+        coords = []
+        for n, d in enumerate(["x", "y", "z"]):
+            dim = dims[dim_kinds.index(d)]
+            if self.layout is not None and d in ["x", "y"]:
+                c_ = self.layout.read(dim, **{d: slices.get(d, slice(None))})
+            else:
+                c_ = self.fhandle.variables[dim][slices.get(d, slice(None))]
+            c_shape = [1, 1, 1]
+            c_shape[n] = -1
+            coords.append(c_.reshape(c_shape))
+        grid = np.broadcast_arrays(*coords)
 
         return (data, grid)
 
-    @np.vectorize
+    @staticmethod
     def calc_density(q_d, q_v, q_l, q_r, q_i, T, p):
         # constants from UCLALES
         R_d = 287.04  # [J/kg/K]
@@ -130,8 +271,13 @@ class UCLALES_NetCDFHandler:
 
         return 1.0 / rho_gas_inv
 
-    @np.vectorize
-    def calc_temperature(q_l, p, theta_l):
+    @staticmethod
+    def calc_temperature(q_l, p, theta_l, max_iterations=20):
+        """
+        Absolute temperature from the liquid water specific concentration
+        `q_l`, pressure `p` and liquid potential temperature `theta_l`, found
+        with Newton iterations on all points at once
+        """
         # constants from UCLALES
         cp_d = 1.004 * 1.0e3  # [J/kg/K]
         R_d = 287.04  # [J/kg/K]
@@ -142,19 +288,22 @@ class UCLALES_NetCDFHandler:
         # given in B. Steven's notes on moist thermodynamics), but instead
         # reflects the form used in UCLALES where in place of the mixture
         # heat-capacity the dry-air heat capacity is used
-        def temp_func(T):
-            return theta_l - T * (p_theta / p) ** (R_d / cp_d) * np.exp(
-                -L_v * q_l / (cp_d * T)
-            )
+        exner_inv = (p_theta / p) ** (R_d / cp_d)
+        a = L_v * q_l / cp_d
 
-        if np.all(q_l == 0.0):
-            # no need for root finding
-            return theta_l / ((p_theta / p) ** (R_d / cp_d))
+        def temp_func(T):
+            return theta_l - T * exner_inv * np.exp(-a / T)
 
-        # XXX: brentq solver requires bounds, I don't expect we'll get below -100C
-        T_min = -100.0 + 273.0
-        T_max = 50.0 + 273.0
-        T = scipy.optimize.brentq(f=temp_func, a=T_min, b=T_max)
+        # exact without liquid water. `temp_func` is increasing and convex in
+        # `T` so the iterations converge from this first guess (below the
+        # root) after overshooting it once
+        T = theta_l / exner_inv
+        for _ in range(max_iterations):
+            f = temp_func(T)
+            if np.all(np.abs(f) < 1.0e-6):
+                break
+            dfdT = -exner_inv * np.exp(-a / T) * (1.0 + a / T)
+            T = T - f / dfdT
 
         # check that we're within 1.0e-4
         assert np.all(np.abs(temp_func(T)) < 1.0e-4)
@@ -1 +1,31 @@
-from .extraction import Extract  # noqa
+import importlib
+
+# the tasks and functions are only imported on first use so that importing
+# `uclales.output` (e.g. for the command line interface) doesn't pull in luigi
+# and xarray, `uclales.output.tasks` imports all the tasks for running them
+# with `python -m luigi`
+_LAZY_ATTRIBUTES = dict(
+    AssembleShards="sharding",
+    BuildZoneMap="zonemaps",
+    Extract="extraction",
+    ExtractEnsemble="ensemble",
+    ExtractShard="sharding",
+    ExtractTemporalStatistics="statistics",
+    ExtractTimeSeriesStore="timeseries",
+    ExtractVerticalCrossSection="cross_sections",
+    open_sparse="sparse_output",
+    sample_points="sampling",
+    sample_trajectories="sampling",
+    sample_where="sampling",
+)
+
+
+def __getattr__(name):
+    if name not in _LAZY_ATTRIBUTES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    module = importlib.import_module(f".{_LAZY_ATTRIBUTES[name]}", __name__)
+    return getattr(module, name)
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_LAZY_ATTRIBUTES))
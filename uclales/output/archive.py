@@ -0,0 +1,219 @@
+"""
+Reading source blocks directly from an uncompressed tar archive of a run, so
+that archived runs can be extracted without unpacking them first. With
+`source_path` set to the archive (e.g. `rico.tar`) the source blocks are given
+paths inside it (`rico.tar/rico.00000000.nc`), the blocks are found from the
+tar index (members are matched by filename, regardless of the directory they
+were archived from) and block reads go straight to the member's bytes in the
+memory-mapped archive. netCDF4 opens the member from memory and the other
+backends read it as a file-like object, so nothing is copied or extracted to
+disk.
+
+Paths which aren't inside an archive are passed through unchanged by the
+functions here, so they can be used for any source path
+"""
+import functools
+import io
+import mmap
+import os
+import tarfile
+from pathlib import Path
+
+
+def is_archive(path):
+    """
+    Is `path` a tar archive (rather than a directory of source blocks)?
+    """
+    path = Path(path)
+    return path.is_file() and tarfile.is_tarfile(path)
+
+
+@functools.lru_cache(maxsize=1024)
+def _is_archive_cached(path, mtime_ns):
+    return is_archive(path)
+
+
+def split_member_path(path):
+    """
+    `rico.tar/rico.00000000.nc` -> (`rico.tar`, `rico.00000000.nc`), or
+    `None` if `path` isn't inside an archive
+    """
+    path = Path(path)
+    try:
+        st = os.stat(path.parent)
+    except OSError:
+        return None
+    if not _is_archive_cached(str(path.parent), st.st_mtime_ns):
+        return None
+    return path.parent, path.name
+
+
+@functools.lru_cache(maxsize=8)
+def _read_index(archive_path, mtime_ns, size):
+    try:
+        tf = tarfile.open(archive_path, "r:")
+    except tarfile.ReadError as ex:
+        raise Exception(
+            f"`{archive_path}` can't be read as an uncompressed tar archive, the"
+            " source blocks can only be read from uncompressed archives"
+        ) from ex
+    members = {}
+    with tf:
+        for member in tf:
+            if member.isfile():
+                members.setdefault(Path(member.name).name, []).append(member)
+    return members
+
+
+def archive_index(archive_path):
+    """
+    Members of the tar archive at `archive_path` by filename, each a list of
+    the members with that filename (in different directories of the
+    archive). The index is read once per process (and again if the archive
+    changes)
+    """
+    st = os.stat(archive_path)
+    return _read_index(str(Path(archive_path).resolve()), st.st_mtime_ns, st.st_size)
+
+
+def list_files(source_path):
+    """
+    Filenames of the files in `source_path`, a directory or an archive
+    """
+    if is_archive(source_path):
+        return list(archive_index(source_path).keys())
+    return [p.name for p in Path(source_path).iterdir()]
+
+
+def _member(path):
+    archive_path, name = split_member_path(path)
+    members = archive_index(archive_path)
+    if name not in members:
+        raise FileNotFoundError(
+            f"`{name}` wasn't found in the archive `{archive_path}`"
+        )
+    if len(members[name]) > 1:
+        # e.g. a copy of the run in a backup directory, rather than silently
+        # picking one of them
+        paths = ", ".join(m.name for m in members[name])
+        raise Exception(
+            f"There is more than one `{name}` in the archive `{archive_path}`"
+            f" ({paths}), so it isn't clear which to use"
+        )
+    return archive_path, members[name][0]
+
+
+def exists(path):
+    parts = split_member_path(path)
+    if parts is None:
+        return Path(path).exists()
+    archive_path, name = parts
+    return name in archive_index(archive_path)
+
+
+def file_stat(path):
+    """
+    Size and modification time (in ns) of `path`, for a block inside an
+    archive those of the archive member
+    """
+    if split_member_path(path) is None:
+        st = os.stat(path)
+        return st.st_size, st.st_mtime_ns
+    _, member = _member(path)
+    return member.size, int(member.mtime * 1e9)
+
+
+_MMAPS = dict(pid=None, mmaps={})
+
+
+def _archive_mmap(archive_path):
+    """
+    Read-only memory-map of the archive, kept open for the lifetime of the
+    process (forked processes map the archive again)
+    """
+    if _MMAPS["pid"] != os.getpid():
+        _MMAPS.update(pid=os.getpid(), mmaps={})
+    st = os.stat(archive_path)
+    key = (str(Path(archive_path).resolve()), st.st_mtime_ns, st.st_size)
+    if key not in _MMAPS["mmaps"]:
+        with open(archive_path, "rb") as fh:
+            _MMAPS["mmaps"][key] = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    return _MMAPS["mmaps"][key]
+
+
+def member_buffer(path):
+    """
+    Read-only buffer (without copying) of the bytes of the archive member at
+    `path`
+    """
+    archive_path, member = _member(path)
+    mm = _archive_mmap(archive_path)
+    return memoryview(mm)[member.offset_data : member.offset_data + member.size]
+
+
+class _BufferReader(io.RawIOBase):
+    """
+    Seekable file-like object reading from a buffer
+    """
+
+    def __init__(self, buffer):
+        self._buffer = buffer
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        n = max(0, min(len(b), len(self._buffer) - self._pos))
+        b[:n] = self._buffer[self._pos : self._pos + n]
+        self._pos += n
+        return n
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        elif whence == io.SEEK_END:
+            self._pos = len(self._buffer) + offset
+        else:
+            raise ValueError(whence)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+
+def open_file(path):
+    """
+    Open `path` for reading in binary mode
+    """
+    if split_member_path(path) is None:
+        return open(path, "rb")
+    return io.BufferedReader(_BufferReader(member_buffer(path)))
+
+
+def path_or_fileobj(path):
+    """
+    `path` itself, or a file-like object for a block inside an archive (for
+    the backends which can read from file-like objects)
+    """
+    if split_member_path(path) is None:
+        return path
+    return open_file(path)
+
+
+def open_netcdf(path):
+    """
+    Open `path` with netCDF4, a block inside an archive is opened from its
+    bytes in the memory-mapped archive
+    """
+    # imported here so that e.g. `uclales-extract --help` doesn't need netCDF4
+    import netCDF4
+
+    if split_member_path(path) is None:
+        return netCDF4.Dataset(path)
+    return netCDF4.Dataset(str(path), memory=member_buffer(path))
@@ -0,0 +1,388 @@
+"""
+Pluggable I/O backends for reading and writing the block files. Each backend
+can read (parts of) one or more variables into numpy arrays and, where xarray
+supports it, open and write whole datasets:
+
+- `netcdf4`: netCDF4-python (the default)
+- `h5netcdf`: h5netcdf (netCDF4/HDF5 files only)
+- `h5py`: raw HDF5 reads with h5py (netCDF4/HDF5 files only, values are read
+  as stored, i.e. without applying scale-factors and offsets)
+- `scipy`: scipy's netCDF3 reader and writer
+
+The optional backends are only imported when used. The HDF5 chunk-cache used
+by the `netcdf4`, `h5netcdf` and `h5py` backends can be tuned with
+`set_chunk_cache`, and `benchmark_backends` times each available backend on
+the files actually present so that the fastest reader and writer can be
+chosen (see `choose_backends`)
+"""
+import importlib
+import shutil
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from . import archive
+
+# HDF5 chunk-cache settings, `None` leaves the library default
+CHUNK_CACHE = dict(size=None, nelems=None, preemption=None)
+
+
+def set_chunk_cache(size=None, nelems=None, preemption=None):
+    """
+    Set the HDF5 chunk-cache size (in bytes), number of chunk slots and
+    preemption (between 0 and 1) used when opening files
+    """
+    CHUNK_CACHE.update(size=size, nelems=nelems, preemption=preemption)
+
+
+def _h5py_cache_kwargs():
+    kwargs = dict(
+        rdcc_nbytes=CHUNK_CACHE["size"],
+        rdcc_nslots=CHUNK_CACHE["nelems"],
+        rdcc_w0=CHUNK_CACHE["preemption"],
+    )
+    return dict((k, v) for (k, v) in kwargs.items() if v is not None)
+
+
+def _read_orthogonal(getitem, shape, index):
+    """
+    Index a variable with `getitem` (which only needs to support integers and
+    slices) independently along each dimension (as in netCDF4), where
+    `index` may contain integers, slices or sequences of integers. Sequences
+    are read as the smallest covering slice and then picked out in memory
+    """
+    if index is None:
+        index = ()
+    index = tuple(index) + (slice(None),) * (len(shape) - len(index))
+
+    read_index = []
+    picks = []
+    for idx, n in zip(index, shape):
+        if isinstance(idx, slice):
+            read_index.append(idx)
+            picks.append(slice(None))
+        elif np.ndim(idx) == 0:
+            # the dimension is dropped
+            read_index.append(idx)
+            picks.append(None)
+        else:
+            idx = np.asarray(idx, dtype=int)
+            idx = np.where(idx < 0, idx + n, idx)
+            start = int(idx.min()) if len(idx) > 0 else 0
+            stop = int(idx.max()) + 1 if len(idx) > 0 else 0
+            read_index.append(slice(start, stop))
+            picks.append(idx - start)
+
+    values = np.asarray(getitem(tuple(read_index)))
+    axis = 0
+    for pick in picks:
+        if pick is None:
+            continue
+        if isinstance(pick, np.ndarray):
+            values = np.take(values, pick, axis=axis)
+        axis += 1
+    return values
+
+
+class Backend:
+    """
+    An I/O backend `name`, requiring the python module `module` and, if
+    xarray can open and write datasets with it, the xarray `engine`
+    """
+
+    def __init__(self, name, module, engine=None, can_write=False):
+        self.name = name
+        self.module = module
+        self.engine = engine
+        self.can_write = can_write
+
+    def available(self):
+        try:
+            importlib.import_module(self.module)
+        except ImportError:
+            return False
+        return True
+
+    def _open(self, path):
+        """
+        Open `path` for reading, returning a context manager for the file
+        """
+        raise NotImplementedError
+
+    def _read(self, fh, var_name, index):
+        var = fh.variables[var_name]
+        return _read_orthogonal(var.__getitem__, var.shape, index)
+
+    def read_variable(self, path, var_name, index=None):
+        """
+        Read `var_name` from `path`, indexed by `index` independently along
+        each dimension (see `_read_orthogonal`)
+        """
+        return self.read_variables(path, {var_name: index})[var_name]
+
+    def read_variables(self, path, indices):
+        """
+        Read each of the variables in `indices` (variable name -> index, as
+        for `read_variable`) from `path`, opening the file once
+        """
+        with self._open(path) as fh:
+            return dict((v, self._read(fh, v, index)) for (v, index) in indices.items())
+
+    def open_dataset(self, path, **kwargs):
+        if self.engine is None:
+            # e.g. raw h5py is only used for reading arrays
+            return BACKENDS["netcdf4"].open_dataset(path, **kwargs)
+        import xarray as xr
+
+        if archive.split_member_path(path) is not None:
+            # a source block inside a tar archive
+            if self.engine == "netcdf4":
+                store = xr.backends.NetCDF4DataStore(archive.open_netcdf(path))
+                return xr.open_dataset(store, **kwargs)
+            return xr.open_dataset(
+                archive.open_file(path), engine=self.engine, **kwargs
+            )
+        return xr.open_dataset(path, engine=self.engine, **kwargs)
+
+    def write_dataset(self, ds, path):
+        if not self.can_write:
+            raise NotImplementedError(
+                f"The `{self.name}` backend can't be used to write datasets"
+            )
+        ds.to_netcdf(path, engine=self.engine)
+
+    def __repr__(self):
+        return f"Backend({self.name!r})"
+
+
+class NetCDF4Backend(Backend):
+    def __init__(self):
+        super().__init__(
+            name="netcdf4", module="netCDF4", engine="netcdf4", can_write=True
+        )
+
+    def _set_chunk_cache(self):
+        import netCDF4
+
+        if any(v is not None for v in CHUNK_CACHE.values()):
+            size, nelems, preemption = netCDF4.get_chunk_cache()
+            netCDF4.set_chunk_cache(
+                size=CHUNK_CACHE["size"] or size,
+                nelems=CHUNK_CACHE["nelems"] or nelems,
+                preemption=(
+                    preemption
+                    if CHUNK_CACHE["preemption"] is None
+                    else CHUNK_CACHE["preemption"]
+                ),
+            )
+
+    def _open(self, path):
+        self._set_chunk_cache()
+        fh = archive.open_netcdf(path)
+        fh.set_auto_mask(False)
+        return fh
+
+    def _read(self, fh, var_name, index):
+        var = fh.variables[var_name]
+        if index is None:
+            return var[:]
+        return var[tuple(index)]
+
+    def open_dataset(self, path, **kwargs):
+        self._set_chunk_cache()
+        return super().open_dataset(path, **kwargs)
+
+
+class H5NetCDFBackend(Backend):
+    def __init__(self):
+        super().__init__(
+            name="h5netcdf", module="h5netcdf", engine="h5netcdf", can_write=True
+        )
+
+    def _open(self, path):
+        import h5netcdf
+
+        return h5netcdf.File(archive.path_or_fileobj(path), "r", **_h5py_cache_kwargs())
+
+
+class H5PyBackend(Backend):
+    def __init__(self):
+        super().__init__(name="h5py", module="h5py")
+
+    def _open(self, path):
+        import h5py
+
+        return h5py.File(archive.path_or_fileobj(path), "r", **_h5py_cache_kwargs())
+
+    def _read(self, fh, var_name, index):
+        var = fh[var_name]
+        return _read_orthogonal(var.__getitem__, var.shape, index)
+
+
+class ScipyBackend(Backend):
+    def __init__(self):
+        super().__init__(
+            name="scipy", module="scipy.io", engine="scipy", can_write=True
+        )
+
+    def _open(self, path):
+        import scipy.io
+
+        return scipy.io.netcdf_file(archive.path_or_fileobj(path), "r", mmap=False)
+
+
+BACKENDS = dict(
+    (b.name, b)
+    for b in [NetCDF4Backend(), H5NetCDFBackend(), H5PyBackend(), ScipyBackend()]
+)
+
+# the backends currently used for reading and writing
+_CURRENT = dict(reader="netcdf4", writer="netcdf4")
+
+
+def get_backend(name):
+    if name not in BACKENDS:
+        raise NotImplementedError(
+            f"Unknown I/O backend `{name}`, available are: {', '.join(BACKENDS)}"
+        )
+    backend = BACKENDS[name]
+    if not backend.available():
+        raise ImportError(
+            f"The `{name}` I/O backend requires the `{backend.module}` module"
+        )
+    return backend
+
+
+def set_backends(reader=None, writer=None):
+    """
+    Set the backends (by name) used for reading and writing
+    """
+    if reader is not None:
+        get_backend(reader)
+        _CURRENT["reader"] = reader
+    if writer is not None:
+        if not get_backend(writer).can_write:
+            raise NotImplementedError(f"The `{writer}` backend can't write datasets")
+        _CURRENT["writer"] = writer
+
+
+def reader():
+    return get_backend(_CURRENT["reader"])
+
+
+def writer():
+    return get_backend(_CURRENT["writer"])
+
+
+def _time_call(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        t_start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t_start)
+    return statistics.median(times)
+
+
+def _reads_same(backend, path, var_name, expected):
+    values = backend.read_variable(path, var_name)
+    return values.shape == expected.shape and np.allclose(
+        values, expected, equal_nan=True
+    )
+
+
+def benchmark_backends(paths, var_name, tmp_path=None, repeat=3):
+    """
+    Time reading `var_name` from each of `paths` and writing it (to a
+    temporary directory in `tmp_path`, which should be on the filesystem the
+    output will be written to) with each available backend. Backends that
+    fail (e.g. the `scipy` backend on netCDF4 files) or that don't read the
+    same (decoded) values as the `netcdf4` backend (e.g. `h5py` on packed
+    variables) are left out. Returns dicts of backend name -> median time (in
+    seconds) for reading and writing, and for each writer the readers which
+    can read its output
+    """
+    paths = list(paths)
+    expected = BACKENDS["netcdf4"].read_variable(paths[0], var_name)
+    read_times = {}
+    for name, backend in BACKENDS.items():
+        if not backend.available():
+            continue
+        try:
+            if not _reads_same(backend, paths[0], var_name, expected):
+                continue
+            read_times[name] = _time_call(
+                lambda: [backend.read_variable(p, var_name) for p in paths], repeat
+            )
+        except Exception:
+            pass
+
+    write_times = {}
+    readable_by = {}
+    # the times aren't decoded since UCLALES doesn't write CF-valid time units
+    with BACKENDS["netcdf4"].open_dataset(paths[0], decode_times=False) as ds_source:
+        ds = ds_source[[var_name]].load()
+    tmpdir = tempfile.mkdtemp(dir=tmp_path)
+    try:
+        for name, backend in BACKENDS.items():
+            if not backend.available() or not backend.can_write:
+                continue
+            fn_out = Path(tmpdir) / f"benchmark.{name}.nc"
+            try:
+                write_times[name] = _time_call(
+                    lambda: backend.write_dataset(ds, fn_out), repeat
+                )
+            except Exception:
+                continue
+            readable_by[name] = []
+            expected_out = BACKENDS["netcdf4"].read_variable(fn_out, var_name)
+            for reader_name in read_times:
+                try:
+                    if _reads_same(
+                        BACKENDS[reader_name], fn_out, var_name, expected_out
+                    ):
+                        readable_by[name].append(reader_name)
+                except Exception:
+                    pass
+    finally:
+        shutil.rmtree(tmpdir)
+    return read_times, write_times, readable_by
+
+
+def fastest_backends(read_times, write_times, readable_by):
+    """
+    From the benchmark results (see `benchmark_backends`) pick the fastest
+    reader, and the fastest writer whose output that reader can read
+    """
+    fastest_reader = min(read_times, key=read_times.get)
+    compatible_writers = [w for w in write_times if fastest_reader in readable_by[w]]
+    fastest_writer = min(compatible_writers, key=write_times.get)
+    return fastest_reader, fastest_writer
+
+
+def choose_backends(paths, var_name, tmp_path=None, repeat=3):
+    """
+    Benchmark the backends (see `benchmark_backends`) and set the fastest
+    reader and writer as the current backends. Returns the names of the
+    chosen reader and writer
+    """
+    reader_name, writer_name = fastest_backends(
+        *benchmark_backends(
+            paths=paths, var_name=var_name, tmp_path=tmp_path, repeat=repeat
+        )
+    )
+    set_backends(reader=reader_name, writer=writer_name)
+    return reader_name, writer_name
+
+
+def format_benchmark(read_times, write_times):
+    lines = [f"  {'backend':<10} {'read [s]':>9} {'write [s]':>9}"]
+    for name in BACKENDS:
+        if name not in read_times and name not in write_times:
+            continue
+        t_read = f"{read_times[name]:.4f}" if name in read_times else "-"
+        t_write = f"{write_times[name]:.4f}" if name in write_times else "-"
+        lines.append(f"  {name:<10} {t_read:>9} {t_write:>9}")
+    return "\n".join(lines)
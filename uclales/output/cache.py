@@ -0,0 +1,150 @@
+"""
+Content-aware completion checking for extraction tasks. Rather than
+considering a task complete as soon as its output exists, a manifest is stored
+next to each output recording the identity (size and modification time, and
+optionally a fast hash) of all the source blocks that the output was created
+from together with the task parameters. The output is only considered up to
+date if these are unchanged, so that after a model rerun only the affected
+blocks and strips are recomputed
+"""
+import hashlib
+import json
+from pathlib import Path
+
+import luigi
+
+from . import archive
+
+# number of bytes hashed at the start and end of each source file for the
+# "fast hash"
+FAST_HASH_NBYTES = 64 * 1024
+
+
+class cache(luigi.Config):
+    """
+    Configuration for the caching of partials, set in the `[cache]` section
+    of `luigi.cfg`
+    """
+
+    enabled = luigi.BoolParameter(default=True)
+    use_hash = luigi.BoolParameter(default=False)
+
+
+def _fast_hash(path):
+    """
+    Hash of the size, first and last `FAST_HASH_NBYTES` bytes of a file
+    """
+    h = hashlib.sha1()
+    size, _ = archive.file_stat(path)
+    h.update(str(size).encode())
+    with archive.open_file(path) as fh:
+        h.update(fh.read(FAST_HASH_NBYTES))
+        if size > FAST_HASH_NBYTES:
+            fh.seek(max(FAST_HASH_NBYTES, size - FAST_HASH_NBYTES))
+            h.update(fh.read(FAST_HASH_NBYTES))
+    return h.hexdigest()
+
+
+def file_identity(path, use_hash=False):
+    # for source blocks inside a tar archive those of the archive member
+    size, mtime_ns = archive.file_stat(path)
+    identity = dict(size=size, mtime_ns=mtime_ns)
+    if use_hash:
+        identity["hash"] = _fast_hash(path)
+    return identity
+
+
+def manifest_path(output_path):
+    return Path(f"{output_path}.manifest.json")
+
+
+def _find_source_tasks(task, source_task_class, found=None):
+    """
+    Walk the dependency graph of `task` collecting all tasks of class
+    `source_task_class` (i.e. the source blocks)
+    """
+    if found is None:
+        found = {}
+    if isinstance(task, source_task_class):
+        found[task.task_id] = task
+        return found
+    for t in luigi.task.flatten(task.requires()):
+        _find_source_tasks(t, source_task_class, found=found)
+    return found
+
+
+class SourceTrackingMixin:
+    """
+    Mixin for luigi tasks which makes task completion depend on the identity
+    of the source blocks (`source_task_class` tasks) the output was created
+    from and the task parameters, as stored in a manifest next to the output
+    """
+
+    source_task_class = None
+
+    def _source_paths(self):
+        tasks = _find_source_tasks(self, self.source_task_class).values()
+        return sorted(set(str(t.output().path) for t in tasks))
+
+    def _output_paths(self):
+        return [t.path for t in luigi.task.flatten(self.output())]
+
+    def _current_manifest(self):
+        use_hash = cache().use_hash
+        return dict(
+            task_family=self.get_task_family(),
+            params=self.to_str_params(only_significant=True),
+            sources=dict(
+                (p, file_identity(p, use_hash=use_hash)) for p in self._source_paths()
+            ),
+        )
+
+    def is_stale(self):
+        """
+        Returns `True` if any of the outputs exist but don't have a manifest
+        or the manifest doesn't match the current sources and parameters
+        """
+        for path in self._output_paths():
+            fn_manifest = manifest_path(path)
+            if not fn_manifest.exists():
+                return True
+            with open(fn_manifest) as fh:
+                if json.load(fh) != self._current_manifest():
+                    return True
+        return False
+
+    def complete(self):
+        if not super().complete():
+            return False
+        if not cache().enabled:
+            return True
+        return not self.is_stale()
+
+    def write_manifest(self):
+        manifest = self._current_manifest()
+        for path in self._output_paths():
+            with open(manifest_path(path), "w") as fh:
+                json.dump(manifest, fh, indent=2)
+
+    def on_success(self):
+        if cache().enabled:
+            self.write_manifest()
+        return super().on_success()
+
+    def remove_outputs(self):
+        """
+        Remove any existing (stale) outputs and their manifests. The files
+        are unlinked rather than overwritten since they may still be open
+        (and so locked by HDF5) in this process
+        """
+        for path in self._output_paths():
+            for p in [Path(path), manifest_path(path)]:
+                if p.exists():
+                    p.unlink()
+
+
+@luigi.Task.event_handler(luigi.Event.START)
+def _remove_stale_outputs(task):
+    # a task is only run if it is incomplete, so any existing outputs are stale
+    if isinstance(task, SourceTrackingMixin):
+        task.remove_outputs()
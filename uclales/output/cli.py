@@ -0,0 +1,216 @@
+"""
+Lightweight command line interface for extracting variables from UCLALES
+per-core output (installed as `uclales-extract`). Parsing the arguments,
+printing `--help` and planning the extraction (`--dry-run`) only need
+netCDF4. luigi and xarray are only imported once the extraction starts, so
+launching many of these (e.g. in a job array) is cheap
+"""
+import argparse
+import concurrent.futures
+import sys
+
+from .integrity import scan_source_blocks
+from .planner import MODES, format_plans, plan_extraction
+
+
+def _build_parser():
+    parser = argparse.ArgumentParser(
+        prog="uclales-extract",
+        description=(
+            "Extract full-domain 3D fields or 2D cross-sections from UCLALES"
+            " per-core output"
+        ),
+    )
+    parser.add_argument("--kind", choices=["3d", "2d"], required=True)
+    parser.add_argument("--file-prefix", required=True)
+    parser.add_argument(
+        "--var-name", nargs="+", required=True, help="variable(s) to extract"
+    )
+    parser.add_argument(
+        "--tn", nargs="+", type=int, default=[], help="timestep(s) for 3D extraction"
+    )
+    parser.add_argument(
+        "--orientation", default=None, help="orientation of 2D cross-sections"
+    )
+    parser.add_argument("--mode", choices=MODES + ["auto"], default="y_strips")
+    parser.add_argument("--source-path", default=".")
+    parser.add_argument("--dest-path", default=".")
+    parser.add_argument(
+        "--no-cdo", action="store_true", help="don't use cdo even if available"
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="only print the estimated cost of each extraction strategy",
+    )
+    parser.add_argument(
+        "--fan-in",
+        type=int,
+        default=0,
+        help="merge strips in a tree of merges each with at most this many parts",
+    )
+    parser.add_argument(
+        # the layouts of `sparse_output.SPARSE_LAYOUTS`, not imported here
+        # since that needs xarray
+        "--sparse",
+        choices=["coo", "blocks"],
+        default=None,
+        help="only store the nonzero values of the extracted fields",
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help=(
+            "scan the headers of all source blocks for missing, unreadable or"
+            " inconsistent files before extracting"
+        ),
+    )
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--memory-budget", default=None, help="e.g. 16GB")
+    parser.add_argument(
+        "--shard", default=None, help="only extract the K'th of N shards, as `K/N`"
+    )
+    parser.add_argument(
+        "--scheduler-url",
+        default=None,
+        help="URL of central luigi scheduler, the local scheduler is used otherwise",
+    )
+    return parser
+
+
+def _parse_args(argv=None):
+    parser = _build_parser()
+    args = parser.parse_args(argv)
+    if args.kind == "3d" and len(args.tn) == 0:
+        parser.error("At least one timestep (`--tn`) must be given for 3D extraction")
+    if args.kind == "2d" and args.orientation is None:
+        parser.error("The `--orientation` must be given for 2D extraction")
+    if args.shard is not None and args.mode == "auto":
+        parser.error("The extraction mode must be set explicitly with `--shard`")
+    if args.shard is not None and args.sparse is not None:
+        parser.error("Sparse output (`--sparse`) can't be used with `--shard`")
+    return args
+
+
+def _plan(args, var_name):
+    return plan_extraction(
+        source_path=args.source_path,
+        file_prefix=args.file_prefix,
+        var_name=var_name,
+        kind=args.kind,
+        orientation=args.orientation,
+        use_cdo=not args.no_cdo,
+    )
+
+
+def _make_tasks(args, modes):
+    # luigi is only imported once we actually need to extract something
+    from .extraction import Extract
+    from .sharding import ExtractShard
+
+    kws = dict(
+        file_prefix=args.file_prefix,
+        kind=args.kind,
+        source_path=args.source_path,
+        dest_path=args.dest_path,
+        orientation=args.orientation,
+    )
+    tns = args.tn if args.kind == "3d" else [None]
+    if args.shard is not None:
+        return [
+            ExtractShard(
+                var_names=args.var_name,
+                tns=args.tn,
+                mode=args.mode,
+                use_cdo=not args.no_cdo,
+                shard=args.shard,
+                **kws,
+            )
+        ]
+    return [
+        Extract(
+            var_name=var_name,
+            tn=tn,
+            mode=modes[var_name][0],
+            use_cdo=modes[var_name][1],
+            fan_in=args.fan_in,
+            sparse=args.sparse,
+            **kws,
+        )
+        for var_name in args.var_name
+        for tn in tns
+    ]
+
+
+def main(argv=None):
+    args = _parse_args(argv)
+
+    if args.check:
+        report = scan_source_blocks(
+            source_path=args.source_path,
+            file_prefix=args.file_prefix,
+            kind=args.kind,
+            orientation=args.orientation,
+            n_workers=max(args.workers, 1),
+        )
+        print(report)
+        if not report.ok:
+            return 1
+
+    modes = {}
+    for var_name in args.var_name:
+        if args.dry_run or args.mode == "auto":
+            plans, chosen = _plan(args, var_name)
+            modes[var_name] = (chosen.mode, chosen.use_cdo)
+            if args.dry_run:
+                print(f"Estimated cost of extraction strategies for `{var_name}`:")
+                print(format_plans(plans, chosen=chosen))
+                print(f"Chosen strategy: mode={chosen.mode} use_cdo={chosen.use_cdo}")
+        else:
+            modes[var_name] = (args.mode, not args.no_cdo)
+
+    if args.dry_run:
+        return 0
+
+    import luigi
+
+    if args.memory_budget is not None:
+        luigi.configuration.get_config().set("memory", "budget", args.memory_budget)
+
+    tasks = _make_tasks(args, modes=modes)
+    if args.scheduler_url is not None and args.workers > 1:
+        success = _build_in_worker_processes(
+            tasks, n_workers=args.workers, scheduler_url=args.scheduler_url
+        )
+    else:
+        build_kws = dict(workers=args.workers)
+        if args.scheduler_url is not None:
+            build_kws["scheduler_url"] = args.scheduler_url
+        else:
+            build_kws["local_scheduler"] = True
+        success = luigi.build(tasks, **build_kws)
+    return 0 if success else 1
+
+
+def _build(tasks, scheduler_url):
+    import luigi
+
+    return luigi.build(tasks, workers=1, scheduler_url=scheduler_url)
+
+
+def _build_in_worker_processes(tasks, n_workers, scheduler_url):
+    """
+    Run `n_workers` long-lived single-worker processes sharing the central
+    scheduler, rather than one luigi worker forking a process per task, so
+    that each process keeps its pool of open datasets (see
+    `handles.DatasetPool`) across the tasks it runs
+    """
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = [
+            executor.submit(_build, tasks, scheduler_url) for _ in range(n_workers)
+        ]
+        return all(f.result() for f in futures)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,5 +1,83 @@
+import fnmatch
+import functools
+import pprint
+import shutil
+from pathlib import Path
+
 import numpy as np
 
+from . import archive
+
+PARTIALS_3D_PATH = Path("partials/3d")
+PARTIALS_2D_PATH = Path("partials/2d")
+# data stages which are stored in `dest_path` rather than with the partials
+FINAL_DATA_STAGES = [
+    "full_domain",
+    "sparse_full_domain",
+    "vertical_section",
+    "temporal_statistics",
+    "timeseries",
+    "zone_map",
+]
+# data stages computed over all timesteps, i.e. without a timestep `tn`
+ALL_TIMESTEPS_DATA_STAGES = [
+    "block_statistics",
+    "temporal_statistics",
+    "timeseries_intermediate",
+    "timeseries",
+    "zone_map",
+]
+
+SOURCE_BLOCK_FILENAME_FORMAT_3D = "{file_prefix}.{i:04d}{j:04d}.nc"
+SINGLE_VAR_BLOCK_FILENAME_FORMAT_3D = (
+    "{file_prefix}.{i:04d}{j:04d}.{var_name}.tn{tn}.nc"
+)
+SINGLE_VAR_STRIP_FILENAME_FORMAT_3D = (
+    "{file_prefix}.{dim}.{idx:04d}.{var_name}.tn{tn}.nc"
+)
+# strips `start` to `stop - 1` merged together when merging strips in a tree
+SINGLE_VAR_STRIP_GROUP_FILENAME_FORMAT_3D = (
+    "{file_prefix}.{dim}.{start:04d}-{stop:04d}.{var_name}.tn{tn}.nc"
+)
+SINGLE_VAR_FILENAME_FORMAT_3D = "{file_prefix}.{var_name}.tn{tn}.nc"
+# full-domain field with only the nonzero values stored (see `sparse_output`)
+SPARSE_VAR_FILENAME_FORMAT_3D = "{file_prefix}.{var_name}.tn{tn}.sparse-{layout}.nc"
+# vertical cross-section (`xz` or `yz`) at index `idx` in the perpendicular
+# horizontal direction, with the timesteps `tns` (e.g. `0-2`) stacked in time
+SINGLE_VAR_VERTICAL_SECTION_FILENAME_FORMAT_3D = (
+    "{file_prefix}.{orientation}.{idx:04d}.{var_name}.tn{tns}.nc"
+)
+# temporal statistics over all timesteps, `stats_name` describes the
+# variables and covariances included
+STATISTICS_BLOCK_FILENAME_FORMAT_3D = (
+    "{file_prefix}.{i:04d}{j:04d}.{stats_name}.stats.nc"
+)
+STATISTICS_FILENAME_FORMAT_3D = "{file_prefix}.{stats_name}.stats.nc"
+# all timesteps of a variable in a single file chunked for time-series access,
+# the intermediate file is chunked by batches of timesteps while rechunking
+TIMESERIES_INTERMEDIATE_FILENAME_FORMAT_3D = (
+    "{file_prefix}.{var_name}.timeseries.partial.nc"
+)
+TIMESERIES_FILENAME_FORMAT_3D = "{file_prefix}.{var_name}.timeseries.nc"
+# per-block minimum, maximum and nonzero count of `var_names` (joined by `-`)
+ZONE_MAP_FILENAME_FORMAT_3D = "{file_prefix}.{var_names}.zonemap.nc"
+
+# rico_gcss.out.xy.0000.0000.nc
+SOURCE_BLOCK_FILENAME_FORMAT_2D = "{file_prefix}.out.{orientation}.{i:04d}.{j:04d}.nc"
+SINGLE_VAR_BLOCK_FILENAME_FORMAT_2D = (
+    "{file_prefix}.out.{orientation}.{i:04d}.{j:04d}.{var_name}.nc"
+)
+SINGLE_VAR_STRIP_FILENAME_FORMAT_2D = (
+    "{file_prefix}.out.{orientation}.{dim}.{idx:04d}.{var_name}.nc"
+)
+SINGLE_VAR_STRIP_GROUP_FILENAME_FORMAT_2D = (
+    "{file_prefix}.out.{orientation}.{dim}.{start:04d}-{stop:04d}.{var_name}.nc"
+)
+SINGLE_VAR_FILENAME_FORMAT_2D = "{file_prefix}.out.{orientation}.{var_name}.nc"
+SPARSE_VAR_FILENAME_FORMAT_2D = (
+    "{file_prefix}.out.{orientation}.{var_name}.sparse-{layout}.nc"
+)
+
 
 def _fix_time_units(da):
     modified = False
@@ -40,3 +118,133 @@ def _fix_time_units(da):
     else:
         raise NotImplementedError(da.attrs["units"])
     return da, modified
+
+
+def _build_filename(data_stage, data_kind, **kwargs):
+    if data_kind == "3d":
+        if (
+            kwargs.get("tn") is None
+            and data_stage
+            not in ["source_block", "vertical_section"] + ALL_TIMESTEPS_DATA_STAGES
+        ):
+            raise Exception("`tn` must be given for 3D output")
+
+        if data_stage == "source_block":
+            filename_format = SOURCE_BLOCK_FILENAME_FORMAT_3D
+        elif data_stage == "block_variable":
+            filename_format = SINGLE_VAR_BLOCK_FILENAME_FORMAT_3D
+        elif data_stage == "strip_variable":
+            filename_format = SINGLE_VAR_STRIP_FILENAME_FORMAT_3D
+        elif data_stage == "strip_group_variable":
+            filename_format = SINGLE_VAR_STRIP_GROUP_FILENAME_FORMAT_3D
+        elif data_stage == "full_domain":
+            filename_format = SINGLE_VAR_FILENAME_FORMAT_3D
+        elif data_stage == "dense_intermediate":
+            # the full-domain field stored with the partials, from which the
+            # sparse output is made
+            filename_format = SINGLE_VAR_FILENAME_FORMAT_3D
+        elif data_stage == "sparse_full_domain":
+            filename_format = SPARSE_VAR_FILENAME_FORMAT_3D
+        elif data_stage == "vertical_section":
+            filename_format = SINGLE_VAR_VERTICAL_SECTION_FILENAME_FORMAT_3D
+        elif data_stage == "block_statistics":
+            filename_format = STATISTICS_BLOCK_FILENAME_FORMAT_3D
+        elif data_stage == "temporal_statistics":
+            filename_format = STATISTICS_FILENAME_FORMAT_3D
+        elif data_stage == "timeseries_intermediate":
+            filename_format = TIMESERIES_INTERMEDIATE_FILENAME_FORMAT_3D
+        elif data_stage == "timeseries":
+            filename_format = TIMESERIES_FILENAME_FORMAT_3D
+        elif data_stage == "zone_map":
+            filename_format = ZONE_MAP_FILENAME_FORMAT_3D
+        else:
+            raise NotImplementedError(data_stage)
+    elif data_kind == "2d":
+        if kwargs.get("orientation") is None:
+            raise Exception("`orientation` must be given for 2D output")
+        if data_stage == "source_block":
+            filename_format = SOURCE_BLOCK_FILENAME_FORMAT_2D
+        elif data_stage == "block_variable":
+            filename_format = SINGLE_VAR_BLOCK_FILENAME_FORMAT_2D
+        elif data_stage == "strip_variable":
+            filename_format = SINGLE_VAR_STRIP_FILENAME_FORMAT_2D
+        elif data_stage == "strip_group_variable":
+            filename_format = SINGLE_VAR_STRIP_GROUP_FILENAME_FORMAT_2D
+        elif data_stage == "full_domain":
+            filename_format = SINGLE_VAR_FILENAME_FORMAT_2D
+        elif data_stage == "dense_intermediate":
+            # the full-domain field stored with the partials, from which the
+            # sparse output is made
+            filename_format = SINGLE_VAR_FILENAME_FORMAT_2D
+        elif data_stage == "sparse_full_domain":
+            filename_format = SPARSE_VAR_FILENAME_FORMAT_2D
+        else:
+            raise NotImplementedError(data_stage)
+    else:
+        raise NotImplementedError(data_kind)
+
+    try:
+        return filename_format.format(**kwargs)
+    except KeyError as e:
+        raise Exception(
+            f"The {e} parameter is missing for {data_kind} of {data_stage}, "
+            f"the provided parameters are: {pprint.pformat(kwargs)}"
+        )
+
+
+def _build_path(data_stage, data_kind, source_path=None, **kwargs):
+    fn = _build_filename(data_stage=data_stage, data_kind=data_kind, **kwargs)
+
+    if data_stage == "source_block":
+        assert source_path is not None
+        path = source_path
+    else:
+        path = Path(kwargs.get("dest_path", "."))
+        if data_stage not in FINAL_DATA_STAGES:
+            if data_kind == "3d":
+                path = path / PARTIALS_3D_PATH
+            elif data_kind == "2d":
+                path = path / PARTIALS_2D_PATH
+            else:
+                raise NotImplementedError(data_kind)
+
+    return Path(path) / fn
+
+
+@functools.lru_cache(maxsize=64)
+def _list_source_files(source_path, mtime_ns):
+    # `source_path` may also be a tar archive of the source blocks
+    return archive.list_files(source_path)
+
+
+def _find_number_of_blocks(source_path, file_prefix, kind, orientation=None):
+    kwargs = dict(
+        file_prefix=file_prefix,
+        data_stage="source_block",
+        data_kind=kind,
+        orientation=orientation,
+    )
+
+    x_filename_pattern = _build_filename(i=9999, j=0, **kwargs).replace("9999", "????")
+    y_filename_pattern = _build_filename(j=9999, i=0, **kwargs).replace("9999", "????")
+
+    # the listing is reused (within a process) until `source_path` changes,
+    # since the blocks are looked up by every task working on them
+    filenames = _list_source_files(
+        str(source_path), Path(source_path).stat().st_mtime_ns
+    )
+    nx = len(fnmatch.filter(filenames, x_filename_pattern))
+    ny = len(fnmatch.filter(filenames, y_filename_pattern))
+
+    if nx == 0 or ny == 0:
+        raise Exception(
+            f"Didn't find any source files in `{source_path}` "
+            f"(nx={nx} and ny={ny} found). Tried `{x_filename_pattern}` "
+            f"and `{y_filename_pattern}` patterns"
+        )
+
+    return nx, ny
+
+
+def _cdo_available():
+    return shutil.which("cdo") is not None
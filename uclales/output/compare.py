@@ -0,0 +1,341 @@
+"""
+Chunked comparison of two simulations' output (e.g. before and after a change
+to the model code or compiler flags), either of two extracted full-domain
+files or of two trees of per-core block files. The fields are streamed one
+chunk (a band of rows of an extracted file, or a block) and timestep at a
+time in parallel worker processes, so neither output has to fit in memory.
+The maximum and RMS difference is reported per variable, timestep and level,
+together with the horizontal location of the largest difference, and the
+comparison can stop as soon as a tolerance is exceeded. Installed as the
+`uclales-compare` command
+"""
+import argparse
+import concurrent.futures
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from . import archive, backends
+from .layout import BlockLayout, _dim_kind
+
+# approximate number of values compared at a time when comparing extracted
+# files (a band of rows of a single timestep)
+CHUNK_NITEMS = 2**22
+
+REPORT_COLUMNS = [
+    "var_name",
+    "tn",
+    "k",
+    "max_abs_diff",
+    "rms_diff",
+    "worst_i",
+    "worst_j",
+]
+
+
+def _var_dims(path, var_name):
+    with archive.open_netcdf(path) as fh:
+        if var_name not in fh.variables:
+            raise KeyError(
+                f"The variable `{var_name}` wasn't found in `{path}`, the following"
+                f" variables are available: {', '.join(fh.variables.keys())}"
+            )
+        var = fh.variables[var_name]
+        return var.dimensions, var.shape
+
+
+def _horizontal_var_names(path):
+    """
+    Names of the variables in `path` which vary in both horizontal directions
+    """
+    with archive.open_netcdf(path) as fh:
+        return [
+            name
+            for (name, var) in fh.variables.items()
+            if {"x", "y"}.issubset(_dim_kind(d) for d in var.dimensions)
+        ]
+
+
+def _compare_chunk(chunk):
+    """
+    Compare `var_name` between the files `path_a` and `path_b` for the part
+    given by `index` (dim name -> index), with the chunk starting at
+    (`i_offset`, `j_offset`) in the full domain. Returns for each timestep
+    (local to the chunk) and level the maximum absolute difference, the sum of
+    squared differences, the number of values and the full-domain (i, j)
+    index of the maximum difference
+    """
+    path_a, path_b, var_name, index, i_offset, j_offset = chunk
+    dims, _ = _var_dims(path_a, var_name)
+    local_index = tuple(index.get(d, slice(None)) for d in dims)
+
+    values_a = backends.reader().read_variable(path_a, var_name, index=local_index)
+    values_b = backends.reader().read_variable(path_b, var_name, index=local_index)
+    if values_a.shape != values_b.shape:
+        raise Exception(
+            f"The shape of `{var_name}` differs: {values_a.shape} in `{path_a}`"
+            f" and {values_b.shape} in `{path_b}`"
+        )
+    diff = np.abs(values_a.astype(np.float64) - values_b.astype(np.float64))
+    # values missing in both are considered equal, values missing in only one
+    # of them as infinitely different
+    both_nan = np.isnan(values_a) & np.isnan(values_b)
+    diff = np.where(both_nan, 0.0, np.where(np.isnan(diff), np.inf, diff))
+
+    # reorder to (time, level, y, x), adding a single level for 2D fields
+    kinds = [_dim_kind(d) for d in dims]
+    for kind in ["time", "z"]:
+        if kind not in kinds:
+            diff = diff[..., np.newaxis]
+            kinds.append(kind)
+    diff = diff.transpose([kinds.index(k) for k in ["time", "z", "y", "x"]])
+    nt, nz, ny, nx = diff.shape
+
+    flat = diff.reshape(nt, nz, ny * nx)
+    worst = np.argmax(flat, axis=-1)
+    worst_j, worst_i = np.unravel_index(worst, (ny, nx))
+    return dict(
+        max_abs_diff=np.take_along_axis(flat, worst[..., np.newaxis], axis=-1)[..., 0],
+        sum_sq_diff=np.sum(np.where(np.isinf(flat), 0.0, flat) ** 2, axis=-1),
+        n_values=ny * nx,
+        worst_i=worst_i + i_offset,
+        worst_j=worst_j + j_offset,
+    )
+
+
+def _file_chunks(path_a, path_b, var_names):
+    for var_name in var_names:
+        dims, shape = _var_dims(path_a, var_name)
+        sizes = dict(zip(dims, shape))
+        y_dim = [d for d in dims if _dim_kind(d) == "y"][0]
+        n_row = np.prod([n for (d, n) in sizes.items() if d not in ["time", y_dim]])
+        chunk_ny = max(1, CHUNK_NITEMS // int(n_row))
+        for tn in range(sizes.get("time", 1)):
+            for j_start in range(0, sizes[y_dim], chunk_ny):
+                index = {
+                    "time": slice(tn, tn + 1),
+                    y_dim: slice(j_start, j_start + chunk_ny),
+                }
+                yield (var_name, tn), (path_a, path_b, var_name, index, 0, j_start)
+
+
+def _block_chunks(layout_a, layout_b, var_names):
+    for var_name in var_names:
+        dims, shape = _var_dims(layout_a.block_path(0, 0), var_name)
+        nt = dict(zip(dims, shape)).get("time", 1)
+        for tn in range(nt):
+            for i in range(layout_a.nx_b):
+                for j in range(layout_a.ny_b):
+                    yield (var_name, tn), (
+                        layout_a.block_path(i, j),
+                        layout_b.block_path(i, j),
+                        var_name,
+                        dict(time=slice(tn, tn + 1)),
+                        i * layout_a.block_nx,
+                        j * layout_a.block_ny,
+                    )
+
+
+def _run_chunks(chunks, tolerance=None, stop_early=True, n_workers=4):
+    """
+    Compare the `chunks` (an iterable of (key, chunk) pairs) in `n_workers`
+    worker processes and combine the results by key. Once a difference larger
+    than `tolerance` has been found no further chunks are started if
+    `stop_early` is set. Returns the combined results and whether the
+    tolerance was exceeded
+    """
+    chunks = iter(chunks)
+    combined = {}
+    exceeded = False
+
+    def _combine(key, result):
+        if key not in combined:
+            combined[key] = result
+            return
+        current = combined[key]
+        worse = result["max_abs_diff"] > current["max_abs_diff"]
+        for field in ["max_abs_diff", "worst_i", "worst_j"]:
+            current[field] = np.where(worse, result[field], current[field])
+        current["sum_sq_diff"] = current["sum_sq_diff"] + result["sum_sq_diff"]
+        current["n_values"] += result["n_values"]
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as executor:
+        pending = {}
+
+        def _fill():
+            # only a few chunks are queued per worker so that we can stop early
+            while len(pending) < 2 * n_workers:
+                try:
+                    key, chunk = next(chunks)
+                except StopIteration:
+                    return
+                pending[executor.submit(_compare_chunk, chunk)] = key
+
+        _fill()
+        while len(pending) > 0:
+            done, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                key = pending.pop(future)
+                result = future.result()
+                _combine(key, result)
+                if tolerance is not None and np.any(result["max_abs_diff"] > tolerance):
+                    exceeded = True
+            if exceeded and stop_early:
+                for future in pending:
+                    future.cancel()
+                break
+            _fill()
+
+    return combined, exceeded
+
+
+def _build_report(combined, exceeded):
+    rows = []
+    for (var_name, tn), result in sorted(combined.items()):
+        for k in range(len(result["max_abs_diff"][0])):
+            # the chunks cover a single timestep each
+            rows.append(
+                dict(
+                    var_name=var_name,
+                    tn=tn,
+                    k=k,
+                    max_abs_diff=result["max_abs_diff"][0][k],
+                    rms_diff=np.sqrt(result["sum_sq_diff"][0][k] / result["n_values"]),
+                    worst_i=int(result["worst_i"][0][k]),
+                    worst_j=int(result["worst_j"][0][k]),
+                )
+            )
+    report = pd.DataFrame(rows, columns=REPORT_COLUMNS)
+    report.attrs["tolerance_exceeded"] = exceeded
+    return report
+
+
+def compare_files(
+    path_a, path_b, var_names=None, tolerance=None, stop_early=True, n_workers=4
+):
+    """
+    Compare the extracted full-domain files `path_a` and `path_b` (all
+    horizontally varying variables by default), streaming through each
+    timestep in bands of rows. Returns a `pd.DataFrame` with the maximum and
+    RMS difference for each variable, timestep `tn` and level `k` (0 for 2D
+    fields) and the full-domain index (`worst_i`, `worst_j`) of the largest
+    difference. If `tolerance` is exceeded `report.attrs["tolerance_exceeded"]`
+    is set and, with `stop_early`, only the chunks compared so far are
+    included
+    """
+    if var_names is None:
+        var_names = _horizontal_var_names(path_a)
+    combined, exceeded = _run_chunks(
+        _file_chunks(path_a, path_b, var_names),
+        tolerance=tolerance,
+        stop_early=stop_early,
+        n_workers=n_workers,
+    )
+    return _build_report(combined, exceeded)
+
+
+def compare_blocks(
+    source_path_a,
+    source_path_b,
+    file_prefix,
+    var_names=None,
+    kind="3d",
+    orientation=None,
+    tolerance=None,
+    stop_early=True,
+    n_workers=4,
+):
+    """
+    Compare two trees of per-core block files (in `source_path_a` and
+    `source_path_b`, both with filename prefix `file_prefix`) block by block
+    and timestep by timestep. The report is the same as for `compare_files`
+    """
+    layout_a, layout_b = [
+        BlockLayout(
+            source_path=source_path,
+            file_prefix=file_prefix,
+            kind=kind,
+            orientation=orientation,
+        )
+        for source_path in [source_path_a, source_path_b]
+    ]
+    shape_a = (layout_a.nx_b, layout_a.ny_b, layout_a.block_nx, layout_a.block_ny)
+    shape_b = (layout_b.nx_b, layout_b.ny_b, layout_b.block_nx, layout_b.block_ny)
+    if shape_a != shape_b:
+        raise Exception(
+            "The block layouts differ (nx_b, ny_b, block_nx, block_ny):"
+            f" {shape_a} in `{source_path_a}` and {shape_b} in `{source_path_b}`"
+        )
+    if var_names is None:
+        var_names = _horizontal_var_names(layout_a.block_path(0, 0))
+    combined, exceeded = _run_chunks(
+        _block_chunks(layout_a, layout_b, var_names),
+        tolerance=tolerance,
+        stop_early=stop_early,
+        n_workers=n_workers,
+    )
+    return _build_report(combined, exceeded)
+
+
+def _build_parser():
+    parser = argparse.ArgumentParser(
+        prog="uclales-compare",
+        description=(
+            "Compare two extracted files, or two directories of UCLALES per-core"
+            " output, reporting the max and RMS differences"
+        ),
+    )
+    parser.add_argument("path_a")
+    parser.add_argument("path_b")
+    parser.add_argument("--var-name", nargs="+", default=None)
+    parser.add_argument(
+        "--file-prefix", default=None, help="required when comparing directories"
+    )
+    parser.add_argument("--kind", choices=["3d", "2d"], default="3d")
+    parser.add_argument("--orientation", default=None)
+    parser.add_argument("--tolerance", type=float, default=None)
+    parser.add_argument(
+        "--no-stop-early",
+        action="store_true",
+        help="compare everything even once the tolerance has been exceeded",
+    )
+    parser.add_argument("--workers", type=int, default=4)
+    return parser
+
+
+def main(argv=None):
+    parser = _build_parser()
+    args = parser.parse_args(argv)
+    kws = dict(
+        var_names=args.var_name,
+        tolerance=args.tolerance,
+        stop_early=not args.no_stop_early,
+        n_workers=args.workers,
+    )
+    if Path(args.path_a).is_dir():
+        if args.file_prefix is None:
+            parser.error("The `--file-prefix` must be given to compare directories")
+        report = compare_blocks(
+            args.path_a,
+            args.path_b,
+            file_prefix=args.file_prefix,
+            kind=args.kind,
+            orientation=args.orientation,
+            **kws,
+        )
+    else:
+        report = compare_files(args.path_a, args.path_b, **kws)
+
+    print(report.to_string(index=False))
+    if report.attrs["tolerance_exceeded"]:
+        print(f"The difference exceeds the tolerance of {args.tolerance}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
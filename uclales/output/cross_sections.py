@@ -0,0 +1,213 @@
+"""
+luigi-based extraction of vertical (`xz` or `yz`) cross-sections directly from
+the per-core 3D output blocks. Only the row (or column) of blocks that each
+cross-section passes through is opened, and only the one-index-thick slab of
+the variable is read from each block
+"""
+from pathlib import Path
+
+import luigi
+import numpy as np
+import xarray as xr
+
+from . import archive, backends
+from .common import _build_path
+from .common import _fix_time_units as fix_time_units
+from .extraction import UCLALESOutputBlock, XArrayTarget, _configure_io
+from .layout import BlockLayout, _dim_kind
+from .planner import block_variable_nbytes
+from .scheduling import MemoryBudgetMixin
+
+# for each orientation the horizontal direction perpendicular to the
+# cross-section
+PERPENDICULAR_DIM = dict(xz="y", yz="x")
+
+
+class ExtractVerticalCrossSection(MemoryBudgetMixin, luigi.Task):
+    """
+    Extract vertical cross-sections (`orientation` either `xz` or `yz`) of
+    `var_name` at timesteps `tns` for each of the horizontal `positions`
+    (given in the same units as the grid, i.e. metres) perpendicular to the
+    cross-section. Each position is snapped to the nearest grid point (positions
+    snapping to the same grid point are extracted once) and all positions and
+    timesteps are extracted in one pass over the blocks. The timesteps are
+    stacked in time into one file per position.
+
+    {file_prefix}.{i:04d}{j:04d}.nc -> {file_prefix}.{orientation}.{idx:04d}.{var_name}.tn{tns}.nc
+    rico.00000001.nc, ... -> rico.xz.0040.w.tn2-4.nc
+    for var w at timesteps 2, 3 and 4 at y-index 40
+    """
+
+    file_prefix = luigi.Parameter()
+    var_name = luigi.Parameter()
+    orientation = luigi.Parameter()
+    positions = luigi.ListParameter()
+    tns = luigi.ListParameter()
+    source_path = luigi.Parameter(default=".")
+    dest_path = luigi.OptionalParameter(default=".")
+
+    def _layout(self):
+        if getattr(self, "_block_layout", None) is None:
+            self._block_layout = BlockLayout(
+                source_path=self.source_path, file_prefix=self.file_prefix, kind="3d"
+            )
+        return self._block_layout
+
+    def _tns(self):
+        return sorted(set(int(tn) for tn in self.tns))
+
+    def _dims(self):
+        """
+        Dimensions of `var_name` as ordered in the source files, and the
+        dimension perpendicular to the cross-section (e.g. `yt` or `ym` for
+        an `xz` cross-section)
+        """
+        if self.orientation not in PERPENDICULAR_DIM:
+            raise NotImplementedError(self.orientation)
+        perp = PERPENDICULAR_DIM[self.orientation]
+
+        with archive.open_netcdf(self._layout().block_path(0, 0)) as fh:
+            dims = fh.variables[self.var_name].dimensions
+        perp_dim = [d for d in dims if _dim_kind(d) == perp][0]
+        return dims, perp_dim
+
+    def _position_indices(self):
+        """
+        Unique grid indices (in the full domain) of the `positions`. The
+        horizontal grid is uniform so the first block's coordinates are enough
+        to work these out
+        """
+        if getattr(self, "_indices", None) is not None:
+            return self._indices
+
+        _, perp_dim = self._dims()
+        with archive.open_netcdf(self._layout().block_path(0, 0)) as fh:
+            coord = fh.variables[perp_dim][:2]
+        n = getattr(self._layout(), f"n{_dim_kind(perp_dim)}")
+
+        indices = []
+        for pos in self.positions:
+            idx = int(np.round((pos - coord[0]) / (coord[1] - coord[0])))
+            if not 0 <= idx < n:
+                raise Exception(
+                    f"The position {pos} is outside the domain along `{perp_dim}`"
+                )
+            indices.append(idx)
+        self._indices = list(dict.fromkeys(indices))
+        return self._indices
+
+    def estimate_peak_memory(self):
+        layout = self._layout()
+        block_nbytes, _ = block_variable_nbytes(
+            source_path=self.source_path,
+            file_prefix=self.file_prefix,
+            var_name=self.var_name,
+            kind="3d",
+        )
+        # one slab through a row (or column) of blocks per position and
+        # timestep, held both as read and when written out
+        if PERPENDICULAR_DIM[self.orientation] == "y":
+            slab_nbytes = layout.nx_b * block_nbytes // layout.block_ny
+        else:
+            slab_nbytes = layout.ny_b * block_nbytes // layout.block_nx
+        return 2 * len(self._position_indices()) * len(self._tns()) * slab_nbytes
+
+    def requires(self):
+        layout = self._layout()
+        perp = PERPENDICULAR_DIM[self.orientation]
+        block_indices = sorted(
+            set(b for (b, _, _) in layout.split_index(perp, self._position_indices()))
+        )
+        if perp == "y":
+            blocks = [(i, j) for j in block_indices for i in range(layout.nx_b)]
+        else:
+            blocks = [(i, j) for i in block_indices for j in range(layout.ny_b)]
+
+        return [
+            UCLALESOutputBlock(
+                file_prefix=self.file_prefix,
+                i=i,
+                j=j,
+                source_path=self.source_path,
+                kind="3d",
+            )
+            for (i, j) in blocks
+        ]
+
+    def run(self):
+        _configure_io(self)
+        layout = self._layout()
+        dims, perp_dim = self._dims()
+        perp = _dim_kind(perp_dim)
+        indices = self._position_indices()
+        tns = self._tns()
+
+        # all positions and timesteps are read in one pass over the blocks
+        data = layout.read(self.var_name, **{perp: indices, "time": tns})
+
+        with archive.open_netcdf(layout.block_path(0, 0)) as fh:
+            var = fh.variables[self.var_name]
+            # netCDF-internal attributes (e.g. `_FillValue`) are set on write
+            attrs = dict(
+                (k, var.getncattr(k)) for k in var.ncattrs() if not k.startswith("_")
+            )
+            da_time = xr.DataArray(
+                fh.variables["time"][tns],
+                dims=("time",),
+                attrs=dict(units=fh.variables["time"].units),
+            )
+            coords = {}
+            for d in dims:
+                if d == "time" or d == perp_dim:
+                    continue
+                elif _dim_kind(d) in ["x", "y"]:
+                    coords[d] = layout.read(d, **{_dim_kind(d): slice(None)})
+                else:
+                    coords[d] = fh.variables[d][:]
+        perp_coord = layout.read(perp_dim, **{perp: indices})
+
+        section_dims = [d for d in dims if d != perp_dim]
+        for n_pos, idx in enumerate(indices):
+            da = xr.DataArray(
+                np.take(data, n_pos, axis=dims.index(perp_dim)),
+                dims=section_dims,
+                coords=dict(coords, time=da_time),
+                attrs=attrs,
+                name=self.var_name,
+            )
+            da.coords[perp_dim] = perp_coord[n_pos]
+            ds = da.to_dataset()
+            ds["time"], _ = fix_time_units(ds["time"])
+            ds = xr.decode_cf(ds)
+
+            target = self._output_target(idx=idx)
+            Path(target.path).parent.mkdir(exist_ok=True, parents=True)
+            backends.writer().write_dataset(ds, target.path)
+
+    def _tns_label(self):
+        """
+        Timesteps in the output filenames, e.g. `2-4` for timesteps 2, 3 and
+        4 or `0_5` for timesteps 0 and 5
+        """
+        tns = self._tns()
+        if len(tns) == 1:
+            return str(tns[0])
+        elif tns == list(range(tns[0], tns[-1] + 1)):
+            return f"{tns[0]}-{tns[-1]}"
+        return "_".join(str(tn) for tn in tns)
+
+    def _output_target(self, idx):
+        p = _build_path(
+            file_prefix=self.file_prefix,
+            data_stage="vertical_section",
+            data_kind="3d",
+            orientation=self.orientation,
+            idx=idx,
+            var_name=self.var_name,
+            tns=self._tns_label(),
+            dest_path=self.dest_path,
+        )
+        return XArrayTarget(str(p))
+
+    def output(self):
+        return [self._output_target(idx=idx) for idx in self._position_indices()]
@@ -0,0 +1,153 @@
+"""
+Derived fields which need horizontal derivatives, computed one block at a
+time rather than from the stitched full domain. Each block is read together
+with a one-cell halo from the neighbouring block (wrapping around periodically
+at the domain edges) and derivatives are taken with centred differences on the
+staggered grid, so that the derivative of a field on the cell centres (`xt`,
+`yt`) lies on the cell faces (`xm`, `ym`) and vice versa. The available
+fields are
+
+- `ddx_{var}` and `ddy_{var}`: horizontal derivatives of any variable `var`
+- `vorticity_z`: vertical vorticity `dv/dx - du/dy` (on `xm`, `ym`)
+- `divergence_h`: horizontal divergence `du/dx + dv/dy` (on `xt`, `yt`)
+
+These can be extracted (and stitched) through `Extract` like any other
+variable
+"""
+import re
+
+import numpy as np
+
+from . import archive
+from .layout import BlockLayout, _dim_kind
+
+DERIVATIVE_FIELDS = dict(
+    vorticity_z=(("v", "x"), ("u", "y")),
+    divergence_h=(("u", "x"), ("v", "y")),
+)
+
+
+def _parse_gradient(var_name):
+    m = re.match(r"^dd(x|y)_(.+)$", var_name)
+    if m is None:
+        return None
+    dim, source_var_name = m.groups()
+    return source_var_name, dim
+
+
+def is_derivative_field(var_name):
+    return var_name in DERIVATIVE_FIELDS or _parse_gradient(var_name) is not None
+
+
+def source_var_names(var_name):
+    """
+    The source variables the derivative field `var_name` is computed from
+    """
+    if var_name in DERIVATIVE_FIELDS:
+        return [v for (v, _) in DERIVATIVE_FIELDS[var_name]]
+    return [_parse_gradient(var_name)[0]]
+
+
+def _halo_index(layout, kind, b, offset):
+    """
+    Full-domain indices along `kind` (`x` or `y`) of block `b` extended by a
+    one-cell halo before (`offset=-1`) or after (`offset=1`) the block,
+    wrapping around periodically at the edges of the domain
+    """
+    block_n = getattr(layout, f"block_n{kind}")
+    n = getattr(layout, f"n{kind}")
+    if offset == 1:
+        idx = np.arange(b * block_n, (b + 1) * block_n + 1)
+    else:
+        idx = np.arange(b * block_n - 1, (b + 1) * block_n)
+    return idx % n
+
+
+def staggered_derivative(layout, var_name, i, j, tn, kind):
+    """
+    Derivative along `kind` (`x` or `y`) of `var_name` at timestep `tn` in
+    block (`i`, `j`). Fields on the cell centres (e.g. `xt`) are
+    differentiated onto the cell faces (`xm`) using the halo after the block
+    and fields on the faces onto the centres using the halo before it.
+    Returns a `xr.DataArray` with the time coordinate as stored in the
+    source files (i.e. not decoded)
+    """
+    # imported here so that e.g. `uclales-extract --help` doesn't need xarray
+    import xarray as xr
+
+    fn_block = layout.block_path(i, j)
+    with archive.open_netcdf(fn_block) as fh:
+        if var_name not in fh.variables:
+            raise KeyError(
+                f"The variable `{var_name}` wasn't found, the following"
+                f" variables are available: {', '.join(fh.variables.keys())}"
+            )
+        var = fh.variables[var_name]
+        dims = var.dimensions
+        units = getattr(var, "units", None)
+        dim = [d for d in dims if _dim_kind(d) == kind][0]
+        # `xt` -> `xm` and vice versa
+        out_dim = kind + ("m" if dim.endswith("t") else "t")
+        offset = 1 if dim.endswith("t") else -1
+        coords = dict(
+            (d, np.asarray(fh.variables[d][:]))
+            for d in dims
+            if d not in ["time", dim] and d in fh.variables
+        )
+        coords[out_dim] = np.asarray(fh.variables[out_dim][:])
+        spacing = float(coords[out_dim][1] - coords[out_dim][0])
+        da_time = xr.DataArray(
+            fh.variables["time"][[int(tn)]],
+            dims=("time",),
+            attrs=dict(units=fh.variables["time"].units),
+        )
+
+    b = dict(x=i, y=j)[kind]
+    isel = dict(time=[int(tn)])
+    isel[kind] = _halo_index(layout, kind, b, offset=offset)
+    other = "y" if kind == "x" else "x"
+    block_n = getattr(layout, f"block_n{other}")
+    b_other = dict(x=i, y=j)[other]
+    isel[other] = slice(b_other * block_n, (b_other + 1) * block_n)
+
+    values = layout.read(var_name, **isel).astype(np.float64)
+    axis = dims.index(dim)
+    derivative = np.diff(values, axis=axis) / spacing
+
+    out_dims = [out_dim if d == dim else d for d in dims]
+    da = xr.DataArray(
+        derivative,
+        dims=out_dims,
+        coords=dict(coords, time=da_time),
+        name=f"dd{kind}_{var_name}",
+        attrs=dict(long_name=f"d{var_name}/d{kind}"),
+    )
+    if units is not None:
+        da.attrs["units"] = f"{units}/m"
+    return da
+
+
+def block_derivative_field(source_path, file_prefix, var_name, i, j, tn):
+    """
+    Compute the derivative field `var_name` (see `DERIVATIVE_FIELDS`) at
+    timestep `tn` in block (`i`, `j`) of the 3D output
+    """
+    layout = BlockLayout(source_path=source_path, file_prefix=file_prefix, kind="3d")
+    if var_name in DERIVATIVE_FIELDS:
+        (v_a, kind_a), (v_b, kind_b) = DERIVATIVE_FIELDS[var_name]
+        da_a = staggered_derivative(layout, v_a, i=i, j=j, tn=tn, kind=kind_a)
+        da_b = staggered_derivative(layout, v_b, i=i, j=j, tn=tn, kind=kind_b)
+        da_b = da_b.transpose(*da_a.dims)
+        if var_name == "vorticity_z":
+            da = da_a - da_b
+            long_name = "vertical vorticity"
+        else:
+            da = da_a + da_b
+            long_name = "horizontal divergence"
+        da.attrs.update(units="1/s", long_name=long_name)
+        da["time"].attrs.update(da_a["time"].attrs)
+    else:
+        source_var_name, kind = _parse_gradient(var_name)
+        da = staggered_derivative(layout, source_var_name, i=i, j=j, tn=tn, kind=kind)
+    da.name = var_name
+    return da
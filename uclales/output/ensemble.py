@@ -0,0 +1,236 @@
+"""
+Extraction across an ensemble of simulations in a single luigi run, so that
+the block work of all members is scheduled together (and shared out over the
+same workers) rather than launching a separate extraction per member,
+variable and timestep. Members with the same decomposition into blocks (the
+number of blocks and the block shape) share the planning of the extraction
+strategy, which is done once for the first member of each group.
+
+The output of each member is stored in `{dest_path}/{member name}/` with the
+usual filenames, and can optionally be combined along a `member` dimension
+into `{dest_path}/{ensemble name}.{var_name}.tn{tn}.nc`
+"""
+import collections
+import logging
+from pathlib import Path
+
+import luigi
+import xarray as xr
+
+from . import archive, backends
+from .common import _build_path, _find_number_of_blocks
+from .extraction import Extract, XArrayTarget
+from .planner import plan_extraction
+from .scheduling import MemoryBudgetMixin
+
+logger = logging.getLogger(__name__)
+
+
+def _member_specs(members, file_prefix):
+    """
+    Normalise the `members` given to `ExtractEnsemble` into a list of dicts
+    with `name`, `file_prefix` and `source_path`
+    """
+    specs = []
+    for member in members:
+        if isinstance(member, str):
+            member = dict(source_path=member)
+        else:
+            member = dict(member)
+        if "source_path" not in member:
+            raise ValueError(f"No `source_path` given for ensemble member {member}")
+        member.setdefault("file_prefix", file_prefix)
+        if member["file_prefix"] is None:
+            raise ValueError(
+                f"No `file_prefix` given for ensemble member {member} (and no"
+                " default `file_prefix` set)"
+            )
+        member.setdefault("name", Path(member["source_path"]).name)
+        specs.append(member)
+
+    names = [m["name"] for m in specs]
+    duplicates = [n for (n, c) in collections.Counter(names).items() if c > 1]
+    if len(duplicates) > 0:
+        raise ValueError(
+            f"The ensemble member names {duplicates} aren't unique, set a"
+            " `name` for each member"
+        )
+    return specs
+
+
+def _decomposition(member, kind, orientation):
+    """
+    Number of blocks and the shape of a block for `member`, members with the
+    same decomposition have the same extraction costs
+    """
+    nx_b, ny_b = _find_number_of_blocks(
+        source_path=member["source_path"],
+        file_prefix=member["file_prefix"],
+        kind=kind,
+        orientation=orientation,
+    )
+    fn_block = _build_path(
+        file_prefix=member["file_prefix"],
+        data_stage="source_block",
+        data_kind=kind,
+        orientation=orientation,
+        i=0,
+        j=0,
+        source_path=member["source_path"],
+    )
+    with archive.open_netcdf(fn_block) as fh:
+        shape = tuple(
+            sorted((d, fh.dimensions[d].size) for d in fh.dimensions if d != "time")
+        )
+    return nx_b, ny_b, shape
+
+
+class ExtractEnsemble(MemoryBudgetMixin, luigi.Task):
+    """
+    Extract all `var_names` at all timesteps `tns` (for 2D extraction this
+    should be left empty) for every member of an ensemble. `members` is a
+    list of members, each given either by its `source_path` or as a dict with
+    `source_path` and optionally `file_prefix` (defaults to `file_prefix`)
+    and `name` (defaults to the last part of `source_path`). With `mode="auto"`
+    the extraction strategy is planned once for each group of members with
+    the same decomposition. With `member_dim` set the members are also
+    combined along a `member` dimension (the coordinates, including time,
+    are taken from the first member)
+    """
+
+    members = luigi.ListParameter()
+    var_names = luigi.ListParameter()
+    tns = luigi.ListParameter(default=[])
+    file_prefix = luigi.OptionalParameter(default=None)
+    ensemble_name = luigi.Parameter(default="ensemble")
+    kind = luigi.Parameter()
+    mode = luigi.Parameter(default="y_strips")
+    dest_path = luigi.OptionalParameter(default=".")
+    orientation = luigi.OptionalParameter(default=None)
+    use_cdo = luigi.BoolParameter(default=True)
+    member_dim = luigi.BoolParameter(default=False)
+
+    def _members(self):
+        return _member_specs(self.members, file_prefix=self.file_prefix)
+
+    def _tns(self):
+        return list(self.tns) if len(self.tns) > 0 else [None]
+
+    def _planned_modes(self):
+        """
+        Extraction mode and whether to use cdo for each member and variable,
+        for `mode="auto"` planned once per group of members with the same
+        decomposition. The plan is kept with the task, since luigi asks for
+        the requirements of a task repeatedly
+        """
+        if getattr(self, "_modes", None) is None:
+            self._modes = self._plan_modes()
+        return self._modes
+
+    def _plan_modes(self):
+        members = self._members()
+        if self.mode != "auto":
+            return dict(
+                ((m["name"], v), (self.mode, self.use_cdo))
+                for m in members
+                for v in self.var_names
+            )
+
+        groups = collections.defaultdict(list)
+        for member in members:
+            key = _decomposition(member, kind=self.kind, orientation=self.orientation)
+            groups[key].append(member)
+
+        modes = {}
+        for group in groups.values():
+            for var_name in self.var_names:
+                _, plan = plan_extraction(
+                    source_path=group[0]["source_path"],
+                    file_prefix=group[0]["file_prefix"],
+                    var_name=var_name,
+                    kind=self.kind,
+                    orientation=self.orientation,
+                    use_cdo=self.use_cdo,
+                )
+                for member in group:
+                    modes[(member["name"], var_name)] = (plan.mode, plan.use_cdo)
+        logger.info(
+            f"Planned the extraction for {len(members)} ensemble members in"
+            f" {len(groups)} group(s) with the same decomposition"
+        )
+        return modes
+
+    def _member_dest_path(self, member):
+        return str(Path(self.dest_path) / member["name"])
+
+    def member_tasks(self):
+        """
+        The extraction tasks by (member name, variable, timestep)
+        """
+        modes = self._planned_modes()
+        tasks = {}
+        for member in self._members():
+            for var_name in self.var_names:
+                mode, use_cdo = modes[(member["name"], var_name)]
+                for tn in self._tns():
+                    tasks[(member["name"], var_name, tn)] = Extract(
+                        file_prefix=member["file_prefix"],
+                        var_name=var_name,
+                        tn=tn,
+                        kind=self.kind,
+                        mode=mode,
+                        source_path=member["source_path"],
+                        dest_path=self._member_dest_path(member),
+                        orientation=self.orientation,
+                        use_cdo=use_cdo,
+                    )
+        return tasks
+
+    def requires(self):
+        return list(self.member_tasks().values())
+
+    def run(self):
+        if not self.member_dim:
+            return
+        tasks = self.member_tasks()
+        names = [m["name"] for m in self._members()]
+        for (var_name, tn), target in self._combined_outputs().items():
+            da_members = [tasks[(name, var_name, tn)].output().open() for name in names]
+            da = xr.concat(
+                da_members,
+                dim="member",
+                coords="minimal",
+                compat="override",
+                join="override",
+            )
+            da["member"] = ("member", names)
+            Path(target.path).parent.mkdir(exist_ok=True, parents=True)
+            backends.writer().write_dataset(da, target.path)
+
+    def _combined_outputs(self):
+        outputs = {}
+        for var_name in self.var_names:
+            for tn in self._tns():
+                p = _build_path(
+                    file_prefix=self.ensemble_name,
+                    data_stage="full_domain",
+                    data_kind=self.kind,
+                    orientation=self.orientation,
+                    var_name=var_name,
+                    tn=tn,
+                    dest_path=self.dest_path,
+                )
+                outputs[(var_name, tn)] = XArrayTarget(str(p))
+        return outputs
+
+    def complete(self):
+        if not all(task.complete() for task in self.requires()):
+            return False
+        if self.member_dim:
+            return all(t.exists() for t in self._combined_outputs().values())
+        return True
+
+    def output(self):
+        if self.member_dim:
+            return list(self._combined_outputs().values())
+        return [task.output() for task in self.requires()]
@@ -6,8 +6,12 @@ luigi-based pipeline for extracting either:
 
 from per-core column output from the UCLALES model
 """
+import fcntl
 import functools
-import pprint
+import itertools
+import json
+import logging
+import os
 import signal
 import subprocess
 from pathlib import Path
@@ -15,32 +19,162 @@ from pathlib import Path
 import luigi
 import xarray as xr
 
+from . import archive, backends
+from .cache import SourceTrackingMixin
+from .common import _build_path, _cdo_available, _find_number_of_blocks
 from .common import _fix_time_units as fix_time_units
-
-PARTIALS_3D_PATH = Path("partials/3d")
-PARTIALS_2D_PATH = Path("partials/2d")
-
-SOURCE_BLOCK_FILENAME_FORMAT_3D = "{file_prefix}.{i:04d}{j:04d}.nc"
-SINGLE_VAR_BLOCK_FILENAME_FORMAT_3D = (
-    "{file_prefix}.{i:04d}{j:04d}.{var_name}.tn{tn}.nc"
-)
-SINGLE_VAR_STRIP_FILENAME_FORMAT_3D = (
-    "{file_prefix}.{dim}.{idx:04d}.{var_name}.tn{tn}.nc"
-)
-SINGLE_VAR_FILENAME_FORMAT_3D = "{file_prefix}.{var_name}.tn{tn}.nc"
-
-# rico_gcss.out.xy.0000.0000.nc
-SOURCE_BLOCK_FILENAME_FORMAT_2D = "{file_prefix}.out.{orientation}.{i:04d}.{j:04d}.nc"
-SINGLE_VAR_BLOCK_FILENAME_FORMAT_2D = (
-    "{file_prefix}.out.{orientation}.{i:04d}.{j:04d}.{var_name}.nc"
+from .derivatives import block_derivative_field, is_derivative_field
+from .handles import DEFAULT_POOL_SIZE, dataset_pool
+from .partials import (
+    NpyPartialTarget,
+    decode_partial,
+    partials,
+    write_block_partial,
+    write_partial,
 )
-SINGLE_VAR_STRIP_FILENAME_FORMAT_2D = (
-    "{file_prefix}.out.{orientation}.{dim}.{idx:04d}.{var_name}.nc"
+from .pipeline import PrefetchingReader
+from .planner import (
+    block_variable_nbytes,
+    estimate_stage_memory,
+    format_plans,
+    plan_extraction,
 )
-SINGLE_VAR_FILENAME_FORMAT_2D = "{file_prefix}.out.{orientation}.{var_name}.nc"
+from .reductions import block_column_reduction, is_column_reduction
+from .scheduling import MemoryBudgetMixin
+from .sparse_output import SPARSE_LAYOUTS, open_sparse, to_sparse_dataset
 
 STORE_PARTIALS_LOCALLY = False
 
+logger = logging.getLogger(__name__)
+
+
+class io(luigi.Config):
+    """
+    I/O backends (see `backends`) used for reading and writing, set in the
+    `[io]` section of `luigi.cfg`. With `auto` the fastest backends for the
+    source files present are chosen by a micro-benchmark (run once and
+    stored in `dest_path`). The HDF5 chunk-cache can be tuned with the `chunk_cache_*`
+    settings and `handle_pool_size` sets how many opened files each worker
+    keeps open for reuse (see `handles.DatasetPool`, 0 disables this)
+    """
+
+    reader = luigi.Parameter(default="netcdf4")
+    writer = luigi.Parameter(default="netcdf4")
+    chunk_cache_size = luigi.OptionalIntParameter(default=None)
+    chunk_cache_nelems = luigi.OptionalIntParameter(default=None)
+    chunk_cache_preemption = luigi.OptionalFloatParameter(default=None)
+    handle_pool_size = luigi.IntParameter(default=DEFAULT_POOL_SIZE)
+
+
+# number of points along `y` of the dense field read at a time when making
+# the sparse output
+SPARSE_SLAB_SIZE = 256
+# the backends chosen by benchmarking, kept in `dest_path` so that the
+# benchmark is only run once rather than in every worker process
+IO_BENCHMARK_PATH = Path("partials/io_backends.json")
+
+
+def _run_benchmark(source_path, file_prefix, var_name, kind, orientation, dest_path):
+    nx_b, ny_b = _find_number_of_blocks(
+        source_path=source_path,
+        file_prefix=file_prefix,
+        kind=kind,
+        orientation=orientation,
+    )
+    # a few of the blocks is enough to time the backends
+    paths = [
+        _build_path(
+            file_prefix=file_prefix,
+            data_stage="source_block",
+            data_kind=kind,
+            orientation=orientation,
+            i=i,
+            j=j,
+            source_path=source_path,
+        )
+        for (i, j) in itertools.islice(itertools.product(range(nx_b), range(ny_b)), 4)
+    ]
+    # the writers are timed on the filesystem the output is written to
+    read_times, write_times, readable_by = backends.benchmark_backends(
+        paths=paths, var_name=var_name, tmp_path=dest_path
+    )
+    print("Benchmark of I/O backends:")
+    print(backends.format_benchmark(read_times, write_times))
+    return backends.fastest_backends(read_times, write_times, readable_by)
+
+
+@functools.lru_cache(maxsize=None)
+def _benchmark_backends(
+    source_path, file_prefix, var_name, kind, orientation, dest_path
+):
+    """
+    The fastest reader and writer for the source files, benchmarked once and
+    stored in `dest_path` (keyed by the source files and their modification
+    time). A lock is held while benchmarking so that concurrent worker
+    processes wait for the result rather than all benchmarking
+    """
+    path = Path(dest_path) / IO_BENCHMARK_PATH
+    path.parent.mkdir(exist_ok=True, parents=True)
+    key = f"{source_path}:{file_prefix}:{kind}:{orientation}:{var_name}"
+    mtime_ns = os.stat(source_path).st_mtime_ns
+
+    with open(f"{path}.lock", "w") as fh_lock:
+        fcntl.flock(fh_lock, fcntl.LOCK_EX)
+        choices = {}
+        if path.exists():
+            with open(path) as fh:
+                choices = json.load(fh)
+        choice = choices.get(key)
+        if choice is not None and choice["mtime_ns"] == mtime_ns:
+            return choice["reader"], choice["writer"]
+
+        reader, writer = _run_benchmark(
+            source_path=source_path,
+            file_prefix=file_prefix,
+            var_name=var_name,
+            kind=kind,
+            orientation=orientation,
+            dest_path=dest_path,
+        )
+        choices[key] = dict(mtime_ns=mtime_ns, reader=reader, writer=writer)
+        path_tmp = path.with_suffix(".tmp")
+        with open(path_tmp, "w") as fh:
+            json.dump(choices, fh, indent=2)
+        os.replace(path_tmp, path)
+    return reader, writer
+
+
+def _configure_io(task):
+    """
+    Set the I/O backends and chunk-cache from the `[io]` configuration,
+    benchmarking the backends on the source files of `task` if requested
+    """
+    config = io()
+    backends.set_chunk_cache(
+        size=config.chunk_cache_size,
+        nelems=config.chunk_cache_nelems,
+        preemption=config.chunk_cache_preemption,
+    )
+    dataset_pool().resize(config.handle_pool_size)
+    reader, writer = config.reader, config.writer
+    if "auto" in [reader, writer]:
+        # tasks working only on the 3D output (e.g. vertical cross-sections)
+        # have no `kind`
+        kind = getattr(task, "kind", "3d")
+        fastest_reader, fastest_writer = _benchmark_backends(
+            source_path=str(task.source_path),
+            file_prefix=task.file_prefix,
+            var_name=task.var_name,
+            kind=kind,
+            orientation=task.orientation if kind == "2d" else None,
+            dest_path=str(task.dest_path),
+        )
+        if reader == "auto":
+            reader = fastest_reader
+        if writer == "auto":
+            writer = fastest_writer
+    backends.set_backends(reader=reader, writer=writer)
+
 
 class XArrayTarget(luigi.target.FileSystemTarget):
     fs = luigi.local_target.LocalFileSystem()
@@ -49,9 +183,29 @@ class XArrayTarget(luigi.target.FileSystemTarget):
         super(XArrayTarget, self).__init__(path, *args, **kwargs)
         self.path = path
 
-    def open(self, *args, **kwargs):
-        # ds = xr.open_dataset(self.path, engine='h5netcdf', *args, **kwargs)
-        ds = xr.open_dataset(self.path, *args, **kwargs)
+    def exists(self):
+        # source blocks may be inside a tar archive
+        return archive.exists(self.path)
+
+    def _open_dataset(self, **kwargs):
+        """
+        Open the dataset through the per-process pool of open datasets, a
+        shallow copy is returned so that changes to it aren't shared
+        """
+        reader = backends.reader()
+        ds = dataset_pool().get(
+            self.path,
+            open_fn=lambda path: self._open_uncached(path, reader, **kwargs),
+            tag=(type(self).__name__, reader.name, tuple(sorted(kwargs.items()))),
+        )
+        return ds.copy(deep=False)
+
+    @staticmethod
+    def _open_uncached(path, reader, **kwargs):
+        return reader.open_dataset(path, **kwargs)
+
+    def open(self, **kwargs):
+        ds = self._open_dataset(**kwargs)
 
         if len(ds.data_vars) == 1:
             name = list(ds.data_vars)[0]
@@ -106,97 +260,172 @@ def _cdo_has_command(cmd):
 
 
 class XArrayTargetUCLALES(XArrayTarget):
-    def open(self, *args, **kwargs):
-        kwargs["decode_times"] = False
-        da = super().open(*args, **kwargs)
-        da["time"], _ = fix_time_units(da["time"])
-        if hasattr(da, "to_dataset"):
-            return xr.decode_cf(da.to_dataset())
-        else:
-            return xr.decode_cf(da)
-
-
-def _build_filename(data_stage, data_kind, **kwargs):
-    if data_kind == "3d":
-        if kwargs.get("tn") is None and data_stage != "source_block":
-            raise Exception("`tn` must be given for 3D output")
-
-        if data_stage == "source_block":
-            filename_format = SOURCE_BLOCK_FILENAME_FORMAT_3D
-        elif data_stage == "block_variable":
-            filename_format = SINGLE_VAR_BLOCK_FILENAME_FORMAT_3D
-        elif data_stage == "strip_variable":
-            filename_format = SINGLE_VAR_STRIP_FILENAME_FORMAT_3D
-        elif data_stage == "full_domain":
-            filename_format = SINGLE_VAR_FILENAME_FORMAT_3D
-        else:
-            raise NotImplementedError(data_stage)
-    elif data_kind == "2d":
-        if kwargs.get("orientation") is None:
-            raise Exception("`orientation` must be given for 2D output")
-        if data_stage == "source_block":
-            filename_format = SOURCE_BLOCK_FILENAME_FORMAT_2D
-        elif data_stage == "block_variable":
-            filename_format = SINGLE_VAR_BLOCK_FILENAME_FORMAT_2D
-        elif data_stage == "strip_variable":
-            filename_format = SINGLE_VAR_STRIP_FILENAME_FORMAT_2D
-        elif data_stage == "full_domain":
-            filename_format = SINGLE_VAR_FILENAME_FORMAT_2D
-        else:
-            raise NotImplementedError(data_stage)
-    else:
-        raise NotImplementedError(data_kind)
+    """
+    Source block with the time units fixed and decoded, the decoded dataset
+    is kept in the pool of open datasets so that repeatedly opening the same
+    block in a worker doesn't decode it again
+    """
 
-    try:
-        return filename_format.format(**kwargs)
-    except KeyError as e:
-        raise Exception(
-            f"The {e} parameter is missing for {data_kind} of {data_stage}, "
-            f"the provided parameters are: {pprint.pformat(kwargs)}"
-        )
+    @staticmethod
+    def _open_uncached(path, reader, **kwargs):
+        ds = reader.open_dataset(path, decode_times=False, **kwargs)
+        ds["time"], _ = fix_time_units(ds["time"])
+        return xr.decode_cf(ds)
 
+    def open(self, **kwargs):
+        return self._open_dataset(**kwargs)
 
-def _build_path(data_stage, data_kind, source_path=None, **kwargs):
-    fn = _build_filename(data_stage=data_stage, data_kind=data_kind, **kwargs)
 
-    if data_stage == "source_block":
-        assert source_path is not None
-        path = source_path
-    else:
-        path = Path(kwargs.get("dest_path", "."))
-        if data_stage != "full_domain":
-            if data_kind == "3d":
-                path = path / PARTIALS_3D_PATH
-            elif data_kind == "2d":
-                path = path / PARTIALS_2D_PATH
-            else:
-                raise NotImplementedError(data_kind)
+class XArrayTargetSparse(XArrayTarget):
+    """
+    Field stored with only its nonzero values (see `sparse_output`), opened
+    as a dense `xr.DataArray` (or wrapping a `sparse.COO` array with
+    `as_sparse=True`)
+    """
 
-    return Path(path) / fn
+    def open(self, as_sparse=False):
+        return open_sparse(self.path, as_sparse=as_sparse)
 
 
-def _find_number_of_blocks(source_path, file_prefix, kind, orientation=None):
-    kwargs = dict(
-        file_prefix=file_prefix,
-        data_stage="source_block",
-        data_kind=kind,
-        orientation=orientation,
+def _open_and_load(target):
+    if isinstance(target, NpyPartialTarget):
+        # kept memory-mapped, the values are only read when merged
+        return target.open()
+    return target.open().load()
+
+
+def _load_inputs(targets):
+    """
+    Open and load `targets` into memory with the reads done by background
+    workers ahead of consumption (see `pipeline.PrefetchingReader`), returns
+    an (ordered) dict of target -> loaded data
+    """
+    reader = PrefetchingReader(read_fn=_open_and_load, items=targets)
+    opened_inputs = dict(reader)
+    logger.debug(reader.metrics)
+    logger.debug(dataset_pool())
+    return opened_inputs
+
+
+def _estimate_task_memory(task, stage, n_blocks):
+    """
+    Estimated peak memory use of `task` at extraction `stage` working on
+    `n_blocks` blocks worth of data (see `planner.estimate_stage_memory`)
+    """
+    block_nbytes, nz = block_variable_nbytes(
+        source_path=task.source_path,
+        file_prefix=task.file_prefix,
+        var_name=task.var_name,
+        kind=task.kind,
+        orientation=task.orientation,
+    )
+    return estimate_stage_memory(
+        stage, use_cdo=task.use_cdo, n_blocks=n_blocks, block_nbytes=block_nbytes, nz=nz
     )
 
-    x_filename_pattern = _build_filename(i=9999, j=0, **kwargs).replace("9999", "????")
-    y_filename_pattern = _build_filename(j=9999, i=0, **kwargs).replace("9999", "????")
 
-    nx = len(list(Path(source_path).glob(x_filename_pattern)))
-    ny = len(list(Path(source_path).glob(y_filename_pattern)))
+def _partials_format(task):
+    """
+    Storage format for the partials of `task`, cdo can only work with netCDF
+    files and the per-block lifting condensation level (`lcl`) is given a
+    horizontal position when extracted so is always stored as netCDF
+    """
+    if task.use_cdo or task.var_name == "lcl":
+        return "netcdf"
+    return partials().format
 
-    if nx == 0 or ny == 0:
-        raise Exception(
-            f"Didn't find any source files in `{source_path}` "
-            f"(nx={nx} and ny={ny} found). Tried `{x_filename_pattern}` "
-            f"and `{y_filename_pattern}` patterns"
+
+def _partial_target(task, path):
+    if _partials_format(task) == "npy":
+        return NpyPartialTarget(str(Path(path).with_suffix(".npy")))
+    return XArrayTargetUCLALES(str(path))
+
+
+def _concat_strips(datasets, dim):
+    """
+    Concatenate strips along `dim` (`x` or `y`)
+    """
+    datasets = list(datasets)
+    # when extracting by strips we need to use `xr.concat` instead of
+    # `xr.merge`, and so we need to know which dimension to concatenate
+    # along
+    concat_dim = None
+    da_first = datasets[0]
+    for d in da_first.dims:
+        if d.startswith(dim):
+            concat_dim = d
+            break
+
+    # couldn't find dim to concat along
+    if concat_dim is None:
+        raise NotImplementedError(da_first.dims)
+    return xr.concat(datasets, dim=concat_dim)
+
+
+def _cdo_merge_strips(input_paths, output_path, dim):
+    """
+    Merge strips along `dim` with cdo
+    """
+    if _cdo_has_command("gather"):
+        cdo_command = "gather"
+    else:
+        cdo_command = "collgrid"
+
+    # if we're concatenating in the y-direction we need to tell cdo to
+    # add an extra dimension for x
+    if dim == "y":
+        cdo_command += ",1"
+
+    Path(output_path).parent.mkdir(exist_ok=True, parents=True)
+    _call_cdo([cdo_command] + list(input_paths) + [output_path])
+
+
+def _strip_merge_parts(task, start, stop):
+    """
+    Tasks for merging strips `start` to `stop - 1` along `task.dim`. With
+    `task.fan_in` set the strips are merged in a tree of merge tasks each
+    merging at most `fan_in` parts, e.g. for `fan_in=8` strips 0-7, 8-15 and
+    so on are merged first, then groups of these and so on, so that all but
+    the final merge runs in parallel
+    """
+    n = stop - start
+    # number of strips merged in each part, a power of `fan_in`
+    size = 1
+    if task.fan_in > 1:
+        while -(-n // size) > task.fan_in:
+            size *= task.fan_in
+
+    kws = dict(
+        file_prefix=task.file_prefix,
+        dim=task.dim,
+        tn=task.tn,
+        kind=task.kind,
+        orientation=task.orientation,
+        var_name=task.var_name,
+        source_path=task.source_path,
+        dest_path=task.dest_path,
+        use_cdo=task.use_cdo,
+    )
+    if size == 1:
+        return [UCLALESStripSelectVariable(idx=i, **kws) for i in range(start, stop)]
+    return [
+        UCLALESStripGroupMerge(
+            start=part_start,
+            stop=min(part_start + size, stop),
+            fan_in=task.fan_in,
+            **kws,
         )
+        for part_start in range(start, stop, size)
+    ]
+
 
-    return nx, ny
+def _n_strips(task):
+    """
+    Number of strips produced by a part of the strip merge
+    """
+    if isinstance(task, UCLALESStripGroupMerge):
+        return task.stop - task.start
+    return 1
 
 
 class UCLALESOutputBlock(luigi.ExternalTask):
@@ -224,13 +453,13 @@ class UCLALESOutputBlock(luigi.ExternalTask):
             dest_path=self.dest_path,
         )
 
-        if not p.exists():
+        if not archive.exists(p):
             raise Exception(f"Missing input file `{p.name}` for `{self.file_prefix}`")
 
         return XArrayTargetUCLALES(str(p))
 
 
-class UCLALESBlockSelectVariable(luigi.Task):
+class UCLALESBlockSelectVariable(MemoryBudgetMixin, SourceTrackingMixin, luigi.Task):
     """
     Extracts a single variable at a single timestep from one 3D output block
 
@@ -257,16 +486,65 @@ class UCLALESBlockSelectVariable(luigi.Task):
 
     use_cdo = luigi.BoolParameter(default=True)
 
-    def requires(self):
+    source_task_class = UCLALESOutputBlock
+
+    def _source_block(self, i, j):
         return UCLALESOutputBlock(
             file_prefix=self.file_prefix,
-            i=self.i,
-            j=self.j,
+            i=i,
+            j=j,
             source_path=self.source_path,
             kind=self.kind,
             orientation=self.orientation,
         )
 
+    def requires(self):
+        if is_derivative_field(self.var_name):
+            # derivative fields also read a halo from the neighbouring blocks
+            nx_b, ny_b = _find_number_of_blocks(
+                file_prefix=self.file_prefix,
+                source_path=self.source_path,
+                kind=self.kind,
+                orientation=self.orientation,
+            )
+            neighbours = [(0, 0), (-1, 0), (1, 0), (0, -1), (0, 1)]
+            blocks = dict.fromkeys(
+                ((self.i + di) % nx_b, (self.j + dj) % ny_b) for (di, dj) in neighbours
+            )
+            return [self._source_block(i=i, j=j) for (i, j) in blocks]
+        return self._source_block(i=self.i, j=self.j)
+
+    def estimate_peak_memory(self):
+        return _estimate_task_memory(self, stage="block", n_blocks=1)
+
+    def _run_derived_field(self):
+        if self.kind != "3d":
+            raise NotImplementedError(
+                "Derivative fields and column reductions can only be computed"
+                " from 3D output"
+            )
+        if is_derivative_field(self.var_name):
+            da = block_derivative_field(
+                source_path=self.source_path,
+                file_prefix=self.file_prefix,
+                var_name=self.var_name,
+                i=self.i,
+                j=self.j,
+                tn=int(self.tn),
+            )
+        else:
+            da = block_column_reduction(
+                fn_block=self._source_block(i=self.i, j=self.j).output().path,
+                var_name=self.var_name,
+                tn=int(self.tn),
+            )
+        if isinstance(self.output(), NpyPartialTarget):
+            write_partial(self.output().path, da)
+            return
+        da = decode_partial(da)
+        Path(self.output().path).parent.mkdir(exist_ok=True, parents=True)
+        backends.writer().write_dataset(da, self.output().path)
+
     def _run_xarray(self):
         ds_block = self.input().open()
         try:
@@ -294,15 +572,32 @@ class UCLALESBlockSelectVariable(luigi.Task):
             raise NotImplementedError(self.kind)
 
         Path(self.output().path).parent.mkdir(exist_ok=True, parents=True)
-        da_block_var.to_netcdf(self.output().path)
+        backends.writer().write_dataset(da_block_var, self.output().path)
 
     def run(self):
-        if self.use_cdo:
+        _configure_io(self)
+        if is_derivative_field(self.var_name) or is_column_reduction(self.var_name):
+            # computed without cdo, the partial is still written as netCDF
+            # when cdo is used to merge the blocks
+            self._run_derived_field()
+        elif self.use_cdo:
             self._run_cdo()
+        elif _partials_format(self) == "npy":
+            write_block_partial(
+                self.output().path,
+                fn_block=self.input().path,
+                var_name=self.var_name,
+                tn=self.tn if self.kind == "3d" else None,
+            )
         else:
             self._run_xarray()
 
     def _run_cdo(self):
+        if archive.is_archive(self.source_path):
+            raise Exception(
+                "cdo can't read source blocks inside a tar archive, extract"
+                " without cdo (`use_cdo=False`) instead"
+            )
         Path(self.output().path).parent.mkdir(exist_ok=True, parents=True)
         args = []
         if self.kind == "3d":
@@ -336,10 +631,10 @@ class UCLALESBlockSelectVariable(luigi.Task):
             dest_path=self.dest_path,
         )
 
-        return XArrayTargetUCLALES(str(p))
+        return _partial_target(self, p)
 
 
-class UCLALESStripSelectVariable(luigi.Task):
+class UCLALESStripSelectVariable(MemoryBudgetMixin, SourceTrackingMixin, luigi.Task):
     """
     Extracts a single variable at a single timestep as a strip of blocks along
     the `dim` dimension at index `idx` in the perpendicular dimension
@@ -367,6 +662,8 @@ class UCLALESStripSelectVariable(luigi.Task):
 
     use_cdo = luigi.BoolParameter(default=True)
 
+    source_task_class = UCLALESOutputBlock
+
     def requires(self):
         nx_b, ny_b = _find_number_of_blocks(
             file_prefix=self.file_prefix,
@@ -399,20 +696,27 @@ class UCLALESStripSelectVariable(luigi.Task):
             for n in range(nidx)
         ]
 
+    def estimate_peak_memory(self):
+        return _estimate_task_memory(self, stage="strip", n_blocks=len(self.requires()))
+
     def _run_xarray(self):
         ortho_dim = "x" if self.dim == "y" else "y"
 
-        dataarrays = [inp.open() for inp in self.input()]
+        dataarrays = list(_load_inputs(self.input()).values())
         # x -> `xt` or `xm` mapping, similar for other dims
         da = dataarrays[0]
         dims = dict([(d.replace("t", "").replace("m", ""), d) for d in da.dims])
 
         ds_strip = xr.concat(dataarrays, dim=dims[ortho_dim])
         da_strip_var = ds_strip[self.var_name]
+        if isinstance(self.output(), NpyPartialTarget):
+            write_partial(self.output().path, da_strip_var)
+            return
         Path(self.output().path).parent.mkdir(exist_ok=True, parents=True)
-        da_strip_var.to_netcdf(self.output().path)
+        backends.writer().write_dataset(da_strip_var, self.output().path)
 
     def run(self):
+        _configure_io(self)
         if self.use_cdo:
             if _cdo_has_command("gather"):
                 cdo_command = "gather"
@@ -446,15 +750,97 @@ class UCLALESStripSelectVariable(luigi.Task):
             dest_path=self.dest_path,
         )
 
-        return XArrayTargetUCLALES(str(p))
+        return _partial_target(self, p)
 
 
-class _Merge3DBaseTask(luigi.Task):
+class UCLALESStripGroupMerge(MemoryBudgetMixin, SourceTrackingMixin, luigi.Task):
+    """
+    Merges strips `start` to `stop - 1` along `dim` for a single variable at a
+    single timestep, as part of the tree-reduction merge of strips (see
+    `ExtractByStrips` with `fan_in`)
+
+    3D:
+    {file_prefix}.{dim}.{idx:04d}.{var_name}.tn{tn}.nc -> {file_prefix}.{dim}.{start:04d}-{stop:04d}.{var_name}.tn{tn}.nc
+    rico_gcss.x.0000.q.tn4.nc, ..., rico_gcss.x.0007.q.tn4.nc -> rico_gcss.x.0000-0008.q.tn4.nc
+    for var q and timestep 4
+    """
+
+    file_prefix = luigi.Parameter()
+    source_path = luigi.Parameter()
+    var_name = luigi.Parameter()
+    dim = luigi.Parameter()
+    start = luigi.IntParameter()
+    stop = luigi.IntParameter()
+    fan_in = luigi.IntParameter()
+    tn = luigi.OptionalParameter(default=None)
+    kind = luigi.Parameter()
+    orientation = luigi.OptionalParameter(default=None)
+    dest_path = luigi.OptionalParameter(default=".")
+
+    use_cdo = luigi.BoolParameter(default=True)
+
+    source_task_class = UCLALESOutputBlock
+
+    def requires(self):
+        return _strip_merge_parts(self, self.start, self.stop)
+
+    def estimate_peak_memory(self):
+        nx_b, ny_b = _find_number_of_blocks(
+            file_prefix=self.file_prefix,
+            source_path=self.source_path,
+            kind=self.kind,
+            orientation=self.orientation,
+        )
+        n_blocks_per_strip = ny_b if self.dim == "x" else nx_b
+        return _estimate_task_memory(
+            self,
+            stage="merge_strips",
+            n_blocks=(self.stop - self.start) * n_blocks_per_strip,
+        )
+
+    def run(self):
+        _configure_io(self)
+        if self.use_cdo:
+            _cdo_merge_strips(
+                [inp.path for inp in self.input()], self.output().path, dim=self.dim
+            )
+            return
+
+        datasets = _load_inputs(self.input()).values()
+        da = _concat_strips(datasets, dim=self.dim)[self.var_name]
+        if isinstance(self.output(), NpyPartialTarget):
+            write_partial(self.output().path, da)
+        else:
+            Path(self.output().path).parent.mkdir(exist_ok=True, parents=True)
+            backends.writer().write_dataset(da, self.output().path)
+
+    def output(self):
+        p = _build_path(
+            file_prefix=self.file_prefix,
+            data_stage="strip_group_variable",
+            data_kind=self.kind,
+            orientation=self.orientation,
+            start=self.start,
+            stop=self.stop,
+            dim=self.dim,
+            var_name=self.var_name,
+            tn=self.tn,
+            dest_path=self.dest_path,
+        )
+        return _partial_target(self, p)
+
+
+class _Merge3DBaseTask(MemoryBudgetMixin, SourceTrackingMixin, luigi.Task):
     """
     Common functionality for task that merge either strips or blocks together
     to construct datafile for whole domain
     """
 
+    source_task_class = UCLALESOutputBlock
+    # store the merged field with the partials, e.g. when only used for
+    # making the sparse output
+    intermediate = luigi.BoolParameter(default=False)
+
     def requires(self):
         return dict(
             first_block=UCLALESBlockSelectVariable(
@@ -471,6 +857,16 @@ class _Merge3DBaseTask(luigi.Task):
             )
         )
 
+    def estimate_peak_memory(self):
+        nx_b, ny_b = _find_number_of_blocks(
+            file_prefix=self.file_prefix,
+            source_path=self.source_path,
+            kind=self.kind,
+            orientation=self.orientation,
+        )
+        stage = "merge_blocks" if isinstance(self, ExtractByBlocks) else "merge_strips"
+        return _estimate_task_memory(self, stage=stage, n_blocks=nx_b * ny_b)
+
     def _check_output(self, da):
         # x -> `xt` or `xm` mapping, similar for other dims
         dims = dict([(d.replace("t", "").replace("m", ""), d) for d in da.dims])
@@ -500,25 +896,13 @@ class _Merge3DBaseTask(luigi.Task):
             )
 
     def run(self):
-        opened_inputs = dict([(inp, inp.open()) for inp in self.input()["parts"]])
+        _configure_io(self)
+        opened_inputs = _load_inputs(self.input()["parts"])
         self._check_inputs(opened_inputs)
 
         class_name = self.__class__.__name__
         if class_name == "ExtractByStrips":
-            # when extracting by strips we need to use `xr.concat` instead of
-            # `xr.merge`, and so we need to know which dimension to concatenate
-            # along
-            concat_dim = None
-            da_first = next(iter(opened_inputs.values()))
-            for d in da_first.dims:
-                if d.startswith(self.dim):
-                    concat_dim = d
-                    break
-
-            # couldn't find dim to concat along
-            if concat_dim is None:
-                raise NotImplementedError(da_first.dims)
-            da = xr.concat(opened_inputs.values(), dim=concat_dim)
+            da = _concat_strips(opened_inputs.values(), dim=self.dim)
         elif class_name == "ExtractByBlocks":
             da_first = self.input()["first_block"].open()[self.var_name]
             # ensure we retain the same coordinate ordering as in the source blocks
@@ -530,8 +914,12 @@ class _Merge3DBaseTask(luigi.Task):
 
         self._check_output(da=da)
 
+        if isinstance(self.input()["first_block"], NpyPartialTarget):
+            # the time coordinate is only decoded once, for the final output
+            da = decode_partial(da)
+
         Path(self.output().path).parent.mkdir(exist_ok=True, parents=True)
-        da.to_netcdf(self.output().path)
+        backends.writer().write_dataset(da, self.output().path)
 
     def _check_inputs(self, opened_inputs):
         pass
@@ -539,7 +927,7 @@ class _Merge3DBaseTask(luigi.Task):
     def output(self):
         p = _build_path(
             file_prefix=self.file_prefix,
-            data_stage="full_domain",
+            data_stage="dense_intermediate" if self.intermediate else "full_domain",
             data_kind=self.kind,
             orientation=self.orientation,
             source_path=self.source_path,
@@ -600,7 +988,9 @@ class ExtractByBlocks(_Merge3DBaseTask):
 class ExtractByStrips(_Merge3DBaseTask):
     """
     Aggregate all strips along `dim` dimension for `var_name` at timestep `tn` into a
-    single file
+    single file. With `fan_in` (> 1) the strips are merged in a tree of merge
+    tasks (each merging at most `fan_in` parts) so that the merge also runs in
+    parallel
     """
 
     file_prefix = luigi.Parameter()
@@ -612,6 +1002,7 @@ class ExtractByStrips(_Merge3DBaseTask):
     dim = luigi.Parameter(default="x")
     use_cdo = luigi.BoolParameter(default=True)
     dest_path = luigi.OptionalParameter(default=".")
+    fan_in = luigi.IntParameter(default=0)
 
     def _check_inputs(self, opened_inputs):
         nx_b, ny_b = _find_number_of_blocks(
@@ -629,52 +1020,52 @@ class ExtractByStrips(_Merge3DBaseTask):
         b_nx = int(da_first_block[dims["x"]].count())
         b_ny = int(da_first_block[dims["y"]].count())
 
-        if self.dim == "x":
-            expected_shape = (b_nx, b_ny * ny_b)
-            expected_shape_calc_str = f"({b_nx}, {b_ny} * {ny_b})"
-        elif self.dim == "y":
-            expected_shape = (b_nx * nx_b, b_ny)
-            expected_shape_calc_str = f"({b_nx} * {nx_b}, {b_ny}"
+        # when merging in a tree each part may be made up of multiple strips
+        n_strips = dict(
+            (t.output().path, _n_strips(t)) for t in self.requires()["parts"]
+        )
 
         invalid_shape = {}
         for inp, da_strip in opened_inputs.items():
+            n = n_strips[inp.path]
+            if self.dim == "x":
+                expected_shape = (b_nx * n, b_ny * ny_b)
+                expected_shape_calc_str = f"({b_nx} * {n}, {b_ny} * {ny_b})"
+            elif self.dim == "y":
+                expected_shape = (b_nx * nx_b, b_ny * n)
+                expected_shape_calc_str = f"({b_nx} * {nx_b}, {b_ny} * {n})"
+
             strip_shape = (
                 int(da_strip[dims["x"]].count()),
                 int(da_strip[dims["y"]].count()),
             )
             if strip_shape != expected_shape:
-                invalid_shape[inp.path] = strip_shape
+                invalid_shape[inp.path] = (
+                    strip_shape,
+                    f"{expected_shape_calc_str} = {expected_shape}",
+                )
 
         if len(invalid_shape) > 0:
             err_str = (
-                "The following input strip files don't have the expected shape "
-                f"{expected_shape_calc_str} = {expected_shape}:\n\t"
+                "The following input strip files don't have the expected shape:\n\t"
             )
 
             err_str += "\n\t".join(
-                [f"{shape}: {fn}" for (fn, shape) in invalid_shape.items()]
+                [
+                    f"{shape} (expected {expected}): {fn}"
+                    for (fn, (shape, expected)) in invalid_shape.items()
+                ]
             )
             raise Exception(err_str)
 
     def run(self):
+        _configure_io(self)
         if self.use_cdo:
-            if _cdo_has_command("gather"):
-                cdo_command = "gather"
-            else:
-                cdo_command = "collgrid"
-
-            # if we're concatenating in the y-direction we need to tell cdo to
-            # add an extra dimension for x
-            if self.dim == "y":
-                cdo_command += ",1"
-
-            args = (
-                [cdo_command]
-                + [inp.path for inp in self.input()["parts"]]
-                + [self.output().path]
+            _cdo_merge_strips(
+                [inp.path for inp in self.input()["parts"]],
+                self.output().path,
+                dim=self.dim,
             )
-            Path(self.output().path).parent.mkdir(exist_ok=True, parents=True)
-            _call_cdo(args)
             # after running cdo we need to check it has the expected content
             da = self.output().open()
             try:
@@ -701,32 +1092,32 @@ class ExtractByStrips(_Merge3DBaseTask):
             raise NotImplementedError(self.dim)
 
         tasks = super().requires()
-
-        tasks["parts"] = [
-            UCLALESStripSelectVariable(
-                file_prefix=self.file_prefix,
-                dim=self.dim,
-                idx=i,
-                tn=self.tn,
-                kind=self.kind,
-                orientation=self.orientation,
-                var_name=self.var_name,
-                source_path=self.source_path,
-                dest_path=self.dest_path,
-                use_cdo=self.use_cdo,
-            )
-            for i in range(nidx)
-        ]
+        tasks["parts"] = _strip_merge_parts(self, start=0, stop=nidx)
         return tasks
 
 
-class Extract(luigi.Task):
+class Extract(MemoryBudgetMixin, SourceTrackingMixin, luigi.Task):
     """
     Extract a single variable from UCLALES column-based output. `kind` should
     be either `3d` or `2d` indicating whether 3D fields or 2D cross-sections
     are to be extracted. For 3D extraction you must provide a timestep `tn` and
     for 2D extraction the orientation of the extraction (for example `xy`) must
-    be given
+    be given.
+
+    With `mode="auto"` the extraction strategy (and whether to use cdo) is
+    chosen from the estimated cost of each strategy (see `planner`). Setting
+    `dry_run` prints the estimates and chosen strategy without extracting
+    anything.
+
+    With `shard="K/N"` only the K'th of N deterministic subsets of the strips
+    (or blocks) are extracted, see `sharding.ExtractShard`
+
+    With `sparse` set (to `coo` or `blocks`, see `sparse_output`) only the
+    nonzero values of the full-domain field are stored, the dense field is
+    merged with the partials and removed once the sparse output is written
+
+    When extracting by strips, setting `fan_in` merges the strips in a tree
+    of merge tasks each merging at most `fan_in` parts (see `ExtractByStrips`)
     """
 
     file_prefix = luigi.Parameter()
@@ -739,10 +1130,72 @@ class Extract(luigi.Task):
     # orientation for 2D cross-sections
     orientation = luigi.OptionalParameter(default=None)
     use_cdo = luigi.BoolParameter(default=True)
+    dry_run = luigi.BoolParameter(default=False)
+    shard = luigi.OptionalParameter(default=None)
+    fan_in = luigi.IntParameter(default=0)
+    sparse = luigi.OptionalChoiceParameter(choices=SPARSE_LAYOUTS, default=None)
+
+    source_task_class = UCLALESOutputBlock
+
+    def _estimate_strategies(self):
+        """
+        The estimated cost of each strategy and the chosen one (see
+        `planner.plan_extraction`). The plan is kept with the task, since
+        luigi asks for the requirements of a task repeatedly and they must
+        not change between calls
+        """
+        if getattr(self, "_plan", None) is None:
+            self._plan = plan_extraction(
+                source_path=self.source_path,
+                file_prefix=self.file_prefix,
+                var_name=self.var_name,
+                kind=self.kind,
+                orientation=self.orientation,
+                use_cdo=self.use_cdo,
+            )
+        return self._plan
+
+    def _get_mode(self):
+        """
+        Extraction mode and whether to use cdo, planned if `mode == "auto"`
+        """
+        if self.mode == "auto":
+            _, plan = self._estimate_strategies()
+            return plan.mode, plan.use_cdo
+        return self.mode, self.use_cdo
 
     def requires(self):
-        if self.mode == "blocks":
-            if self.use_cdo:
+        if self.dry_run:
+            return []
+        elif self.shard is not None:
+            if self.sparse is not None:
+                raise NotImplementedError(
+                    "Sparse output can't be used when extracting a shard"
+                )
+            # imported here since the sharding tasks build on `Extract`
+            from .sharding import ExtractShard
+
+            return ExtractShard(
+                file_prefix=self.file_prefix,
+                var_names=[self.var_name],
+                tns=[self.tn],
+                kind=self.kind,
+                mode=self.mode,
+                source_path=self.source_path,
+                dest_path=self.dest_path,
+                orientation=self.orientation,
+                use_cdo=self.use_cdo,
+                shard=self.shard,
+            )
+        return self.merge_task()
+
+    def merge_task(self):
+        """
+        The task which merges the blocks (or strips) into the full domain
+        """
+        mode, use_cdo = self._get_mode()
+        if mode == "blocks":
+            if use_cdo:
                 raise NotImplementedError(
                     "It isn't currently possible to use cdo to extract-by-blocks"
                     " to avoid creating intermediate strips"
@@ -755,21 +1208,102 @@ class Extract(luigi.Task):
                 orientation=self.orientation,
                 source_path=self.source_path,
                 dest_path=self.dest_path,
+                intermediate=self.sparse is not None,
             )
-        elif self.mode.endswith("_strips"):
+        elif mode.endswith("_strips"):
             return ExtractByStrips(
                 file_prefix=self.file_prefix,
-                use_cdo=self.use_cdo,
+                use_cdo=use_cdo,
                 var_name=self.var_name,
                 tn=self.tn,
                 kind=self.kind,
                 orientation=self.orientation,
-                dim=self.mode[0],
+                dim=mode[0],
                 source_path=self.source_path,
                 dest_path=self.dest_path,
+                fan_in=self.fan_in,
+                intermediate=self.sparse is not None,
             )
         else:
-            raise NotImplementedError(self.mode)
+            raise NotImplementedError(mode)
+
+    def run(self):
+        if not self.dry_run:
+            if self.sparse is not None:
+                self._write_sparse()
+            # otherwise the work is done by the required task
+            return
+
+        plans, chosen = self._estimate_strategies()
+        if _cdo_available():
+            cdo_str = "available" if self.use_cdo else "not used"
+        else:
+            cdo_str = "not available"
+        print(
+            f"Estimated cost of extraction strategies for `{self.var_name}` "
+            f"(cdo: {cdo_str}):"
+        )
+        print(format_plans(plans, chosen=chosen))
+        print(f"Chosen strategy: mode={chosen.mode} use_cdo={chosen.use_cdo}")
+        if self.mode != "auto":
+            # the strategy set explicitly is used rather than the planned one
+            print(f"Strategy used: mode={self.mode} use_cdo={self.use_cdo}")
+
+    def _write_sparse(self):
+        merge_task = self.requires()
+        # opened lazily (and directly rather than through the pool of open
+        # datasets, since the file is removed afterwards) so that only a slab
+        # of the dense field is read into memory at a time
+        with xr.open_dataarray(merge_task.output().path) as da:
+            ds = to_sparse_dataset(da, layout=self.sparse, slab_size=SPARSE_SLAB_SIZE)
+            n_dense = da.size
+        # written to a temporary file first so that an interrupted run doesn't
+        # leave behind an incomplete output
+        path = Path(self.output().path)
+        path_tmp = path.with_suffix(".tmp.nc")
+        try:
+            backends.writer().write_dataset(ds, str(path_tmp))
+            os.replace(path_tmp, path)
+        finally:
+            path_tmp.unlink(missing_ok=True)
+        n_stored = ds[da.name].size
+        print(
+            f"Stored {n_stored} of {n_dense} values ({100.0 * n_stored / n_dense:.1f}%)"
+            f" of `{self.var_name}` in the `{self.sparse}` sparse layout"
+        )
+        # the dense field is only an intermediate, its manifest is removed
+        # too so that it is merged again if needed
+        merge_task.remove_outputs()
+
+    def _output_paths(self):
+        # without sparse output the output is that of the required task, which
+        # keeps its own manifest
+        if self.sparse is None or self.dry_run:
+            return []
+        return super()._output_paths()
+
+    def complete(self):
+        if self.dry_run:
+            return False
+        elif self.sparse is not None:
+            # up-to-date with the source files in the same way as the dense
+            # output (which is removed once the sparse output is written)
+            return super().complete()
+        # the output is that of the required task, which checks whether its
+        # output is up-to-date with the source files
+        return self.requires().complete()
 
     def output(self):
+        if self.sparse is not None and not self.dry_run:
+            p = _build_path(
+                file_prefix=self.file_prefix,
+                data_stage="sparse_full_domain",
+                data_kind=self.kind,
+                orientation=self.orientation,
+                var_name=self.var_name,
+                tn=self.tn,
+                layout=self.sparse,
+                dest_path=self.dest_path,
+            )
+            return XArrayTargetSparse(str(p))
         return self.input()
@@ -0,0 +1,116 @@
+"""
+Per-process pool of open datasets so that a worker running many tasks on the
+same files (e.g. extracting different variables from the same blocks, or
+reopening the first block to check the merged output) only opens each file,
+and decodes its metadata, once. The least recently used datasets are closed
+when the pool is full. Closed datasets are reopened by xarray if they are
+accessed again, so evicting a dataset that is still in use is safe (it just
+costs a reopen). Datasets are keyed on the file's modification time and size
+as well as its path so that files which are rewritten are opened again.
+
+Note that with more than one luigi worker each task is run in its own forked
+process, so datasets are then only reused within a task (e.g. the first block
+opened again to check the merged output). Reuse across tasks needs the tasks
+to be run in the same process, i.e. with a single worker per process (as
+done by `uclales-extract` with a central scheduler)
+"""
+import collections
+import os
+import threading
+from pathlib import Path
+
+from . import archive
+
+DEFAULT_POOL_SIZE = 16
+
+
+class DatasetPool:
+    """
+    LRU pool of at most `maxsize` open datasets (no datasets are kept if
+    `maxsize` is 0), with counts of hits, misses and evictions
+    """
+
+    def __init__(self, maxsize=DEFAULT_POOL_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._datasets = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _key(self, path, tag):
+        size, mtime_ns = archive.file_stat(path)
+        return (str(Path(path).resolve()), mtime_ns, size, tag)
+
+    def get(self, path, open_fn, tag=None):
+        """
+        Return the dataset for `path` from the pool, opening it with
+        `open_fn(path)` if it isn't there. `tag` distinguishes datasets
+        opened from the same file in different ways (e.g. with and without
+        decoding)
+        """
+        key = self._key(path, tag)
+        with self._lock:
+            if key in self._datasets:
+                self.hits += 1
+                self._datasets.move_to_end(key)
+                return self._datasets[key]
+            self.misses += 1
+
+        # opened without holding the lock so that opening different files
+        # isn't serialised across threads
+        ds = open_fn(path)
+        with self._lock:
+            if key in self._datasets:
+                # opened by another thread in the meantime, keep theirs
+                ds.close()
+                self._datasets.move_to_end(key)
+                return self._datasets[key]
+            if self.maxsize > 0:
+                self._datasets[key] = ds
+                self._evict(self.maxsize)
+            return ds
+
+    def _evict(self, maxsize):
+        while len(self._datasets) > maxsize:
+            _, ds = self._datasets.popitem(last=False)
+            ds.close()
+            self.evictions += 1
+
+    def resize(self, maxsize):
+        with self._lock:
+            self.maxsize = maxsize
+            self._evict(maxsize)
+
+    def clear(self):
+        with self._lock:
+            self._evict(0)
+
+    def __len__(self):
+        return len(self._datasets)
+
+    def __str__(self):
+        n_total = self.hits + self.misses
+        hit_rate = self.hits / n_total if n_total > 0 else 0.0
+        return (
+            f"dataset pool: {len(self)}/{self.maxsize} open, "
+            f"{self.hits} hits, {self.misses} misses ({100.*hit_rate:.0f}% hit rate), "
+            f"{self.evictions} evictions"
+        )
+
+
+_POOL = dict(pid=None, pool=None)
+
+
+def dataset_pool():
+    """
+    The pool for the current process. File handles (in particular HDF5
+    ones) can't be shared with forked processes, so a forked process starts
+    with an empty pool
+    """
+    if _POOL["pid"] != os.getpid():
+        maxsize = (
+            _POOL["pool"].maxsize if _POOL["pool"] is not None else DEFAULT_POOL_SIZE
+        )
+        _POOL.update(pid=os.getpid(), pool=DatasetPool(maxsize=maxsize))
+    return _POOL["pool"]
@@ -0,0 +1,226 @@
+"""
+Pre-flight integrity scan of the per-core source blocks. Crashed or still
+running simulations can leave missing, truncated or partially written block
+files, which otherwise are only found once the extraction reaches them (often
+as a segfault in cdo). Only the header of each block is read (in parallel
+worker processes), and the blocks are checked for
+
+- gaps in the grid of blocks
+- files that can't be opened
+- dimensions (and so block shapes) differing from the other blocks
+- variables (or their dimensions) differing from the other blocks
+- a different number of timesteps than the other blocks
+- files truncated after the header, i.e. smaller than the data described by
+  the header or (for uncompressed files) than the other blocks
+"""
+import collections
+import concurrent.futures
+import re
+from pathlib import Path
+
+from . import archive
+from .common import _build_path
+
+BLOCK_FILENAME_REGEX = dict(
+    [
+        # rico.00010002.nc
+        ("3d", r"^{file_prefix}\.(\d{{4}})(\d{{4}})\.nc$"),
+        # rico.out.xy.0001.0002.nc
+        ("2d", r"^{file_prefix}\.out\.{orientation}\.(\d{{4}})\.(\d{{4}})\.nc$"),
+    ]
+)
+
+
+def _find_block_files(source_path, file_prefix, kind, orientation=None):
+    """
+    Block files in `source_path` by block index (i, j)
+    """
+    if kind not in BLOCK_FILENAME_REGEX:
+        raise NotImplementedError(kind)
+    regex = re.compile(
+        BLOCK_FILENAME_REGEX[kind].format(
+            file_prefix=re.escape(file_prefix),
+            orientation=re.escape(str(orientation)),
+        )
+    )
+    blocks = {}
+    # `source_path` may also be a tar archive of the source blocks
+    for filename in archive.list_files(source_path):
+        m = regex.match(filename)
+        if m is not None:
+            blocks[tuple(int(n) for n in m.groups())] = Path(source_path) / filename
+    return blocks
+
+
+def _is_compressed(var):
+    filters = var.filters() or {}
+    return any(v for (k, v) in filters.items() if k not in ["shuffle", "fletcher32"])
+
+
+def _read_header(path):
+    """
+    The dimension sizes and the dimensions of each variable in `path`, the
+    file size and the number of bytes of (uncompressed) data the header
+    describes, or the error raised when opening it
+    """
+    try:
+        with archive.open_netcdf(path) as fh:
+            dims = dict((name, d.size) for (name, d) in fh.dimensions.items())
+            variables = dict(
+                (name, var.dimensions) for (name, var) in fh.variables.items()
+            )
+            # compressed variables may take up any amount of space
+            data_nbytes = sum(
+                var.size * var.dtype.itemsize
+                for var in fh.variables.values()
+                if not _is_compressed(var)
+            )
+            compressed = any(_is_compressed(var) for var in fh.variables.values())
+        size, _ = archive.file_stat(path)
+    except Exception as ex:
+        return dict(error=f"couldn't be opened ({ex})")
+    return dict(
+        dims=dims,
+        variables=variables,
+        size=size,
+        data_nbytes=data_nbytes,
+        compressed=compressed,
+    )
+
+
+def _most_common(values):
+    return collections.Counter(values).most_common(1)[0][0]
+
+
+class IntegrityReport:
+    """
+    Result of scanning `n_files` block files, with a list of problems found
+    for each file with problems (missing files are included by the path they
+    were expected at)
+    """
+
+    def __init__(self, n_files, problems):
+        self.n_files = n_files
+        self.problems = problems
+
+    @property
+    def ok(self):
+        return len(self.problems) == 0
+
+    def __str__(self):
+        if self.ok:
+            return f"All {self.n_files} source blocks are complete and consistent"
+        lines = [
+            f"Problems found with {len(self.problems)} of the source blocks"
+            f" ({self.n_files} found):"
+        ]
+        for path, problems in sorted(self.problems.items()):
+            lines.append(f"  {path}: {'; '.join(problems)}")
+        return "\n".join(lines)
+
+
+def scan_source_blocks(
+    source_path, file_prefix, kind="3d", orientation=None, n_workers=4
+):
+    """
+    Scan the headers of all source blocks with prefix `file_prefix` in
+    `source_path` in `n_workers` worker processes, and check that the grid of
+    blocks is complete and that the blocks are consistent with each other
+    (the most common header being taken as the reference). Returns an
+    `IntegrityReport`
+    """
+    blocks = _find_block_files(
+        source_path=source_path,
+        file_prefix=file_prefix,
+        kind=kind,
+        orientation=orientation,
+    )
+    if len(blocks) == 0:
+        raise Exception(
+            f"Didn't find any source files with prefix `{file_prefix}` in"
+            f" `{source_path}`"
+        )
+    problems = collections.defaultdict(list)
+
+    # the block grid should have no gaps
+    nx_b = max(i for (i, _) in blocks) + 1
+    ny_b = max(j for (_, j) in blocks) + 1
+    for i in range(nx_b):
+        for j in range(ny_b):
+            if (i, j) not in blocks:
+                path = _build_path(
+                    file_prefix=file_prefix,
+                    data_stage="source_block",
+                    data_kind=kind,
+                    orientation=orientation,
+                    i=i,
+                    j=j,
+                    source_path=source_path,
+                )
+                problems[str(path)].append("missing")
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as executor:
+        headers = dict(
+            zip(blocks.values(), executor.map(_read_header, blocks.values()))
+        )
+
+    readable = {}
+    for path, header in headers.items():
+        if "error" in header:
+            problems[str(path)].append(header["error"])
+        else:
+            readable[path] = header
+
+    if len(readable) > 0:
+        ref_shape = _most_common(
+            tuple(sorted((d, n) for (d, n) in h["dims"].items() if d != "time"))
+            for h in readable.values()
+        )
+        ref_variables = _most_common(
+            tuple(sorted(h["variables"].items())) for h in readable.values()
+        )
+        ref_nt = _most_common(h["dims"].get("time") for h in readable.values())
+        ref_size = _most_common(h["size"] for h in readable.values())
+
+        for path, header in readable.items():
+            shape = tuple(
+                sorted((d, n) for (d, n) in header["dims"].items() if d != "time")
+            )
+            if shape != ref_shape:
+                problems[str(path)].append(
+                    f"dimensions {dict(shape)} differ from {dict(ref_shape)}"
+                )
+            variables = dict(header["variables"])
+            missing = set(dict(ref_variables)).difference(variables)
+            extra = set(variables).difference(dict(ref_variables))
+            if len(missing) > 0:
+                problems[str(path)].append(f"missing variables {sorted(missing)}")
+            if len(extra) > 0:
+                problems[str(path)].append(f"unexpected variables {sorted(extra)}")
+            for name, dims in ref_variables:
+                if name in variables and variables[name] != dims:
+                    problems[str(path)].append(
+                        f"`{name}` has dimensions {variables[name]} rather than {dims}"
+                    )
+            nt = header["dims"].get("time")
+            if nt != ref_nt:
+                problems[str(path)].append(f"{nt} timesteps rather than {ref_nt}")
+
+            # a copy interrupted after the header leaves a file which can be
+            # opened (netCDF3 files in particular) but is missing data
+            if header["size"] < header["data_nbytes"]:
+                problems[str(path)].append(
+                    f"truncated, {header['size']} bytes is less than the"
+                    f" {header['data_nbytes']} bytes of data in its header"
+                )
+            elif (
+                not header["compressed"]
+                and header["size"] < ref_size
+                and (shape, variables, nt) == (ref_shape, dict(ref_variables), ref_nt)
+            ):
+                problems[str(path)].append(
+                    f"truncated, {header['size']} bytes rather than the"
+                    f" {ref_size} bytes of the other blocks"
+                )
+
+    return IntegrityReport(n_files=len(blocks), problems=dict(problems))
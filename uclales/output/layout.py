@@ -0,0 +1,201 @@
+"""
+Description of how the model domain is decomposed into per-core output blocks,
+with routines for reading (parts of) a variable across the blocks directly
+without first stitching the blocks together
+"""
+import itertools
+
+import numpy as np
+
+from . import archive, backends
+from .common import _build_path, _find_number_of_blocks
+
+
+def _dim_kind(dim):
+    """
+    `xt` or `xm` -> `x`, similarly for the other spatial dimensions
+    """
+    return dim.replace("t", "").replace("m", "") if dim != "time" else dim
+
+
+def _is_scalar_index(idx):
+    return not isinstance(idx, slice) and np.ndim(idx) == 0
+
+
+class BlockLayout:
+    """
+    Layout of the `nx_b` x `ny_b` per-core output blocks (each `block_nx` x
+    `block_ny` points in size) with filename prefix `file_prefix` in
+    `source_path`. `kind` is either `3d` or `2d` (in which case the
+    `orientation` of the cross-section must be given)
+    """
+
+    def __init__(self, source_path, file_prefix, kind="3d", orientation=None):
+        self.source_path = source_path
+        self.file_prefix = file_prefix
+        self.kind = kind
+        self.orientation = orientation
+
+        self.nx_b, self.ny_b = _find_number_of_blocks(
+            source_path=source_path,
+            file_prefix=file_prefix,
+            kind=kind,
+            orientation=orientation,
+        )
+
+        with archive.open_netcdf(self.block_path(0, 0)) as fh:
+            self.block_nx = fh.dimensions["xt"].size
+            self.block_ny = fh.dimensions["yt"].size
+
+    @property
+    def nx(self):
+        return self.nx_b * self.block_nx
+
+    @property
+    def ny(self):
+        return self.ny_b * self.block_ny
+
+    def block_path(self, i, j):
+        return _build_path(
+            file_prefix=self.file_prefix,
+            data_stage="source_block",
+            data_kind=self.kind,
+            orientation=self.orientation,
+            i=i,
+            j=j,
+            source_path=self.source_path,
+        )
+
+    def split_index(self, dim, idx):
+        """
+        Split the index `idx` (an integer, a slice or a sequence of integers)
+        in the full domain along `dim` (`x` or `y`) into the blocks that it
+        intersects. Yields for each block the block index, the index into that
+        block and the index into the output (`None` if `idx` is an integer)
+        """
+        if dim == "x":
+            n_b, block_n = self.nx_b, self.block_nx
+        elif dim == "y":
+            n_b, block_n = self.ny_b, self.block_ny
+        else:
+            raise NotImplementedError(dim)
+        n = n_b * block_n
+
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(n)
+            if step <= 0:
+                raise NotImplementedError("Only positive strides are supported")
+            if start >= stop:
+                return
+            n_out = 0
+            for b in range(start // block_n, (stop - 1) // block_n + 1):
+                b_start, b_end = b * block_n, (b + 1) * block_n
+                if start < b_start:
+                    first = start + -(-(b_start - start) // step) * step
+                else:
+                    first = start
+                last = min(stop, b_end)
+                if first >= last:
+                    continue
+                n_in = len(range(first, last, step))
+                yield (
+                    b,
+                    slice(first - b_start, last - b_start, step),
+                    slice(n_out, n_out + n_in),
+                )
+                n_out += n_in
+        elif not _is_scalar_index(idx):
+            idx = np.asarray(idx, dtype=int)
+            idx = np.where(idx < 0, idx + n, idx)
+            if np.any(idx < 0) or np.any(idx >= n):
+                raise IndexError(f"Indices {idx} are out of bounds along {dim} ({n})")
+            blocks = idx // block_n
+            for b in np.unique(blocks):
+                out_idx = np.nonzero(blocks == b)[0]
+                local_idx = idx[out_idx] % block_n
+                order = np.argsort(local_idx, kind="stable")
+                yield int(b), local_idx[order], out_idx[order]
+        else:
+            idx = int(idx)
+            if idx < 0:
+                idx += n
+            if not 0 <= idx < n:
+                raise IndexError(f"Index {idx} is out of bounds along {dim} ({n})")
+            yield idx // block_n, idx % block_n, None
+
+    def read(self, var_name, **isel):
+        """
+        Read `var_name` for the part of the domain given by indexing (by
+        integer index, slice or sequence of integers) along `time`, `x`, `y`
+        and `z` in `isel`, for example `read("w", time=0, z=slice(0, 10))`.
+        Indexing is done independently along each dimension (as in netCDF4).
+        Only the blocks that intersect the selection are opened (each exactly
+        once), and the result is filled into a preallocated array with
+        dimensions ordered as in the source files
+        """
+        with archive.open_netcdf(self.block_path(0, 0)) as fh:
+            if var_name not in fh.variables:
+                raise KeyError(
+                    f"The variable `{var_name}` wasn't found, the following"
+                    f" variables are available: {', '.join(fh.variables.keys())}"
+                )
+            var = fh.variables[var_name]
+            dims = var.dimensions
+            shape = var.shape
+            dtype = var.dtype
+
+        unknown_dims = set(isel.keys()).difference(["time", "x", "y", "z"])
+        if len(unknown_dims) > 0:
+            raise NotImplementedError(
+                f"Can only index along `time`, `x`, `y` and `z`, not {unknown_dims}"
+            )
+
+        # for each dimension a list of (block index, index into block, output
+        # slice) for each of the blocks along that dimension
+        dim_parts = []
+        out_shape = []
+        for d, n in zip(dims, shape):
+            kind = _dim_kind(d)
+            idx = isel.get(kind, slice(None))
+            if kind in ["x", "y"]:
+                parts = list(self.split_index(kind, idx))
+                n = dict(x=self.nx, y=self.ny)[kind]
+            else:
+                parts = [(None, idx, slice(None))]
+            if isinstance(idx, slice):
+                out_shape.append(len(range(*idx.indices(n))))
+            elif not _is_scalar_index(idx):
+                out_shape.append(len(idx))
+            dim_parts.append((kind, parts))
+
+        data = np.empty(out_shape, dtype=dtype)
+        if data.size == 0:
+            return data
+
+        for block_parts in itertools.product(*[parts for (_, parts) in dim_parts]):
+            block_idx = dict(i=0, j=0)
+            local_idx = []
+            out_idx = []
+            for (kind, _), (b, local, out) in zip(dim_parts, block_parts):
+                if kind == "x":
+                    block_idx["i"] = b
+                elif kind == "y":
+                    block_idx["j"] = b
+                local_idx.append(local)
+                if not _is_scalar_index(local):
+                    out_idx.append(out)
+
+            if any(isinstance(o, np.ndarray) for o in out_idx):
+                # index the output independently along each dimension
+                out_idx = np.ix_(
+                    *[
+                        o if isinstance(o, np.ndarray) else np.arange(n)[o]
+                        for (o, n) in zip(out_idx, data.shape)
+                    ]
+                )
+
+            data[tuple(out_idx)] = backends.reader().read_variable(
+                self.block_path(**block_idx), var_name, index=local_idx
+            )
+
+        return data
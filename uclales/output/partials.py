@@ -0,0 +1,195 @@
+"""
+Lightweight binary storage for the intermediate partials. Rather than writing
+each block and strip partial as a full netCDF file (rewriting its coordinates
+and attributes, and decoding them again when read back) the values are stored
+as a raw `.npy` array with a small JSON sidecar header holding the dimensions,
+coordinates (as offset and spacing for the uniform horizontal grid) and
+attributes. Partials are memory-mapped when opened, without any decoding, and
+only the final full-domain output is written as netCDF (with the time
+coordinate decoded once)
+"""
+import json
+from pathlib import Path
+
+import luigi
+import numpy as np
+import xarray as xr
+
+from . import archive
+from .common import _fix_time_units as fix_time_units
+from .layout import _dim_kind
+
+PARTIALS_FORMATS = ["netcdf", "npy"]
+
+
+class partials(luigi.Config):
+    """
+    Storage format of the intermediate partials (`netcdf` or `npy`), set in
+    the `[partials]` section of `luigi.cfg`. Partials created with cdo are
+    always stored as netCDF
+    """
+
+    format = luigi.ChoiceParameter(choices=PARTIALS_FORMATS, default="netcdf")
+
+
+def header_path(path):
+    return Path(path).with_suffix(".header.json")
+
+
+def _to_json(value):
+    if isinstance(value, (np.ndarray, np.generic)):
+        return value.tolist()
+    return value
+
+
+def _encode_coord(dim, values, attrs):
+    values = np.asarray(values)
+    coord = dict(
+        dtype=str(values.dtype), attrs=dict((k, _to_json(v)) for k, v in attrs.items())
+    )
+    if _dim_kind(dim) in ["x", "y"] and len(values) > 1:
+        # uniform horizontal grid, only store the offset and spacing if the
+        # coordinate is reconstructed exactly from these
+        uniform = dict(
+            start=_to_json(values[0]),
+            step=_to_json(values[1] - values[0]),
+            size=len(values),
+        )
+        if np.array_equal(_decode_coord(dict(coord, **uniform)), values):
+            coord.update(uniform)
+            return coord
+    coord["values"] = _to_json(values)
+    return coord
+
+
+def _decode_coord(coord):
+    if "values" in coord:
+        values = coord["values"]
+    else:
+        values = coord["start"] + coord["step"] * np.arange(coord["size"])
+    return np.asarray(values, dtype=coord["dtype"])
+
+
+def _write(path, name, values, dims, coords, attrs):
+    """
+    `coords` is a dict of dim -> (values, attrs)
+    """
+    path = Path(path)
+    path.parent.mkdir(exist_ok=True, parents=True)
+    np.save(path, np.ascontiguousarray(values), allow_pickle=False)
+    header = dict(
+        name=name,
+        dims=list(dims),
+        attrs=dict((k, _to_json(v)) for k, v in attrs.items()),
+        coords=dict(
+            (d, _encode_coord(d, c_values, c_attrs))
+            for (d, (c_values, c_attrs)) in coords.items()
+        ),
+    )
+    with open(header_path(path), "w") as fh:
+        json.dump(header, fh, indent=2)
+
+
+def write_block_partial(path, fn_block, var_name, tn=None):
+    """
+    Write `var_name` (at timestep `tn` if given) from the source block
+    `fn_block` read directly with netCDF4, i.e. without decoding
+    """
+    with archive.open_netcdf(fn_block) as fh:
+        fh.set_auto_mask(False)
+        if var_name not in fh.variables:
+            raise KeyError(
+                f"The variable `{var_name}` wasn't found, the following"
+                f" variables are available: {', '.join(fh.variables.keys())}"
+            )
+        var = fh.variables[var_name]
+        dims = var.dimensions
+        isel = dict(time=slice(None) if tn is None else slice(int(tn), int(tn) + 1))
+        idx = tuple(isel.get(d, slice(None)) for d in dims)
+        values = var[idx]
+
+        coords = {}
+        for d in dims:
+            if d in fh.variables:
+                c_var = fh.variables[d]
+                coords[d] = (
+                    c_var[isel.get(d, slice(None))],
+                    dict((k, c_var.getncattr(k)) for k in c_var.ncattrs()),
+                )
+        # the fill value is kept so that missing values are masked when the
+        # final output is decoded (see `decode_partial`)
+        attrs = dict(
+            (k, var.getncattr(k))
+            for k in var.ncattrs()
+            if not k.startswith("_") or k == "_FillValue"
+        )
+
+    _write(
+        path,
+        name=var_name,
+        values=values,
+        dims=dims,
+        coords=coords,
+        attrs=attrs,
+    )
+
+
+def write_partial(path, da):
+    """
+    Write the (undecoded) `xr.DataArray` `da` as a partial
+    """
+    coords = dict((d, (da[d].values, da[d].attrs)) for d in da.dims if d in da.coords)
+    _write(
+        path,
+        name=da.name,
+        values=da.values,
+        dims=da.dims,
+        coords=coords,
+        attrs=da.attrs,
+    )
+
+
+def open_partial(path):
+    """
+    Open a partial as a `xr.Dataset`, with the values memory-mapped
+    """
+    with open(header_path(path)) as fh:
+        header = json.load(fh)
+    values = np.load(path, mmap_mode="r")
+    coords = dict(
+        (d, xr.DataArray(_decode_coord(c), dims=(d,), attrs=c["attrs"]))
+        for (d, c) in header["coords"].items()
+    )
+    da = xr.DataArray(
+        values,
+        dims=header["dims"],
+        coords=coords,
+        attrs=header["attrs"],
+        name=header["name"],
+    )
+    return da.to_dataset()
+
+
+def decode_partial(da):
+    """
+    Decode the time coordinate of data constructed from partials, this is only
+    done once for the final output
+    """
+    da["time"], _ = fix_time_units(da["time"])
+    if isinstance(da, xr.DataArray):
+        return xr.decode_cf(da.to_dataset())[da.name]
+    return xr.decode_cf(da)
+
+
+class NpyPartialTarget(luigi.target.FileSystemTarget):
+    fs = luigi.local_target.LocalFileSystem()
+
+    def __init__(self, path, *args, **kwargs):
+        super().__init__(path, *args, **kwargs)
+        self.path = path
+
+    def exists(self):
+        return Path(self.path).exists() and header_path(self.path).exists()
+
+    def open(self):
+        return open_partial(self.path)
@@ -0,0 +1,199 @@
+"""
+Pipelined reading and writing of blocks so that reading, transforming and
+writing neighbouring blocks overlap. Reads are done ahead of consumption by
+background workers (threads or processes) into a bounded queue and writes are
+handed off to a separate writer thread, with the occupancy of both queues
+recorded so that the pipeline depth can be tuned.
+
+netCDF4/HDF5 isn't thread-safe, so at most one thread in a process should be
+reading or writing netCDF files at a time: several readers are run as
+processes, and when writing at the same time as reading the reads should be
+done in processes too (see `run_pipeline`)
+"""
+import collections
+import concurrent.futures
+import time
+
+import luigi
+
+
+class pipeline(luigi.Config):
+    """
+    Configuration for pipelined reading and writing of blocks, set in the
+    `[pipeline]` section of `luigi.cfg`
+    """
+
+    depth = luigi.IntParameter(default=4)
+    n_readers = luigi.IntParameter(default=1)
+    # more than one reader always uses processes
+    use_processes = luigi.BoolParameter(default=False)
+
+
+def _make_executor(n_workers, use_processes):
+    if use_processes:
+        return concurrent.futures.ProcessPoolExecutor(max_workers=n_workers)
+    return concurrent.futures.ThreadPoolExecutor(max_workers=n_workers)
+
+
+class QueueMetrics:
+    """
+    Occupancy of a bounded queue sampled every time an item is taken from
+    (or, for writers, put into) the queue, together with how long was spent
+    waiting on the queue
+    """
+
+    def __init__(self, name, depth):
+        self.name = name
+        self.depth = depth
+        self.occupancy = []
+        self.wait_time = 0.0
+        self.t_start = time.time()
+        self.t_end = None
+
+    def record(self, n_ready, wait_time):
+        self.occupancy.append(n_ready)
+        self.wait_time += wait_time
+
+    def summary(self):
+        n_items = len(self.occupancy)
+        t_end = self.t_end if self.t_end is not None else time.time()
+        return dict(
+            name=self.name,
+            depth=self.depth,
+            n_items=n_items,
+            mean_occupancy=sum(self.occupancy) / n_items if n_items > 0 else 0.0,
+            max_occupancy=max(self.occupancy) if n_items > 0 else 0,
+            # fraction of the time an item was requested and the queue was empty
+            empty_fraction=(
+                sum(n == 0 for n in self.occupancy) / n_items if n_items > 0 else 0.0
+            ),
+            wait_time=self.wait_time,
+            total_time=t_end - self.t_start,
+        )
+
+    def __str__(self):
+        s = self.summary()
+        return (
+            f"{s['name']}: {s['n_items']} items, queue depth {s['depth']}, "
+            f"occupancy mean={s['mean_occupancy']:.2f} max={s['max_occupancy']}, "
+            f"empty {100.*s['empty_fraction']:.0f}% of the time, "
+            f"waited {s['wait_time']:.2f}s of {s['total_time']:.2f}s"
+        )
+
+
+class PrefetchingReader:
+    """
+    Iterate over `(item, read_fn(item))` for each of `items` in order, with
+    up to `depth` reads started ahead of consumption by `n_readers`
+    background workers. A single reader is run as a thread (unless
+    `use_processes` is set) and several readers as processes, in which case
+    `read_fn` must be picklable. The queue occupancy is recorded in `metrics`
+    """
+
+    def __init__(self, read_fn, items, depth=None, n_readers=None, use_processes=None):
+        config = pipeline()
+        self.read_fn = read_fn
+        self.items = items
+        self.depth = depth if depth is not None else config.depth
+        self.n_readers = n_readers if n_readers is not None else config.n_readers
+        if use_processes is None:
+            use_processes = config.use_processes
+        self.use_processes = use_processes or self.n_readers > 1
+        if self.depth < 1:
+            raise ValueError("The pipeline depth must be at least 1")
+        self.metrics = QueueMetrics(name="read", depth=self.depth)
+
+    def __iter__(self):
+        items = iter(self.items)
+        queue = collections.deque()
+
+        def _fill(executor):
+            while len(queue) < self.depth:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+                queue.append((item, executor.submit(self.read_fn, item)))
+
+        with _make_executor(self.n_readers, self.use_processes) as executor:
+            try:
+                _fill(executor)
+                while len(queue) > 0:
+                    item, future = queue.popleft()
+                    n_ready = int(future.done()) + sum(f.done() for (_, f) in queue)
+                    t0 = time.time()
+                    result = future.result()
+                    self.metrics.record(n_ready=n_ready, wait_time=time.time() - t0)
+                    _fill(executor)
+                    yield item, result
+            finally:
+                for _, future in queue:
+                    future.cancel()
+                self.metrics.t_end = time.time()
+
+
+class PipelinedWriter:
+    """
+    Hands off `write_fn(item, data)` calls to a background writer thread so
+    that writing overlaps with reading and transforming the next blocks. At
+    most `depth` writes are queued, `submit` blocks until there is room. Use
+    as a context manager to wait for (and raise any exceptions from) all
+    writes on exit
+    """
+
+    def __init__(self, write_fn, depth=None):
+        self.write_fn = write_fn
+        self.depth = depth if depth is not None else pipeline().depth
+        if self.depth < 1:
+            raise ValueError("The pipeline depth must be at least 1")
+        self.metrics = QueueMetrics(name="write", depth=self.depth)
+        self._queue = collections.deque()
+        self._executor = None
+
+    def __enter__(self):
+        # a single thread, so that the writes are done one at a time and in
+        # order (e.g. to the same open file)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        return self
+
+    def submit(self, item, data):
+        # drop completed writes (raising if any failed) and wait for room
+        t0 = time.time()
+        while len(self._queue) > 0 and (
+            self._queue[0].done() or len(self._queue) >= self.depth
+        ):
+            self._queue.popleft().result()
+        self.metrics.record(n_ready=len(self._queue), wait_time=time.time() - t0)
+        self._queue.append(self._executor.submit(self.write_fn, item, data))
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                while len(self._queue) > 0:
+                    self._queue.popleft().result()
+            else:
+                for future in self._queue:
+                    future.cancel()
+        finally:
+            self._executor.shutdown(wait=True)
+            self.metrics.t_end = time.time()
+
+
+def run_pipeline(items, read_fn, write_fn, transform_fn=None, depth=None, **kwargs):
+    """
+    Read, (optionally) transform and write each of `items` with reading done
+    ahead and writing done behind the transformation so that neighbouring
+    items are in different stages at the same time. The reads are done in
+    processes (so that only the writer thread uses netCDF4/HDF5 in this
+    process) and `kwargs` are passed on to `PrefetchingReader`. Returns the
+    read and write queue metrics
+    """
+    kwargs.setdefault("use_processes", True)
+    reader = PrefetchingReader(read_fn=read_fn, items=items, depth=depth, **kwargs)
+    with PipelinedWriter(write_fn=write_fn, depth=depth) as writer:
+        for item, data in reader:
+            if transform_fn is not None:
+                data = transform_fn(item, data)
+            writer.submit(item, data)
+
+    return reader.metrics, writer.metrics
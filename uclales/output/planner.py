@@ -0,0 +1,325 @@
+"""
+Cost-model for choosing how to extract a variable. For each strategy
+(extracting by `blocks`, `x_strips` or `y_strips`, with or without cdo) the
+number of files opened, bytes read and written, number of subprocesses started
+and peak memory use are estimated from the block layout, and the cheapest
+strategy that fits in the available memory is chosen
+"""
+import functools
+import os
+
+from . import archive
+from .common import _build_path, _cdo_available, _find_number_of_blocks
+
+# rough cost (in seconds) of each operation, these are only used to rank the
+# strategies against each other so only their relative magnitude matters
+DEFAULT_COSTS = dict(
+    # seconds per byte read and written
+    read=1.0 / 200.0e6,
+    write=1.0 / 100.0e6,
+    # seconds per file opened, and the extra cost of decoding the file's
+    # coordinates and attributes with xarray
+    file_open=0.01,
+    xarray_decode=0.05,
+    # seconds to start a subprocess (i.e. cdo)
+    subprocess=0.2,
+)
+
+MODES = ["blocks", "x_strips", "y_strips"]
+
+
+def _available_memory():
+    """
+    Available physical memory in bytes, or `None` if it can't be determined.
+    On Linux this is `MemAvailable` from `/proc/meminfo`, which (unlike the
+    free memory) includes the page cache that can be reclaimed
+    """
+    try:
+        with open("/proc/meminfo") as fh:
+            for line in fh:
+                if line.startswith("MemAvailable:"):
+                    # given in kB
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+class ExtractionPlan:
+    """
+    Estimated cost of extracting with `mode` (and `use_cdo`)
+    """
+
+    def __init__(
+        self,
+        mode,
+        use_cdo,
+        n_files_opened,
+        bytes_read,
+        bytes_written,
+        n_subprocesses,
+        n_xarray_opens,
+        peak_memory,
+        costs,
+    ):
+        self.mode = mode
+        self.use_cdo = use_cdo
+        self.n_files_opened = n_files_opened
+        self.bytes_read = bytes_read
+        self.bytes_written = bytes_written
+        self.n_subprocesses = n_subprocesses
+        self.n_xarray_opens = n_xarray_opens
+        self.peak_memory = peak_memory
+        self.cost = (
+            bytes_read * costs["read"]
+            + bytes_written * costs["write"]
+            + n_files_opened * costs["file_open"]
+            + n_xarray_opens * costs["xarray_decode"]
+            + n_subprocesses * costs["subprocess"]
+        )
+
+    def __repr__(self):
+        return (
+            f"ExtractionPlan(mode={self.mode!r}, use_cdo={self.use_cdo}, "
+            f"cost={self.cost:.2f})"
+        )
+
+
+def estimate_stage_memory(stage, use_cdo, n_blocks, block_nbytes, nz):
+    """
+    Estimated peak memory use (in bytes) of a single task at extraction
+    `stage`, one of `block` (selecting the variable from one source block),
+    `strip` (joining `n_blocks` block partials into a strip), `merge_blocks`
+    or `merge_strips` (constructing the full domain from `n_blocks` worth of
+    blocks or strips)
+    """
+    nbytes = n_blocks * block_nbytes
+    if use_cdo:
+        # cdo works one horizontal level (record) at a time
+        nbytes = nbytes // max(nz, 1)
+
+    if stage == "merge_blocks":
+        # `xr.merge` aligns (and so copies) all the inputs in addition to the
+        # loaded inputs and result
+        return 3 * nbytes
+    elif stage in ["block", "strip", "merge_strips"]:
+        # the loaded inputs and the result
+        return 2 * nbytes
+    else:
+        raise NotImplementedError(stage)
+
+
+def _estimate(mode, use_cdo, nx_b, ny_b, block_nbytes, nz, costs):
+    n_blocks = nx_b * ny_b
+    full_nbytes = n_blocks * block_nbytes
+    stage_memory = functools.partial(
+        estimate_stage_memory, use_cdo=use_cdo, block_nbytes=block_nbytes, nz=nz
+    )
+
+    # first stage: selecting the variable (and timestep) from each source
+    # block into a partial
+    n_files_opened = 2 * n_blocks
+    bytes_read = full_nbytes
+    bytes_written = full_nbytes
+    n_subprocesses = n_blocks if use_cdo else 0
+    n_xarray_opens = 0 if use_cdo else n_blocks
+
+    if mode == "blocks":
+        # merge all block partials at once
+        n_files_opened += n_blocks + 1
+        n_xarray_opens += n_blocks
+        bytes_read += full_nbytes
+        bytes_written += full_nbytes
+        peak_memory = stage_memory("merge_blocks", n_blocks=n_blocks)
+    else:
+        n_strips = nx_b if mode == "x_strips" else ny_b
+        # second stage: block partials -> strips, third stage: strips ->
+        # full domain
+        n_files_opened += (n_blocks + n_strips) + (n_strips + 1)
+        bytes_read += 2 * full_nbytes
+        bytes_written += 2 * full_nbytes
+        if use_cdo:
+            n_subprocesses += n_strips + 1
+        else:
+            n_xarray_opens += n_blocks + n_strips
+        peak_memory = stage_memory("merge_strips", n_blocks=n_blocks)
+
+    return ExtractionPlan(
+        mode=mode,
+        use_cdo=use_cdo,
+        n_files_opened=n_files_opened,
+        bytes_read=bytes_read,
+        bytes_written=bytes_written,
+        n_subprocesses=n_subprocesses,
+        n_xarray_opens=n_xarray_opens,
+        peak_memory=peak_memory,
+        costs=costs,
+    )
+
+
+@functools.lru_cache(maxsize=64)
+def block_variable_nbytes(source_path, file_prefix, var_name, kind, orientation=None):
+    """
+    Size in bytes of `var_name` in a single source block (for 3D output at a
+    single timestep) and the number of vertical levels
+    """
+    from . import reductions
+    from .derivatives import is_derivative_field, source_var_names
+
+    column_reduction = reductions.is_column_reduction(var_name)
+    if is_derivative_field(var_name):
+        # derivative fields are the same size as the fields they're computed from
+        var_name = source_var_names(var_name)[0]
+    elif column_reduction:
+        var_name = reductions.source_var_name(var_name)
+
+    fn_block = _build_path(
+        file_prefix=file_prefix,
+        data_stage="source_block",
+        data_kind=kind,
+        orientation=orientation,
+        i=0,
+        j=0,
+        source_path=source_path,
+    )
+    with archive.open_netcdf(fn_block) as fh:
+        if var_name not in fh.variables:
+            raise KeyError(
+                f"The variable `{var_name}` wasn't found, the following"
+                f" variables are available: {', '.join(fh.variables.keys())}"
+            )
+        var = fh.variables[var_name]
+        shape = dict(zip(var.dimensions, var.shape))
+        itemsize = var.dtype.itemsize
+
+    nz = 1
+    block_nitems = 1
+    for d, n in shape.items():
+        if d == "time" and kind == "3d":
+            # 3D extraction is done one timestep at a time
+            continue
+        if d.startswith("z"):
+            if column_reduction:
+                # the column reductions are 2D (and stored in double precision)
+                itemsize = 8
+                continue
+            nz = n
+        block_nitems *= n
+    return block_nitems * itemsize, nz
+
+
+def estimate_strategies(
+    source_path,
+    file_prefix,
+    var_name,
+    kind,
+    orientation=None,
+    allow_cdo=True,
+    costs=None,
+):
+    """
+    Estimate the cost of all possible extraction strategies for `var_name`.
+    cdo-based strategies are only considered if `allow_cdo` is set
+    """
+    costs = dict(DEFAULT_COSTS, **(costs or {}))
+    nx_b, ny_b = _find_number_of_blocks(
+        source_path=source_path,
+        file_prefix=file_prefix,
+        kind=kind,
+        orientation=orientation,
+    )
+    block_nbytes, nz = block_variable_nbytes(
+        source_path=source_path,
+        file_prefix=file_prefix,
+        var_name=var_name,
+        kind=kind,
+        orientation=orientation,
+    )
+
+    plans = []
+    for mode in MODES:
+        for use_cdo in [False, True]:
+            if use_cdo and (not allow_cdo or mode == "blocks"):
+                # it isn't possible to extract by blocks with cdo
+                continue
+            plans.append(
+                _estimate(
+                    mode=mode,
+                    use_cdo=use_cdo,
+                    nx_b=nx_b,
+                    ny_b=ny_b,
+                    block_nbytes=block_nbytes,
+                    nz=nz,
+                    costs=costs,
+                )
+            )
+    return plans
+
+
+def choose_plan(plans, memory_available=None):
+    """
+    Choose the cheapest of `plans` with a peak memory use within
+    `memory_available` (in bytes, by default the available physical memory).
+    If none fit the one with the smallest peak memory use is chosen
+    """
+    if memory_available is None:
+        memory_available = _available_memory()
+
+    if memory_available is not None:
+        fitting_plans = [p for p in plans if p.peak_memory <= memory_available]
+    else:
+        fitting_plans = plans
+
+    if len(fitting_plans) == 0:
+        return min(plans, key=lambda p: p.peak_memory)
+    return min(fitting_plans, key=lambda p: p.cost)
+
+
+def plan_extraction(
+    source_path, file_prefix, var_name, kind, orientation=None, use_cdo=True
+):
+    """
+    Estimate the cost of all extraction strategies (cdo-based strategies only
+    if `use_cdo` is set and cdo is available) and choose the cheapest that
+    fits in the available memory. Returns the estimates and the chosen plan
+    """
+    plans = estimate_strategies(
+        source_path=source_path,
+        file_prefix=file_prefix,
+        var_name=var_name,
+        kind=kind,
+        orientation=orientation,
+        allow_cdo=use_cdo and _cdo_available(),
+    )
+    return plans, choose_plan(plans)
+
+
+def _format_nbytes(nbytes):
+    for unit in ["B", "KB", "MB", "GB"]:
+        if nbytes < 1024:
+            return f"{nbytes:.1f}{unit}"
+        nbytes /= 1024.0
+    return f"{nbytes:.1f}TB"
+
+
+def format_plans(plans, chosen=None):
+    """
+    Table of the estimates for each of `plans`, marking the `chosen` one
+    """
+    header = (
+        f"  {'mode':<10} {'cdo':<5} {'files':>7} {'read':>9} {'written':>9}"
+        f" {'procs':>6} {'peak mem':>9} {'cost':>8}"
+    )
+    lines = [header]
+    for p in sorted(plans, key=lambda p: p.cost):
+        marker = "*" if p is chosen else " "
+        lines.append(
+            f"{marker} {p.mode:<10} {str(p.use_cdo):<5} {p.n_files_opened:>7}"
+            f" {_format_nbytes(p.bytes_read):>9}"
+            f" {_format_nbytes(p.bytes_written):>9} {p.n_subprocesses:>6}"
+            f" {_format_nbytes(p.peak_memory):>9} {p.cost:>8.2f}"
+        )
+    return "\n".join(lines)
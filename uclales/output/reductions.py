@@ -0,0 +1,215 @@
+"""
+2D maps reduced over each column of the 3D output (e.g. cloud-base height or
+the maximum vertical velocity), computed inside each source block so that
+only the small 2D result is written and stitched (through `Extract`, in the
+same way as any other variable) and the 3D field never has to be extracted.
+The available reductions are
+
+- `cloud_base_height` and `cloud_top_height`: height of the lowest and
+  highest level with liquid water (`l`) above `CLOUD_LIQUID_THRESHOLD`
+  (`nan` for columns without cloud)
+- `colmax_{var}` and `colmin_{var}`: column maximum and minimum of `var`,
+  e.g. `colmax_w`
+- `colint_{var}`: density-weighted vertical integral of `var` over the
+  column, e.g. `colint_l` for the liquid water path. The mixture density is
+  calculated in the same way as the derived field `rho` (see
+  `uclales.loader`), so the integrated variable must be on the cell-centre
+  levels (`zt`)
+"""
+import re
+
+import numpy as np
+
+from . import archive, backends
+from .layout import _dim_kind
+
+# liquid water mixing ratio (in kg/kg) above which a grid-cell is cloudy
+CLOUD_LIQUID_THRESHOLD = 1.0e-5
+
+# units of the density-weighted column integral of mixing ratios, i.e. the
+# mass path
+MASS_PATH_UNITS = {"kg/kg": "kg/m2", "g/kg": "g/m2"}
+
+CLOUD_REDUCTIONS = dict(
+    cloud_base_height="lowest",
+    cloud_top_height="highest",
+)
+
+
+def _parse_reduction(var_name):
+    """
+    `colmax_w` -> ("max", "w"), `cloud_base_height` -> ("cloud_base_height", "l")
+    """
+    if var_name in CLOUD_REDUCTIONS:
+        return var_name, "l"
+    m = re.match(r"^col(max|min|int)_(.+)$", var_name)
+    if m is None:
+        return None
+    return m.groups()
+
+
+def is_column_reduction(var_name):
+    return _parse_reduction(var_name) is not None
+
+
+def source_var_name(var_name):
+    """
+    The 3D variable the column reduction `var_name` is computed from
+    """
+    return _parse_reduction(var_name)[1]
+
+
+def _layer_thickness(z, z_interfaces):
+    """
+    Thickness of the layer around each of the levels `z`, from the staggered
+    levels `z_interfaces` (the first interface being below the ground)
+    """
+    if np.all(z_interfaces[:-1] >= z[:-1]):
+        # the interfaces are above the levels, as for `zt` with `zm`
+        dz = np.diff(z_interfaces, prepend=0.0)
+    else:
+        dz = np.diff(z_interfaces, append=2 * z[-1] - z_interfaces[-1])
+    return np.clip(dz, 0.0, None)
+
+
+def reduce_columns(values, z, axis, reduction, units=None, z_interfaces=None, rho=None):
+    """
+    Apply `reduction` (see `_parse_reduction`) over `axis` of `values`, with
+    heights `z` along that axis. Integrals are weighted by the density `rho`
+    (with the same shape as `values`) if given
+    """
+    if reduction == "max":
+        return np.max(values, axis=axis)
+    elif reduction == "min":
+        return np.min(values, axis=axis)
+    elif reduction == "int":
+        dz = _layer_thickness(z, z_interfaces)
+        shape = [1] * values.ndim
+        shape[axis] = len(dz)
+        if rho is not None:
+            values = values * rho
+        return np.sum(values * dz.reshape(shape), axis=axis)
+    elif reduction in CLOUD_REDUCTIONS:
+        threshold = CLOUD_LIQUID_THRESHOLD
+        if units == "g/kg":
+            threshold *= 1.0e3
+        cloudy = np.moveaxis(values > threshold, axis, -1)
+        has_cloud = np.any(cloudy, axis=-1)
+        if CLOUD_REDUCTIONS[reduction] == "lowest":
+            k = np.argmax(cloudy, axis=-1)
+        else:
+            k = len(z) - 1 - np.argmax(cloudy[..., ::-1], axis=-1)
+        return np.where(has_cloud, z[k], np.nan)
+    raise NotImplementedError(reduction)
+
+
+def _block_density(fn_block, index, shape):
+    """
+    Mixture density (in kg/m3) within `index` of the 3D source block
+    `fn_block`, calculated from the raw fields in the same way as the derived
+    field `rho`
+    """
+    from ..loader import DERIVED_FIELD_INPUTS, OPTIONAL_FIELDS, calc_derived_field
+
+    with archive.open_netcdf(fn_block) as fh:
+        available = list(fh.variables.keys())
+    fields = {}
+    for v in DERIVED_FIELD_INPUTS["rho"]:
+        if v in OPTIONAL_FIELDS and v not in available:
+            fields[v] = 0.0
+        else:
+            fields[v] = backends.reader().read_variable(fn_block, v, index=index)
+            if fields[v].shape != shape:
+                raise Exception(
+                    f"`{v}` has shape {fields[v].shape}, but the integrated"
+                    f" variable has shape {shape}"
+                )
+    return calc_derived_field("rho", fields)
+
+
+def block_column_reduction(fn_block, var_name, tn):
+    """
+    Compute the column reduction `var_name` at timestep `tn` from the 3D
+    source block `fn_block`. Returns a `xr.DataArray` with the time coordinate
+    as stored in the source files (i.e. not decoded)
+    """
+    # imported here so that e.g. `uclales-extract --help` doesn't need xarray
+    import xarray as xr
+
+    reduction, source_var = _parse_reduction(var_name)
+    with archive.open_netcdf(fn_block) as fh:
+        if source_var not in fh.variables:
+            raise KeyError(
+                f"The variable `{source_var}` wasn't found, the following"
+                f" variables are available: {', '.join(fh.variables.keys())}"
+            )
+        var = fh.variables[source_var]
+        dims = var.dimensions
+        units = getattr(var, "units", None)
+        z_dim = [d for d in dims if _dim_kind(d) == "z"][0]
+        z = np.asarray(fh.variables[z_dim][:], dtype=np.float64)
+        # the other (staggered) vertical grid gives the layer interfaces
+        z_other = "zm" if z_dim == "zt" else "zt"
+        z_interfaces = (
+            np.asarray(fh.variables[z_other][:], dtype=np.float64)
+            if z_other in fh.variables
+            else None
+        )
+        coords = dict(
+            (d, np.asarray(fh.variables[d][:]))
+            for d in dims
+            if d not in ["time", z_dim] and d in fh.variables
+        )
+        da_time = xr.DataArray(
+            fh.variables["time"][[int(tn)]],
+            dims=("time",),
+            attrs=dict(units=fh.variables["time"].units),
+        )
+        z_units = getattr(fh.variables[z_dim], "units", "m")
+
+    index = tuple(
+        slice(int(tn), int(tn) + 1) if d == "time" else slice(None) for d in dims
+    )
+    values = backends.reader().read_variable(fn_block, source_var, index=index)
+    rho = None
+    if reduction == "int":
+        if z_interfaces is None:
+            raise Exception(
+                f"Can't integrate `{source_var}` without the staggered vertical grid"
+            )
+        if z_dim != "zt":
+            raise NotImplementedError(
+                f"The density is calculated on `zt`, so `{source_var}` (on"
+                f" `{z_dim}`) can't be integrated"
+            )
+        rho = _block_density(fn_block, index=index, shape=values.shape)
+    reduced = reduce_columns(
+        values.astype(np.float64),
+        z=z,
+        axis=dims.index(z_dim),
+        reduction=reduction,
+        units=units,
+        z_interfaces=z_interfaces,
+        rho=rho,
+    )
+
+    if reduction in CLOUD_REDUCTIONS:
+        attrs = dict(units=z_units, long_name=var_name.replace("_", " "))
+    elif reduction == "int":
+        attrs = dict(long_name=f"density-weighted vertical integral of {source_var}")
+        if units in MASS_PATH_UNITS:
+            attrs["units"] = MASS_PATH_UNITS[units]
+        elif units is not None:
+            attrs["units"] = f"{units} kg/m2"
+    else:
+        attrs = dict(long_name=f"column {reduction}imum of {source_var}")
+        if units is not None:
+            attrs["units"] = units
+
+    return xr.DataArray(
+        reduced,
+        dims=[d for d in dims if d != z_dim],
+        coords=dict(coords, time=da_time),
+        name=var_name,
+        attrs=attrs,
+    )
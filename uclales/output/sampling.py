@@ -0,0 +1,348 @@
+"""
+Sampling of variables at arbitrary points, vertical columns or along (t, x, y,
+z) trajectories directly from the per-core output blocks. The samples are
+grouped by the block (and timestep) they fall in and only a small bounding
+box around the samples in each group, or the individual samples if they are
+scattered, are read, i.e. the cost grows with the number of samples rather
+than with the size of the domain
+"""
+import numpy as np
+import xarray as xr
+
+from . import archive, backends
+from .common import _fix_time_units as fix_time_units
+from .layout import BlockLayout, _dim_kind
+
+# the bounding box of a group of samples is read (rather than each sample on
+# its own) if it contains at most this many grid points per sample
+BBOX_POINTS_PER_SAMPLE = 8
+
+
+def _grid_coordinate(layout, dim):
+    """
+    Values of the coordinate `dim` (e.g. `xt` or `zm`) across the full domain.
+    The horizontal grid is uniform so the first block's coordinates are
+    enough to construct these
+    """
+    with archive.open_netcdf(layout.block_path(0, 0)) as fh:
+        values = fh.variables[dim][:]
+    kind = _dim_kind(dim)
+    if kind in ["x", "y"]:
+        n = getattr(layout, f"n{kind}")
+        values = values[0] + (values[1] - values[0]) * np.arange(n)
+    return np.asarray(values)
+
+
+def _nearest_index(coord, positions, dim):
+    """
+    Index of the grid point in `coord` (monotonically increasing) nearest to
+    each of `positions`
+    """
+    positions = np.atleast_1d(np.asarray(positions, dtype=float))
+    dx_first, dx_last = coord[1] - coord[0], coord[-1] - coord[-2]
+    outside = (positions < coord[0] - 0.5 * dx_first) | (
+        positions > coord[-1] + 0.5 * dx_last
+    )
+    if np.any(outside):
+        raise Exception(
+            f"The positions {positions[outside]} are outside the domain along `{dim}`"
+        )
+    idx = np.clip(np.searchsorted(coord, positions), 1, len(coord) - 1)
+    nearer_left = positions - coord[idx - 1] < coord[idx] - positions
+    return np.where(nearer_left, idx - 1, idx)
+
+
+def _read_samples(layout, var_name, sampled, shared=None):
+    """
+    Read `var_name` at the samples given by the (full-domain) index arrays in
+    `sampled` (by dimension kind, e.g. `dict(x=..., y=...)`, all with one
+    entry per sample). The dimensions in `shared` (or otherwise not sampled)
+    are indexed the same for all samples. Samples are grouped by block (and
+    by timestep if `time` is sampled) and for each group either the bounding
+    box of the samples is read (if it has at most `BBOX_POINTS_PER_SAMPLE`
+    points per sample) or each sample is read on its own, so that scattered
+    samples don't make the reads span whole blocks. The result has the
+    sample dimension first followed by the remaining dimensions in the order
+    of the source files
+    """
+    shared = shared or {}
+    with archive.open_netcdf(layout.block_path(0, 0)) as fh:
+        if var_name not in fh.variables:
+            raise KeyError(
+                f"The variable `{var_name}` wasn't found, the following"
+                f" variables are available: {', '.join(fh.variables.keys())}"
+            )
+        var = fh.variables[var_name]
+        dims = var.dimensions
+        dtype = var.dtype
+    kinds = [_dim_kind(d) for d in dims]
+    sampled_kinds = [kind for kind in kinds if kind in sampled]
+    sampled_axes = [n for (n, kind) in enumerate(kinds) if kind in sampled]
+
+    sampled = dict((k, np.asarray(v, dtype=int)) for (k, v) in sampled.items())
+    n_samples = len(next(iter(sampled.values())))
+    offsets = dict(
+        x=(sampled["x"] // layout.block_nx) * layout.block_nx,
+        y=(sampled["y"] // layout.block_ny) * layout.block_ny,
+    )
+    group_keys = [offsets["x"], offsets["y"]]
+    if "time" in sampled:
+        group_keys.append(sampled["time"])
+    _, group = np.unique(np.stack(group_keys, axis=1), axis=0, return_inverse=True)
+    group = np.ravel(group)
+
+    reader = backends.reader()
+    data = None
+    for n in range(group.max() + 1):
+        in_group = np.nonzero(group == n)[0]
+        first = in_group[0]
+        path = layout.block_path(
+            i=int(offsets["x"][first]) // layout.block_nx,
+            j=int(offsets["y"][first]) // layout.block_ny,
+        )
+        # indices within the block
+        local = dict(
+            (kind, sampled[kind][in_group] - offsets[kind][in_group])
+            if kind in offsets
+            else (kind, sampled[kind][in_group])
+            for kind in sampled_kinds
+        )
+        start = dict((kind, idx.min()) for (kind, idx) in local.items())
+        stop = dict((kind, idx.max() + 1) for (kind, idx) in local.items())
+        n_bbox = np.prod([stop[k] - start[k] for k in sampled_kinds])
+
+        if n_bbox <= BBOX_POINTS_PER_SAMPLE * len(in_group):
+            index = tuple(
+                slice(start[kind], stop[kind])
+                if kind in sampled
+                else shared.get(kind, slice(None))
+                for kind in kinds
+            )
+            values = reader.read_variable(path, var_name, index=index)
+            # move the sampled dimensions to the front and pick out the
+            # individual samples from the bounding box
+            values = np.moveaxis(values, sampled_axes, range(len(sampled_axes)))
+            values = values[tuple(local[k] - start[k] for k in sampled_kinds)]
+        else:
+            values = np.stack(
+                [
+                    reader.read_variable(
+                        path,
+                        var_name,
+                        index=tuple(
+                            int(local[kind][m])
+                            if kind in sampled
+                            else shared.get(kind, slice(None))
+                            for kind in kinds
+                        ),
+                    )
+                    for m in range(len(in_group))
+                ]
+            )
+
+        if data is None:
+            data = np.empty((n_samples,) + values.shape[1:], dtype=dtype)
+        data[in_group] = values
+
+    remaining_dims = [d for (d, kind) in zip(dims, kinds) if kind not in sampled]
+    return data, remaining_dims
+
+
+def _time_coord(layout, tns):
+    with archive.open_netcdf(layout.block_path(0, 0)) as fh:
+        da_time = xr.DataArray(
+            fh.variables["time"][tns],
+            dims=("time",) if np.ndim(tns) > 0 else (),
+            attrs=dict(units=fh.variables["time"].units),
+        )
+    return da_time
+
+
+def _var_attrs(layout, var_name):
+    with archive.open_netcdf(layout.block_path(0, 0)) as fh:
+        var = fh.variables[var_name]
+        return dict(
+            (k, var.getncattr(k)) for k in var.ncattrs() if not k.startswith("_")
+        )
+
+
+def _decode(ds):
+    ds["time"], _ = fix_time_units(ds["time"])
+    return xr.decode_cf(ds)
+
+
+def sample_points(source_path, file_prefix, var_names, x, y, z=None, tns=None):
+    """
+    Sample `var_names` at the horizontal positions (`x`, `y`) (in metres)
+    at timesteps `tns` (all timesteps by default), either at heights `z` (one
+    per point) or as full vertical columns (profiles, e.g. for comparison with
+    virtual soundings) if `z` isn't given. Positions are snapped to the
+    nearest grid point of each variable (which may be staggered). Returns a
+    `xr.Dataset` with dimension `point` (and `time`, and the vertical
+    dimension for columns), with the positions of the grid points sampled as
+    coordinates
+    """
+    if isinstance(var_names, str):
+        var_names = [var_names]
+    layout = BlockLayout(source_path=source_path, file_prefix=file_prefix, kind="3d")
+    positions = dict(x=x, y=y)
+    if z is not None:
+        positions["z"] = z
+
+    if tns is None:
+        with archive.open_netcdf(layout.block_path(0, 0)) as fh:
+            tns = list(range(fh.dimensions["time"].size))
+    tns = [int(tn) for tn in tns]
+
+    ds = xr.Dataset(coords=dict(time=_time_coord(layout, tns)))
+    for var_name in var_names:
+        with archive.open_netcdf(layout.block_path(0, 0)) as fh:
+            dims = fh.variables[var_name].dimensions
+        sampled = {}
+        for d in dims:
+            kind = _dim_kind(d)
+            if kind in positions:
+                coord = _grid_coordinate(layout, d)
+                sampled[kind] = _nearest_index(coord, positions[kind], dim=d)
+                ds.coords[f"{var_name}_{d}"] = ("point", coord[sampled[kind]])
+
+        values, remaining_dims = _read_samples(
+            layout, var_name, sampled=sampled, shared=dict(time=tns)
+        )
+        ds[var_name] = xr.DataArray(
+            values, dims=["point"] + remaining_dims, attrs=_var_attrs(layout, var_name)
+        )
+        for d in remaining_dims:
+            if d != "time" and d not in ds.coords:
+                ds.coords[d] = _grid_coordinate(layout, d)
+
+    return _decode(ds)
+
+
+def sample_trajectories(source_path, file_prefix, var_names, tn, x, y, z):
+    """
+    Sample `var_names` along trajectories (e.g. of Lagrangian parcels), with
+    one value returned for each (`tn`, `x`, `y`, `z`) sample (`tn` being the
+    timestep index and the positions in metres). Positions are snapped to the
+    nearest grid point of each variable (which may be staggered). Returns a
+    `xr.Dataset` with dimension `sample`
+    """
+    if isinstance(var_names, str):
+        var_names = [var_names]
+    layout = BlockLayout(source_path=source_path, file_prefix=file_prefix, kind="3d")
+    tn = np.atleast_1d(np.asarray(tn, dtype=int))
+    positions = dict(x=x, y=y, z=z)
+
+    ds = xr.Dataset(coords=dict(time=("sample", _time_coord(layout, tn).values)))
+    ds.time.attrs.update(_time_coord(layout, 0).attrs)
+    for var_name in var_names:
+        with archive.open_netcdf(layout.block_path(0, 0)) as fh:
+            dims = fh.variables[var_name].dimensions
+        sampled = dict(time=tn)
+        for d in dims:
+            kind = _dim_kind(d)
+            if kind in positions:
+                coord = _grid_coordinate(layout, d)
+                sampled[kind] = _nearest_index(coord, positions[kind], dim=d)
+                ds.coords[f"{var_name}_{d}"] = ("sample", coord[sampled[kind]])
+
+        values, _ = _read_samples(layout, var_name, sampled=sampled)
+        ds[var_name] = xr.DataArray(
+            values, dims=["sample"], attrs=_var_attrs(layout, var_name)
+        )
+
+    return _decode(ds)
+
+
+def sample_where(source_path, file_prefix, var_names, where, tns=None, zone_map=None):
+    """
+    Sample `var_names` at every grid point where the predicate `where` (e.g.
+    `"l > 0"`, see `zonemaps.Predicate`) holds, at timesteps `tns` (all
+    timesteps by default). With a `zone_map` (a `zonemaps.ZoneMap` including
+    the predicate variable) only the blocks and bands of levels which could
+    contain matching points are read, otherwise every block is read in full.
+    The variables must be on the same grid as the predicate variable. Returns
+    a `xr.Dataset` with dimension `point`, with the time and the position of
+    each point as coordinates
+    """
+    # imported here since the zone maps are built with the luigi tasks
+    from .zonemaps import Predicate
+
+    if isinstance(var_names, str):
+        var_names = [var_names]
+    predicate = Predicate.parse(where)
+    layout = BlockLayout(source_path=source_path, file_prefix=file_prefix, kind="3d")
+    with archive.open_netcdf(layout.block_path(0, 0)) as fh:
+        dims = fh.variables[predicate.var_name].dimensions
+        for var_name in var_names:
+            if fh.variables[var_name].dimensions != dims:
+                raise Exception(
+                    f"`{var_name}` {fh.variables[var_name].dimensions} isn't on"
+                    f" the same grid as `{predicate.var_name}` {dims}"
+                )
+        if tns is None:
+            tns = list(range(fh.dimensions["time"].size))
+    tns = [int(tn) for tn in tns]
+    kinds = [_dim_kind(d) for d in dims if d != "time"]
+    all_blocks = [(i, j) for i in range(layout.nx_b) for j in range(layout.ny_b)]
+
+    da_time = _time_coord(layout, tns)
+    points = dict((k, []) for k in ["tn", "time"] + kinds)
+    samples = dict((v, []) for v in var_names)
+    for n_tn, tn in enumerate(tns):
+        blocks = all_blocks
+        if zone_map is not None:
+            blocks = zone_map.blocks_matching(predicate, tn=tn)
+        for i, j in blocks:
+            path = layout.block_path(i, j)
+            levels = slice(None)
+            if zone_map is not None and "z" in kinds:
+                levels = zone_map.levels_matching(predicate, i=i, j=j, tn=tn)
+                if len(levels) == 0:
+                    continue
+            index = tuple(
+                tn if d == "time" else (levels if _dim_kind(d) == "z" else slice(None))
+                for d in dims
+            )
+            reader = backends.reader()
+            mask = predicate.evaluate(
+                reader.read_variable(path, predicate.var_name, index=index)
+            )
+            if not np.any(mask):
+                continue
+            local_idx = np.nonzero(mask)
+            offsets = dict(x=i * layout.block_nx, y=j * layout.block_ny)
+            for kind, idx in zip(kinds, local_idx):
+                if kind == "z" and not isinstance(levels, slice):
+                    idx = levels[idx]
+                points[kind].append(idx + offsets.get(kind, 0))
+            points["tn"].append(np.full(len(local_idx[0]), tn))
+            points["time"].append(np.full(len(local_idx[0]), da_time.values[n_tn]))
+            for var_name in var_names:
+                values = reader.read_variable(path, var_name, index=index)
+                samples[var_name].append(values[mask])
+
+    def _concat(arrays, dtype):
+        return np.concatenate(arrays) if len(arrays) > 0 else np.array([], dtype)
+
+    ds = xr.Dataset(
+        coords=dict(
+            time=xr.DataArray(
+                _concat(points["time"], da_time.dtype),
+                dims=("point",),
+                attrs=da_time.attrs,
+            ),
+            tn=("point", _concat(points["tn"], int)),
+        )
+    )
+    for d, kind in zip([d for d in dims if d != "time"], kinds):
+        coord = _grid_coordinate(layout, d)
+        ds.coords[d] = ("point", coord[_concat(points[kind], int)])
+    for var_name in var_names:
+        ds[var_name] = xr.DataArray(
+            _concat(samples[var_name], np.float64),
+            dims=["point"],
+            attrs=_var_attrs(layout, var_name),
+        )
+    ds.attrs["where"] = str(predicate)
+    return _decode(ds)
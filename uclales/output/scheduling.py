@@ -0,0 +1,93 @@
+"""
+Memory-budget aware scheduling of the extraction tasks. Each task declares its
+estimated peak memory use (from the block shape, dtype and extraction stage,
+see `planner.estimate_stage_memory`) as a luigi resource, so that when a
+memory budget is given (with `--memory-budget` or `budget` in the `[memory]`
+section of `luigi.cfg`) the scheduler only runs tasks concurrently while
+their total estimated memory use stays within the budget. Small block tasks
+are then packed around the large merge tasks rather than the number of
+workers having to be chosen for the worst case
+"""
+import math
+import re
+
+import luigi
+
+# name of the luigi resource the memory use (in MB) is accounted in
+MEMORY_RESOURCE = "memory_mb"
+
+_UNITS = dict(B=1.0 / 1024**2, KB=1.0 / 1024, MB=1, GB=1024, TB=1024**2)
+
+
+class memory(luigi.Config):
+    """
+    Memory budget for running extraction tasks concurrently, e.g. `16GB` (a
+    plain number is taken to be in MB). Set in the `[memory]` section of
+    `luigi.cfg` or with `--memory-budget` on the command line
+    """
+
+    budget = luigi.OptionalParameter(default=None)
+
+
+def parse_memory(value):
+    """
+    "16GB" -> 16384 (MB)
+    """
+    m = re.match(r"^\s*([\d.]+)\s*([KMGT]?B)?\s*$", str(value), re.IGNORECASE)
+    if m is None:
+        raise ValueError(f"Couldn't parse memory amount `{value}`, e.g. use `16GB`")
+    amount, unit = m.groups()
+    return int(float(amount) * _UNITS[(unit or "MB").upper()])
+
+
+def memory_budget():
+    """
+    Memory budget in MB, or `None` if no budget has been set
+    """
+    budget = memory().budget
+    if budget is None:
+        return None
+    return parse_memory(budget)
+
+
+def register_memory_budget():
+    """
+    Make the memory budget available to the luigi scheduler as the amount of
+    the `MEMORY_RESOURCE` resource. This must happen before the scheduler is
+    created, which for the local scheduler happens after the root task has
+    been instantiated. With a central scheduler (`luigid`) the budget must
+    instead be set as `memory_mb` in the `[resources]` section of the
+    scheduler's configuration
+    """
+    budget = memory_budget()
+    if budget is None:
+        return
+    luigi.configuration.get_config().set("resources", MEMORY_RESOURCE, str(budget))
+
+
+class MemoryBudgetMixin:
+    """
+    Mixin for luigi tasks which declares the task's estimated peak memory
+    use (returned in bytes by `estimate_peak_memory`, `None` if the task
+    doesn't use significant memory) as a luigi resource when a memory budget
+    has been set. Tasks estimated to need more than the whole budget are
+    capped to the budget so that they run on their own
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        register_memory_budget()
+
+    def estimate_peak_memory(self):
+        return None
+
+    @property
+    def resources(self):
+        budget = memory_budget()
+        if budget is None:
+            return {}
+        nbytes = self.estimate_peak_memory()
+        if nbytes is None:
+            return {}
+        amount = math.ceil(nbytes / 1024**2)
+        return {MEMORY_RESOURCE: max(1, min(amount, budget))}
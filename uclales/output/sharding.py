@@ -0,0 +1,162 @@
+"""
+Sharded extraction for running across multiple nodes (for example as a job
+array) without a central luigi scheduler. The strips (or blocks) for all the
+variables and timesteps requested are split deterministically into `N`
+shards, each job extracts one shard (`ExtractShard` with `shard="K/N"`) and
+writes a marker file when done. `AssembleShards` can then be run on any node,
+it checks that all markers exist before merging the strips (or blocks) into
+the full-domain output
+"""
+import hashlib
+import json
+from pathlib import Path
+
+import luigi
+
+from .extraction import Extract
+from .scheduling import MemoryBudgetMixin
+
+SHARDS_PATH = Path("partials/shards")
+SHARD_MARKER_FILENAME_FORMAT = "{file_prefix}.{spec_hash}.shard{k:04d}of{n:04d}.done"
+
+
+def _parse_shard(shard):
+    """
+    "K/N" -> (K, N)
+    """
+    try:
+        k, n = [int(v) for v in shard.split("/")]
+    except ValueError:
+        raise ValueError(f"`shard` should be given as `K/N`, not `{shard}`")
+    if not 0 <= k < n:
+        raise ValueError(f"Shard index {k} should be in [0, {n})")
+    return k, n
+
+
+class _ShardedExtractionBase(MemoryBudgetMixin, luigi.Task):
+    """
+    Parameters shared by the shard extraction and assembly tasks. `tns` are
+    the timesteps to extract (for 2D extraction this should be left empty)
+    """
+
+    file_prefix = luigi.Parameter()
+    var_names = luigi.ListParameter()
+    tns = luigi.ListParameter(default=[])
+    kind = luigi.Parameter()
+    mode = luigi.Parameter(default="y_strips")
+    source_path = luigi.Parameter(default=".")
+    dest_path = luigi.OptionalParameter(default=".")
+    orientation = luigi.OptionalParameter(default=None)
+    use_cdo = luigi.BoolParameter(default=True)
+
+    def _extract_tasks(self):
+        if self.mode == "auto":
+            # the available memory (and so the planned mode) may differ
+            # between nodes, but all shards must agree on the work split
+            raise NotImplementedError(
+                "The extraction mode must be set explicitly for sharded extraction"
+            )
+
+        tns = list(self.tns) if len(self.tns) > 0 else [None]
+        return [
+            Extract(
+                file_prefix=self.file_prefix,
+                var_name=var_name,
+                tn=tn,
+                kind=self.kind,
+                mode=self.mode,
+                source_path=self.source_path,
+                dest_path=self.dest_path,
+                orientation=self.orientation,
+                use_cdo=self.use_cdo,
+            )
+            for var_name in self.var_names
+            for tn in tns
+        ]
+
+    def _spec_hash(self):
+        """
+        Short hash identifying the work being split into shards so that
+        markers from different extractions don't get mixed up
+        """
+        spec = dict(
+            var_names=list(self.var_names),
+            tns=[str(tn) for tn in self.tns],
+            kind=self.kind,
+            mode=self.mode,
+            orientation=self.orientation,
+            use_cdo=self.use_cdo,
+            source_path=str(self.source_path),
+        )
+        return hashlib.sha1(json.dumps(spec, sort_keys=True).encode()).hexdigest()[:8]
+
+    def _marker_target(self, k, n):
+        fn = SHARD_MARKER_FILENAME_FORMAT.format(
+            file_prefix=self.file_prefix, spec_hash=self._spec_hash(), k=k, n=n
+        )
+        return luigi.LocalTarget(str(Path(self.dest_path) / SHARDS_PATH / fn))
+
+
+class ExtractShard(_ShardedExtractionBase):
+    """
+    Extract the `K`'th of `N` shards (given as `shard="K/N"`) of the strips
+    (or blocks with `mode="blocks"`) needed for extracting all `var_names` at
+    all timesteps `tns`. The work units are assigned to shards round-robin in
+    a fixed order, so that every job in an `N`-way job array works on a
+    different subset. A marker file is written once the shard is complete
+    """
+
+    shard = luigi.Parameter()
+
+    def requires(self):
+        k, n = _parse_shard(self.shard)
+        units = []
+        for task in self._extract_tasks():
+            units += task.merge_task().requires()["parts"]
+        return units[k::n]
+
+    def run(self):
+        with self.output().open("w") as fh:
+            json.dump([inp.path for inp in self.input()], fh, indent=2)
+
+    def output(self):
+        return self._marker_target(*_parse_shard(self.shard))
+
+
+class ShardMarker(luigi.ExternalTask):
+    """
+    Marker file written when a shard has been extracted (possibly on another
+    node)
+    """
+
+    path = luigi.Parameter()
+
+    def output(self):
+        return luigi.LocalTarget(self.path)
+
+
+class AssembleShards(_ShardedExtractionBase):
+    """
+    Once all `n_shards` shards (see `ExtractShard`) have been extracted,
+    merge the strips (or blocks) into the full-domain output for each
+    variable and timestep
+    """
+
+    n_shards = luigi.IntParameter()
+
+    def requires(self):
+        return [
+            ShardMarker(path=self._marker_target(k, self.n_shards).path)
+            for k in range(self.n_shards)
+        ]
+
+    def run(self):
+        # only scheduled as dynamic dependencies once all the shard markers
+        # exist, so that we never start extracting strips on this node
+        yield self._extract_tasks()
+
+    def complete(self):
+        return all(task.complete() for task in self._extract_tasks())
+
+    def output(self):
+        return [task.merge_task().output() for task in self._extract_tasks()]
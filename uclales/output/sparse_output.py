@@ -0,0 +1,202 @@
+"""
+Sparse storage of mostly-zero fields (e.g. the condensate fields `l` and `r`,
+which are zero outside of clouds), so that disk use and read time scale with
+the amount of cloud rather than the size of the domain. Only the nonzero
+values are stored in a netCDF file, in one of two layouts:
+
+- `coo`: every nonzero value with its index along each dimension (as
+  `{dim}_index`), along a `nnz` dimension
+- `blocks`: the horizontal tiles of `tile_size` x `tile_size` points (with
+  all other dimensions in full) containing any nonzero values, along a `tile`
+  dimension, with the index of the first point of each tile (as `{dim}_tile`).
+  Larger, but faster to read back for fields with extended clouds
+
+The dimensions, coordinates and attributes of the dense field are kept, so
+that `open_sparse` can give back the dense `xr.DataArray` (or one wrapping a
+`sparse.COO` array, which requires the optional `sparse` package)
+"""
+import numpy as np
+import xarray as xr
+
+from .layout import _dim_kind
+
+SPARSE_LAYOUTS = ["coo", "blocks"]
+DEFAULT_TILE_SIZE = 16
+
+
+def _horizontal_axes(dims):
+    axes = dict((_dim_kind(d), n) for (n, d) in enumerate(dims))
+    if "x" not in axes or "y" not in axes:
+        raise NotImplementedError(
+            f"The `blocks` layout needs both horizontal dimensions, not {dims}"
+        )
+    return axes["y"], axes["x"]
+
+
+def _encode_coo(values, dims, y_offset=0):
+    idx = list(np.nonzero(values))
+    ax_y = _slab_axis(dims)
+    if ax_y is not None:
+        idx[ax_y] = idx[ax_y] + y_offset
+    data_vars = dict(
+        (f"{d}_index", ("nnz", i.astype(np.int32))) for (d, i) in zip(dims, idx)
+    )
+    return data_vars, ("nnz", values[np.nonzero(values)])
+
+
+def _encode_blocks(values, dims, tile_size, y_offset=0):
+    ax_y, ax_x = _horizontal_axes(dims)
+    rest = [d for (n, d) in enumerate(dims) if n not in (ax_y, ax_x)]
+    v = np.moveaxis(values, [ax_y, ax_x], [0, 1])
+    ny, nx = v.shape[:2]
+    nty, ntx = -(-ny // tile_size), -(-nx // tile_size)
+    # pad to a whole number of tiles
+    pad = [(0, nty * tile_size - ny), (0, ntx * tile_size - nx)]
+    v = np.pad(v, pad + [(0, 0)] * (v.ndim - 2))
+    tiles = v.reshape((nty, tile_size, ntx, tile_size) + v.shape[2:])
+    tiles = np.moveaxis(tiles, 2, 1).reshape(
+        (nty * ntx, tile_size, tile_size) + v.shape[2:]
+    )
+    nonzero = np.any(tiles != 0, axis=tuple(range(1, tiles.ndim)))
+    ty, tx = np.divmod(np.nonzero(nonzero)[0], ntx)
+    y_dim, x_dim = dims[ax_y], dims[ax_x]
+    data_vars = {
+        f"{y_dim}_tile": ("tile", (ty * tile_size + y_offset).astype(np.int32)),
+        f"{x_dim}_tile": ("tile", (tx * tile_size).astype(np.int32)),
+    }
+    tile_dims = ["tile", f"{y_dim}_in_tile", f"{x_dim}_in_tile"] + rest
+    return data_vars, (tile_dims, tiles[nonzero])
+
+
+def _slab_axis(dims):
+    kinds = [_dim_kind(d) for d in dims]
+    return kinds.index("y") if "y" in kinds else None
+
+
+def _slabs(da, slab_size):
+    """
+    Values of `da` in slabs of `slab_size` along `y` (all at once if `da`
+    has no `y` dimension or `slab_size` isn't given), with the offset of each
+    slab along `y`
+    """
+    ax_y = _slab_axis(da.dims)
+    if ax_y is None or slab_size is None:
+        yield 0, np.asarray(da.values)
+        return
+    y_dim = da.dims[ax_y]
+    for y_start in range(0, da.sizes[y_dim], slab_size):
+        da_slab = da.isel({y_dim: slice(y_start, y_start + slab_size)})
+        yield y_start, np.asarray(da_slab.values)
+
+
+def to_sparse_dataset(da, layout="coo", tile_size=DEFAULT_TILE_SIZE, slab_size=None):
+    """
+    Encode `da` with only its nonzero values stored, in `layout` (see
+    `SPARSE_LAYOUTS`). With `slab_size` set (rounded up to a whole number of
+    tiles) `da` is read and encoded `slab_size` points along `y` at a time,
+    so that a lazily opened field is never held in memory in full
+    """
+    if layout not in SPARSE_LAYOUTS:
+        raise NotImplementedError(
+            f"Unknown sparse layout `{layout}`, available are: "
+            f"{', '.join(SPARSE_LAYOUTS)}"
+        )
+    dims = list(da.dims)
+    if slab_size is not None:
+        slab_size = tile_size * max(1, -(-slab_size // tile_size))
+
+    parts = []
+    for y_offset, values in _slabs(da, slab_size):
+        if layout == "coo":
+            parts.append(_encode_coo(values, dims, y_offset=y_offset))
+        else:
+            parts.append(_encode_blocks(values, dims, tile_size, y_offset=y_offset))
+    data_vars = dict(
+        (k, (v_dims, np.concatenate([p[0][k][1] for p in parts])))
+        for (k, (v_dims, _)) in parts[0][0].items()
+    )
+    var = (parts[0][1][0], np.concatenate([p[1][1] for p in parts]))
+
+    # keep the coordinates of the dense field for decoding
+    coords = dict((d, da[d]) for d in dims if d in da.coords)
+    ds = xr.Dataset(data_vars, coords=coords)
+    ds[da.name] = var
+    ds[da.name].attrs.update(da.attrs)
+    ds[da.name].attrs.update(
+        sparse_layout=layout,
+        sparse_dims=" ".join(dims),
+        sparse_shape=list(da.shape),
+        sparse_fill_value=0,
+    )
+    if layout == "blocks":
+        ds[da.name].attrs["sparse_tile_size"] = tile_size
+    return ds
+
+
+def _decode_indices(ds, name):
+    """
+    Index along each dense dimension of each stored value of `name`, and the
+    values
+    """
+    attrs = ds[name].attrs
+    dims = attrs["sparse_dims"].split()
+    if attrs["sparse_layout"] == "coo":
+        idx = tuple(ds[f"{d}_index"].values for d in dims)
+        return idx, ds[name].values
+
+    ax_y, ax_x = _horizontal_axes(dims)
+    shape = list(np.atleast_1d(attrs["sparse_shape"]))
+    tiles = ds[name].values
+    ty = ds[f"{dims[ax_y]}_tile"].values
+    tx = ds[f"{dims[ax_x]}_tile"].values
+    # indices within the tiles of the nonzero values, `n` is the tile
+    n, *local = np.nonzero(tiles)
+    y = ty[n] + local[0]
+    x = tx[n] + local[1]
+    values = tiles[(n, *local)]
+    # drop the padding past the edges of the domain
+    inside = (y < shape[ax_y]) & (x < shape[ax_x])
+    rest = iter(local[2:])
+    idx = []
+    for ax in range(len(dims)):
+        if ax == ax_y:
+            idx.append(y[inside])
+        elif ax == ax_x:
+            idx.append(x[inside])
+        else:
+            idx.append(next(rest)[inside])
+    return tuple(idx), values[inside]
+
+
+def open_sparse(path, as_sparse=False):
+    """
+    Open the sparse field stored in `path` (see `to_sparse_dataset`) as a
+    dense `xr.DataArray`, or with `as_sparse` as a `xr.DataArray` wrapping a
+    `sparse.COO` array (requires the `sparse` package)
+    """
+    with xr.open_dataset(path) as ds:
+        ds = ds.load()
+    names = [v for v in ds.data_vars if "sparse_layout" in ds[v].attrs]
+    if len(names) != 1:
+        raise Exception(f"`{path}` doesn't contain a single sparse field")
+    name = names[0]
+    attrs = dict(ds[name].attrs)
+    dims = attrs["sparse_dims"].split()
+    shape = tuple(np.atleast_1d(attrs["sparse_shape"]))
+    idx, values = _decode_indices(ds, name)
+
+    if as_sparse:
+        try:
+            import sparse
+        except ImportError:
+            raise ImportError("Opening as a sparse array requires the `sparse` module")
+        data = sparse.COO(np.stack(idx), values, shape=shape, fill_value=0)
+    else:
+        data = np.zeros(shape, dtype=values.dtype)
+        data[idx] = values
+
+    for k in list(attrs):
+        if k.startswith("sparse_"):
+            del attrs[k]
+    coords = dict((d, ds[d]) for d in dims if d in ds.coords)
+    return xr.DataArray(data, dims=dims, coords=coords, name=name, attrs=attrs)
@@ -0,0 +1,459 @@
+"""
+Temporal statistics (time-mean, variance and covariances, e.g. `w'q'`) over
+all timesteps of the 3D output computed directly from the per-core blocks.
+Each block's timesteps are streamed through once (with the reads done ahead
+by `pipeline.PrefetchingReader`) and accumulated with Welford's numerically
+stable online algorithm, so that the statistics for all blocks are computed
+in parallel without first extracting every timestep to a full-domain file.
+Only the final statistics fields are stitched together.
+
+Conditional statistics (e.g. of points with `l > 0`) are computed with
+`where`, only including the values where the predicate holds. The zone map of
+the predicate variable (see `zonemaps`) is used to only read the timesteps
+and levels (and blocks) which could contain matching values
+"""
+import functools
+import logging
+from pathlib import Path
+
+import luigi
+import numpy as np
+import xarray as xr
+
+from . import archive, backends
+from .common import _build_path, _find_number_of_blocks
+from .extraction import UCLALESOutputBlock, XArrayTarget
+from .layout import _dim_kind
+from .pipeline import PrefetchingReader, pipeline
+from .planner import block_variable_nbytes
+from .scheduling import MemoryBudgetMixin
+from .zonemaps import BuildZoneMap, Predicate, ZoneMap
+
+logger = logging.getLogger(__name__)
+
+
+class RunningMoments:
+    """
+    Running mean and variance of each of `var_names` and the covariance of
+    each pair in `covariances`, updated one sample (e.g. timestep) at a time
+    with Welford's algorithm. The values for the variables of a covariance
+    pair must have the same shape, and are paired index by index (so for
+    example `w` on the `zm` levels is paired with `q` on `zt`). With a `mask`
+    only the values where it is set are included in an update, so that the
+    number of samples (`count`) may differ between points
+    """
+
+    def __init__(self, var_names, covariances=()):
+        self.covariances = [tuple(pair) for pair in covariances]
+        self.var_names = list(var_names)
+        for pair in self.covariances:
+            for v in pair:
+                if v not in self.var_names:
+                    self.var_names.append(v)
+        self.n = 0
+        self.mean = {}
+        self._m2 = {}
+        self._c = {}
+        self._count = {}
+
+    def update(self, values, mask=None):
+        """
+        Add one sample, `values` being a dict of variable name -> array and
+        `mask` an optional boolean array (of the same shape as the values)
+        selecting the values to include
+        """
+        self.n += 1
+        deltas = {}
+        for v in self.var_names:
+            x = np.asarray(values[v], dtype=np.float64)
+            if self.n == 1:
+                self.mean[v] = np.zeros_like(x)
+                self._m2[v] = np.zeros_like(x)
+                self._count[v] = np.zeros(x.shape, dtype=np.int64)
+            if mask is None:
+                self._count[v] += 1
+                deltas[v] = x - self.mean[v]
+                self.mean[v] += deltas[v] / self._count[v]
+            else:
+                if mask.shape != x.shape:
+                    raise Exception(
+                        f"The mask {mask.shape} and `{v}` {x.shape} differ in shape"
+                    )
+                self._count[v] += mask
+                deltas[v] = np.where(mask, x - self.mean[v], 0.0)
+                self.mean[v] += np.divide(
+                    deltas[v], self._count[v], out=np.zeros_like(x), where=mask
+                )
+            self._m2[v] += deltas[v] * (x - self.mean[v])
+
+        for a, b in self.covariances:
+            if deltas[a].shape != deltas[b].shape:
+                raise Exception(
+                    f"Can't compute the covariance of `{a}` {deltas[a].shape}"
+                    f" and `{b}` {deltas[b].shape} which differ in shape"
+                )
+            if self.n == 1:
+                self._c[(a, b)] = np.zeros_like(deltas[a])
+            # uses the mean of `b` after the update
+            self._c[(a, b)] += deltas[a] * (
+                np.asarray(values[b], dtype=np.float64) - self.mean[b]
+            )
+
+    def count(self, var_name):
+        return self._count[var_name]
+
+    def _normalise(self, values, var_name, ddof):
+        n = self._count[var_name] - ddof
+        out = np.full_like(values, np.nan)
+        return np.divide(values, n, out=out, where=n > 0)
+
+    def variance(self, var_name, ddof=0):
+        return self._normalise(self._m2[var_name], var_name, ddof)
+
+    def covariance(self, var_a, var_b, ddof=0):
+        return self._normalise(self._c[(var_a, var_b)], var_a, ddof)
+
+
+def _stats_name(var_names, covariances, where=None):
+    """
+    e.g. `w-q.cov-w_q` for the statistics of `w` and `q` and the covariance
+    of `w` and `q` (and `w.where-l_gt_0` for the statistics of `w` where
+    `l > 0`)
+    """
+    name = "-".join(var_names)
+    if len(covariances) > 0:
+        name += ".cov-" + "-".join(f"{a}_{b}" for (a, b) in covariances)
+    if where is not None:
+        name += ".where-" + Predicate.parse(where).slug
+    return name
+
+
+def _read_timestep(path, var_dims, item):
+    """
+    Read the variables in `var_dims` (variable name -> dimensions) from the
+    block at `path` for `item`, a tuple of the timestep and the slice of
+    levels to read. The block is opened once for all the variables
+    """
+    tn, z_slice = item
+    indices = dict(
+        (
+            v,
+            tuple(
+                tn if d == "time" else z_slice if _dim_kind(d) == "z" else slice(None)
+                for d in dims
+            ),
+        )
+        for (v, dims) in var_dims.items()
+    )
+    return backends.reader().read_variables(path, indices)
+
+
+def _level_range(levels):
+    """
+    The slice of levels spanning all of `levels`
+    """
+    return slice(int(np.min(levels)), int(np.max(levels)) + 1)
+
+
+def _expand_levels(values, shape, z_axis, z_slice, fill_value):
+    """
+    Place `values` read for the levels `z_slice` (along `z_axis`) into an
+    array of the full `shape` filled with `fill_value` elsewhere
+    """
+    if z_slice == slice(None):
+        return values
+    full = np.full(shape, fill_value, dtype=values.dtype)
+    index = [slice(None)] * len(shape)
+    index[z_axis] = z_slice
+    full[tuple(index)] = values
+    return full
+
+
+class _TemporalStatisticsBase(MemoryBudgetMixin, luigi.Task):
+    file_prefix = luigi.Parameter()
+    source_path = luigi.Parameter(default=".")
+    var_names = luigi.ListParameter()
+    covariances = luigi.ListParameter(default=[])
+    where = luigi.OptionalParameter(default=None)
+    dest_path = luigi.OptionalParameter(default=".")
+
+    def _all_var_names(self):
+        return RunningMoments(self.var_names, self.covariances).var_names
+
+    def _stats_name(self):
+        return _stats_name(self.var_names, self.covariances, where=self.where)
+
+    def requires_zone_map(self):
+        return BuildZoneMap(
+            file_prefix=self.file_prefix,
+            source_path=self.source_path,
+            var_names=[Predicate.parse(self.where).var_name],
+            dest_path=self.dest_path,
+        )
+
+    def _block_nbytes(self):
+        """
+        Size of a single timestep of (the first of) `var_names` in one block,
+        as stored and when accumulated in double precision
+        """
+        nbytes, _ = block_variable_nbytes(
+            source_path=self.source_path,
+            file_prefix=self.file_prefix,
+            var_name=self.var_names[0],
+            kind="3d",
+        )
+        with archive.open_netcdf(self.requires_block(0, 0).output().path) as fh:
+            itemsize = fh.variables[self.var_names[0]].dtype.itemsize
+        return nbytes, nbytes * 8 // itemsize
+
+    def _n_fields(self):
+        return 2 * len(self.var_names) + len(self.covariances)
+
+    def requires_block(self, i, j):
+        return UCLALESOutputBlock(
+            file_prefix=self.file_prefix,
+            i=i,
+            j=j,
+            source_path=self.source_path,
+            kind="3d",
+        )
+
+
+class UCLALESBlockTemporalStatistics(_TemporalStatisticsBase):
+    """
+    Compute the time-mean and variance of `var_names` and the covariances of
+    the pairs in `covariances` over all timesteps of one 3D output block,
+    reading each timestep once
+
+    {file_prefix}.{i:04d}{j:04d}.nc -> {file_prefix}.{i:04d}{j:04d}.{stats_name}.stats.nc
+    rico.00010002.nc -> rico.00010002.w-q.cov-w_q.stats.nc
+    for the statistics of w and q and the covariance of w and q
+    """
+
+    i = luigi.IntParameter()
+    j = luigi.IntParameter()
+
+    def requires(self):
+        tasks = dict(block=self.requires_block(i=self.i, j=self.j))
+        if self.where is not None:
+            tasks["zone_map"] = self.requires_zone_map()
+        return tasks
+
+    def estimate_peak_memory(self):
+        nbytes, acc_nbytes = self._block_nbytes()
+        n_vars = len(self._all_var_names())
+        # the accumulators and the timesteps read ahead
+        n_acc = 2 * n_vars + len(self.covariances)
+        n_read = n_vars * (1 + pipeline().depth)
+        return n_acc * acc_nbytes + n_read * nbytes
+
+    def run(self):
+        path = self.input()["block"].path
+        var_names = self._all_var_names()
+        predicate = None
+        if self.where is not None:
+            predicate = Predicate.parse(self.where)
+            if predicate.var_name not in var_names:
+                var_names = var_names + [predicate.var_name]
+        with archive.open_netcdf(path) as fh:
+            nt = fh.dimensions["time"].size
+            source_dims = {}
+            var_dims = {}
+            var_attrs = {}
+            for v in var_names:
+                var = fh.variables[v]
+                source_dims[v] = var.dimensions
+                var_dims[v] = [d for d in var.dimensions if d != "time"]
+                var_attrs[v] = dict(
+                    (k, var.getncattr(k))
+                    for k in var.ncattrs()
+                    if not k.startswith("_")
+                )
+            coords = dict(
+                (d, np.asarray(fh.variables[d][:]))
+                for v in var_names
+                for d in var_dims[v]
+                if d in fh.variables
+            )
+            shapes = dict(
+                (v, tuple(fh.dimensions[d].size for d in var_dims[v]))
+                for v in var_names
+            )
+
+        tns = range(nt)
+        if predicate is not None:
+            # the mask from the predicate is applied point-wise, so it must be
+            # on the same grid as all the variables
+            for v in self._all_var_names():
+                if var_dims[v] != var_dims[predicate.var_name]:
+                    raise Exception(
+                        f"`{v}` {tuple(var_dims[v])} isn't on the same grid as"
+                        f" `{predicate.var_name}`"
+                        f" {tuple(var_dims[predicate.var_name])}"
+                    )
+            # skip the timesteps where the block can't contain matching values
+            zone_map = ZoneMap(self.input()["zone_map"].path)
+            tns = zone_map.timesteps_matching(predicate, i=self.i, j=self.j)
+
+        # at each timestep only the range of levels which could contain
+        # matching values is read, the values elsewhere are excluded
+        z_axes = []
+        if predicate is not None:
+            z_axes = [
+                n
+                for (n, d) in enumerate(var_dims[predicate.var_name])
+                if _dim_kind(d) == "z"
+            ]
+        items = []
+        for tn in tns:
+            z_slice = slice(None)
+            if len(z_axes) > 0:
+                z_slice = _level_range(
+                    zone_map.levels_matching(predicate, i=self.i, j=self.j, tn=tn)
+                )
+            items.append((tn, z_slice))
+
+        moments = RunningMoments(self.var_names, self.covariances)
+        # the timesteps are all read from the same file, and HDF5 isn't
+        # thread-safe, so only a single reader is used to read ahead while
+        # the statistics are being accumulated
+        reader = PrefetchingReader(
+            read_fn=functools.partial(_read_timestep, path, source_dims),
+            items=items,
+            n_readers=1,
+        )
+        for (_, z_slice), values in reader:
+            mask = None
+            if predicate is not None:
+                mask = predicate.evaluate(values[predicate.var_name])
+                if z_slice != slice(None):
+                    z_axis = z_axes[0]
+                    values = dict(
+                        (v, _expand_levels(x, shapes[v], z_axis, z_slice, 0))
+                        for (v, x) in values.items()
+                    )
+                    mask = _expand_levels(
+                        mask, shapes[predicate.var_name], z_axis, z_slice, False
+                    )
+            moments.update(values, mask=mask)
+        logger.debug(reader.metrics)
+
+        if moments.n == 0:
+            # no timesteps could match the predicate, add an empty sample so
+            # that the statistics are set (to `nan`, with a count of zero)
+            moments.update(
+                dict((v, np.zeros(shapes[v])) for v in var_names),
+                mask=np.zeros(shapes[predicate.var_name], dtype=bool),
+            )
+        counts = dict((v, moments.count(v)) for v in self.var_names)
+        means = dict(
+            (v, np.where(counts[v] > 0, moments.mean[v], np.nan))
+            for v in self.var_names
+        )
+
+        ds = xr.Dataset(coords=coords)
+        for v in self.var_names:
+            units = var_attrs[v].get("units")
+            ds[f"{v}_mean"] = xr.DataArray(
+                means[v],
+                dims=var_dims[v],
+                attrs=dict(var_attrs[v], long_name=f"time-mean of {v}"),
+            )
+            ds[f"{v}_variance"] = xr.DataArray(
+                moments.variance(v),
+                dims=var_dims[v],
+                attrs=dict(long_name=f"temporal variance of {v}"),
+            )
+            if units is not None:
+                ds[f"{v}_variance"].attrs["units"] = f"({units})^2"
+            if predicate is not None:
+                ds[f"{v}_count"] = xr.DataArray(
+                    counts[v],
+                    dims=var_dims[v],
+                    attrs=dict(long_name=f"number of samples where {predicate}"),
+                )
+        for a, b in self.covariances:
+            ds[f"{a}_{b}_covariance"] = xr.DataArray(
+                moments.covariance(a, b),
+                dims=var_dims[a],
+                attrs=dict(long_name=f"temporal covariance of {a} and {b}"),
+            )
+        if predicate is None:
+            ds.attrs["n_timesteps"] = moments.n
+        else:
+            # the number of timesteps read differs between blocks, the number
+            # of samples at each point is given by the `*_count` variables
+            ds.attrs["where"] = str(predicate)
+
+        Path(self.output().path).parent.mkdir(exist_ok=True, parents=True)
+        backends.writer().write_dataset(ds, self.output().path)
+
+    def output(self):
+        p = _build_path(
+            file_prefix=self.file_prefix,
+            data_stage="block_statistics",
+            data_kind="3d",
+            i=self.i,
+            j=self.j,
+            stats_name=self._stats_name(),
+            dest_path=self.dest_path,
+        )
+        return XArrayTarget(str(p))
+
+
+class ExtractTemporalStatistics(_TemporalStatisticsBase):
+    """
+    Stitch together the temporal statistics (time-mean and variance of
+    `var_names` and covariances of the pairs in `covariances`) computed for
+    each 3D output block into full-domain fields
+
+    rico.00000000.nc, ... -> rico.w-q.cov-w_q.stats.nc
+    for the statistics of w and q and the covariance of w and q
+    """
+
+    def requires(self):
+        nx_b, ny_b = _find_number_of_blocks(
+            source_path=self.source_path, file_prefix=self.file_prefix, kind="3d"
+        )
+        return [
+            UCLALESBlockTemporalStatistics(
+                file_prefix=self.file_prefix,
+                source_path=self.source_path,
+                var_names=self.var_names,
+                covariances=self.covariances,
+                where=self.where,
+                dest_path=self.dest_path,
+                i=i,
+                j=j,
+            )
+            for i in range(nx_b)
+            for j in range(ny_b)
+        ]
+
+    def estimate_peak_memory(self):
+        nx_b, ny_b = _find_number_of_blocks(
+            source_path=self.source_path, file_prefix=self.file_prefix, kind="3d"
+        )
+        # blocks and merged fields held at the same time
+        _, acc_nbytes = self._block_nbytes()
+        return 2 * nx_b * ny_b * self._n_fields() * acc_nbytes
+
+    def run(self):
+        datasets = [target.open() for target in self.input()]
+        ds = xr.combine_by_coords(datasets, combine_attrs="override")
+        # keep the dimension ordering of the source blocks
+        for name, da in datasets[0].data_vars.items():
+            ds[name] = ds[name].transpose(*da.dims)
+
+        Path(self.output().path).parent.mkdir(exist_ok=True, parents=True)
+        backends.writer().write_dataset(ds, self.output().path)
+
+    def output(self):
+        p = _build_path(
+            file_prefix=self.file_prefix,
+            data_stage="temporal_statistics",
+            data_kind="3d",
+            stats_name=self._stats_name(),
+            dest_path=self.dest_path,
+        )
+        return XArrayTarget(str(p))
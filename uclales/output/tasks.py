@@ -0,0 +1,12 @@
+"""
+All the luigi tasks, imported so that they can be found by name when running
+them with `python -m luigi --module uclales.output.tasks <task> ...`
+(`uclales.output` itself only imports these on first use)
+"""
+from .cross_sections import ExtractVerticalCrossSection  # noqa
+from .ensemble import ExtractEnsemble  # noqa
+from .extraction import Extract  # noqa
+from .sharding import AssembleShards, ExtractShard  # noqa
+from .statistics import ExtractTemporalStatistics  # noqa
+from .timeseries import ExtractTimeSeriesStore  # noqa
+from .zonemaps import BuildZoneMap  # noqa
@@ -0,0 +1,365 @@
+"""
+Time-contiguous store of a variable for fast access to the time history at
+points or small regions. The extracted output (and the source blocks) are
+stored one timestep at a time, so reading the history of a single column
+means opening every timestep. Here a variable is instead rechunked into a
+single netCDF file chunked as all timesteps x a small horizontal tile x all
+levels, so that a time-series query only reads the few chunks covering it.
+
+The rechunk is done out-of-core in two passes with bounded memory: first
+batches of timesteps (as many as fit in the memory limit, or slabs of rows of
+a single timestep for large domains) are read from the source and written as complete chunks (of the batch of timesteps) to an
+intermediate file (with the next batches read while the previous ones are
+written, see `pipeline.run_pipeline`), and then groups of tiles are read for all timesteps from
+the intermediate file and written as the final (complete) chunks. Every chunk
+is written once in whole, rather than every timestep touching every chunk
+"""
+import functools
+import logging
+import os
+from pathlib import Path
+
+import luigi
+import netCDF4
+import numpy as np
+
+from . import archive
+from .common import _build_path, _find_number_of_blocks
+from .common import _fix_time_units as fix_time_units
+from .extraction import Extract, UCLALESOutputBlock, XArrayTarget
+from .layout import BlockLayout, _dim_kind
+from .pipeline import pipeline, run_pipeline
+from .scheduling import MemoryBudgetMixin, parse_memory
+
+logger = logging.getLogger(__name__)
+
+SOURCES = ["blocks", "extracted"]
+
+
+class _BlockSource:
+    """
+    Read `var_name` for a range of timesteps directly from the source blocks
+    """
+
+    def __init__(self, source_path, file_prefix, var_name):
+        self.layout = BlockLayout(source_path=source_path, file_prefix=file_prefix)
+        self.var_name = var_name
+        with archive.open_netcdf(self.layout.block_path(0, 0)) as fh:
+            var = fh.variables[var_name]
+            self.dims = var.dimensions
+            self.dtype = var.dtype
+            self.attrs = dict(
+                (k, var.getncattr(k)) for k in var.ncattrs() if not k.startswith("_")
+            )
+            self.sizes = dict(zip(var.dimensions, var.shape))
+            self.coords = dict(
+                (d, np.asarray(fh.variables[d][:]))
+                for d in self.dims
+                if d != "time" and _dim_kind(d) == "z"
+            )
+        for d in self.dims:
+            if _dim_kind(d) in ["x", "y"]:
+                self.sizes[d] = getattr(self.layout, f"n{_dim_kind(d)}")
+                self.coords[d] = self.layout.read(d)
+
+    def time(self, tns):
+        import xarray as xr
+
+        with archive.open_netcdf(self.layout.block_path(0, 0)) as fh:
+            da_time = xr.DataArray(
+                fh.variables["time"][tns],
+                dims=("time",),
+                attrs=dict(units=fh.variables["time"].units),
+            )
+        da_time, _ = fix_time_units(da_time)
+        return da_time.values, da_time.attrs["units"]
+
+    def read(self, tns, y=slice(None)):
+        return self.layout.read(self.var_name, time=list(tns), y=y)
+
+
+class _ExtractedSource:
+    """
+    Read `var_name` for a range of timesteps from the extracted full-domain
+    files (one per timestep), given as a dict of timestep -> path
+    """
+
+    def __init__(self, paths, var_name):
+        self.paths = paths
+        self.var_name = var_name
+        with archive.open_netcdf(next(iter(paths.values()))) as fh:
+            var = fh.variables[var_name]
+            self.dims = var.dimensions
+            self.dtype = var.dtype
+            self.attrs = dict(
+                (k, var.getncattr(k)) for k in var.ncattrs() if not k.startswith("_")
+            )
+            self.sizes = dict(zip(var.dimensions, var.shape))
+            self.coords = dict(
+                (d, np.asarray(fh.variables[d][:])) for d in self.dims if d != "time"
+            )
+            self.time_units = fh.variables["time"].units
+
+    def time(self, tns):
+        values = []
+        for tn in tns:
+            with archive.open_netcdf(self.paths[tn]) as fh:
+                t = fh.variables["time"]
+                dates = netCDF4.num2date(t[:], t.units)
+                values.append(netCDF4.date2num(dates, self.time_units))
+        return np.concatenate(values), self.time_units
+
+    def read(self, tns, y=slice(None)):
+        index = tuple(y if _dim_kind(d) == "y" else slice(None) for d in self.dims)
+        parts = []
+        for tn in tns:
+            with archive.open_netcdf(self.paths[tn]) as fh:
+                fh.set_auto_mask(False)
+                parts.append(fh.variables[self.var_name][index])
+        return np.concatenate(parts, axis=self.dims.index("time"))
+
+
+def _read_batch(source, tns, item):
+    t_slice, y_slice = item
+    return source.read(tns[t_slice], y=y_slice)
+
+
+def _batch_shape(nt, ny, row_nbytes, tile_size, max_nbytes):
+    """
+    Number of timesteps and rows (along `y`, a whole number of tiles unless
+    all rows are read at once) to read at a time in the first pass, so that
+    a batch is at most `max_nbytes` (but at least `tile_size` rows of one
+    timestep)
+    """
+    timestep_nbytes = ny * row_nbytes
+    if timestep_nbytes <= max_nbytes:
+        return int(min(nt, max_nbytes // timestep_nbytes)), ny
+    n_rows = max(1, max_nbytes // (tile_size * row_nbytes)) * tile_size
+    return 1, int(min(ny, n_rows))
+
+
+def _tile_slices(n, tile_size):
+    return [slice(s, min(s + tile_size, n)) for s in range(0, n, tile_size)]
+
+
+def _create_store(path, source, nt, chunks, time=None):
+    """
+    Create the netCDF file at `path` for `source.var_name` with `nt`
+    timesteps, chunked by `chunks` (dim -> chunk size)
+    """
+    Path(path).parent.mkdir(exist_ok=True, parents=True)
+    fh = netCDF4.Dataset(path, "w")
+    sizes = dict(source.sizes, time=nt)
+    for d in source.dims:
+        fh.createDimension(d, sizes[d])
+        if d in source.coords:
+            fh.createVariable(d, source.coords[d].dtype, (d,))[:] = source.coords[d]
+    if time is not None:
+        values, units = time
+        var_time = fh.createVariable("time", "f8", ("time",))
+        var_time.units = units
+        var_time[:] = values
+    var = fh.createVariable(
+        source.var_name,
+        source.dtype,
+        source.dims,
+        chunksizes=[min(chunks[d], sizes[d]) for d in source.dims],
+    )
+    var.setncatts(source.attrs)
+    return fh
+
+
+def rechunk_to_timeseries(source, output_path, tns, tile_size, max_memory, tmp_path):
+    """
+    Rechunk `source` (see `_BlockSource` and `_ExtractedSource`) at timesteps
+    `tns` into a file at `output_path` chunked as all timesteps x
+    `tile_size` x `tile_size` horizontally x all levels, using at most around
+    `max_memory` bytes (for the data held in memory). The memory used can't
+    be less than that for `tile_size` rows of a single timestep (in the
+    first pass) and for one tile of all timesteps (in the second pass). The
+    intermediate file is stored at `tmp_path`, and the output is only moved
+    into place once it has been written in full
+    """
+    output_path = Path(output_path)
+    output_tmp_path = output_path.with_suffix(".tmp.nc")
+    tns = list(tns)
+    nt = len(tns)
+    dims = source.dims
+    sizes = dict(source.sizes, time=nt)
+    x_dim = [d for d in dims if _dim_kind(d) == "x"][0]
+    y_dim = [d for d in dims if _dim_kind(d) == "y"][0]
+    itemsize = np.dtype(source.dtype).itemsize
+    slab_nbytes = itemsize * int(np.prod([sizes[d] for d in dims if d != "time"]))
+    tile_nbytes = slab_nbytes * tile_size**2 // (sizes[x_dim] * sizes[y_dim])
+
+    # first pass: batches of timesteps (or, if a single timestep doesn't fit
+    # in memory, slabs of rows of one timestep) read ahead (in a separate
+    # process) while the previous batches are written. With the batches
+    # queued for reading and writing up to `2 * depth + 1` are held in memory
+    # at once
+    depth = pipeline().depth
+    n_batches_held = 2 * depth + 1
+    nt_batch, ny_batch = _batch_shape(
+        nt=nt,
+        ny=sizes[y_dim],
+        row_nbytes=slab_nbytes // sizes[y_dim],
+        tile_size=tile_size,
+        max_nbytes=max_memory // n_batches_held,
+    )
+    chunks = dict((d, sizes[d]) for d in dims)
+    chunks.update({"time": nt_batch, x_dim: tile_size, y_dim: tile_size})
+    fh_tmp = _create_store(tmp_path, source, nt=nt, chunks=chunks)
+    try:
+        var_tmp = fh_tmp.variables[source.var_name]
+
+        def _write_batch(item, values):
+            region = {"time": item[0], y_dim: item[1]}
+            var_tmp[tuple(region.get(d, slice(None)) for d in dims)] = values
+
+        read_metrics, write_metrics = run_pipeline(
+            items=[
+                (
+                    slice(t_start, min(t_start + nt_batch, nt)),
+                    slice(y_start, min(y_start + ny_batch, sizes[y_dim])),
+                )
+                for t_start in range(0, nt, nt_batch)
+                for y_start in range(0, sizes[y_dim], ny_batch)
+            ],
+            read_fn=functools.partial(_read_batch, source, tns),
+            write_fn=_write_batch,
+            depth=depth,
+        )
+        logger.debug(read_metrics)
+        logger.debug(write_metrics)
+        fh_tmp.close()
+
+        # second pass: groups of tiles over all timesteps
+        n_tiles = int(max(1, max_memory // max(1, nt * tile_nbytes)))
+        chunks.update(time=nt)
+        fh_out = _create_store(
+            output_tmp_path, source, nt=nt, chunks=chunks, time=source.time(tns)
+        )
+        with archive.open_netcdf(tmp_path) as fh_tmp, fh_out:
+            fh_tmp.set_auto_mask(False)
+            var_tmp = fh_tmp.variables[source.var_name]
+            var_out = fh_out.variables[source.var_name]
+            x_tiles = _tile_slices(sizes[x_dim], tile_size)
+            for y_slice in _tile_slices(sizes[y_dim], tile_size):
+                for n in range(0, len(x_tiles), n_tiles):
+                    group = x_tiles[n : n + n_tiles]
+                    x_slice = slice(group[0].start, group[-1].stop)
+                    region = {x_dim: x_slice, y_dim: y_slice}
+                    index = tuple(region.get(d, slice(None)) for d in dims)
+                    var_out[index] = var_tmp[index]
+        os.replace(output_tmp_path, output_path)
+    finally:
+        Path(tmp_path).unlink(missing_ok=True)
+        output_tmp_path.unlink(missing_ok=True)
+
+
+class ExtractTimeSeriesStore(MemoryBudgetMixin, luigi.Task):
+    """
+    Rechunk `var_name` at timesteps `tns` (all timesteps by default) into a
+    time-contiguous store, chunked as all timesteps x `tile_size` x
+    `tile_size` horizontally x all levels, for fast access to the time
+    history at points or small regions. The data is read either directly
+    from the source blocks (`source="blocks"`) or from the full-domain files
+    extracted for each timestep (`source="extracted"`, these are extracted
+    with `Extract` if needed). At most around `max_memory` (e.g. `2GB`) of
+    data is held in memory, see `rechunk_to_timeseries` for the lower bound.
+
+    rico.00000000.nc, ... -> rico.w.timeseries.nc
+    for var w
+    """
+
+    file_prefix = luigi.Parameter()
+    var_name = luigi.Parameter()
+    tns = luigi.OptionalListParameter(default=None)
+    source = luigi.ChoiceParameter(choices=SOURCES, default="blocks")
+    tile_size = luigi.IntParameter(default=16)
+    max_memory = luigi.Parameter(default="1GB")
+    source_path = luigi.Parameter(default=".")
+    dest_path = luigi.OptionalParameter(default=".")
+    # only used when extracting the per-timestep files
+    use_cdo = luigi.BoolParameter(default=True)
+
+    def _tns(self):
+        if self.tns is not None:
+            return [int(tn) for tn in self.tns]
+        with archive.open_netcdf(self._source_block(0, 0).output().path) as fh:
+            return list(range(fh.dimensions["time"].size))
+
+    def _source_block(self, i, j):
+        return UCLALESOutputBlock(
+            file_prefix=self.file_prefix,
+            i=i,
+            j=j,
+            source_path=self.source_path,
+            kind="3d",
+        )
+
+    def requires(self):
+        if self.source == "extracted":
+            return dict(
+                (
+                    tn,
+                    Extract(
+                        file_prefix=self.file_prefix,
+                        var_name=self.var_name,
+                        tn=tn,
+                        kind="3d",
+                        source_path=self.source_path,
+                        dest_path=self.dest_path,
+                        use_cdo=self.use_cdo,
+                    ),
+                )
+                for tn in self._tns()
+            )
+        nx_b, ny_b = _find_number_of_blocks(
+            source_path=self.source_path, file_prefix=self.file_prefix, kind="3d"
+        )
+        return [self._source_block(i=i, j=j) for i in range(nx_b) for j in range(ny_b)]
+
+    def estimate_peak_memory(self):
+        # the batches of timesteps (or tiles) and the values being written
+        return 2 * parse_memory(self.max_memory) * 1024**2
+
+    def run(self):
+        if self.source == "extracted":
+            source = _ExtractedSource(
+                paths=dict((tn, target.path) for (tn, target) in self.input().items()),
+                var_name=self.var_name,
+            )
+        else:
+            source = _BlockSource(
+                source_path=self.source_path,
+                file_prefix=self.file_prefix,
+                var_name=self.var_name,
+            )
+
+        output_path = Path(self.output().path)
+        tmp_path = _build_path(
+            file_prefix=self.file_prefix,
+            data_stage="timeseries_intermediate",
+            data_kind="3d",
+            var_name=self.var_name,
+            dest_path=self.dest_path,
+        )
+        rechunk_to_timeseries(
+            source=source,
+            output_path=output_path,
+            tns=self._tns(),
+            tile_size=self.tile_size,
+            max_memory=parse_memory(self.max_memory) * 1024**2,
+            tmp_path=tmp_path,
+        )
+
+    def output(self):
+        p = _build_path(
+            file_prefix=self.file_prefix,
+            data_stage="timeseries",
+            data_kind="3d",
+            var_name=self.var_name,
+            dest_path=self.dest_path,
+        )
+        return XArrayTarget(str(p))
@@ -0,0 +1,310 @@
+"""
+Per-block "zone maps": a small index of the minimum, maximum and number of
+nonzero values of variables in each source block, for each timestep and each
+band of `band_size` vertical levels. In e.g. shallow-cumulus cases most blocks
+contain no cloud at most levels and timesteps, so with the zone map a
+conditional analysis (e.g. of all points with `l > 0`) only needs to read the
+blocks, timesteps and levels which could match, rather than every block in
+full. The zone map is built once (with the blocks read in parallel worker
+processes) and stored as `{file_prefix}.{var_names}.zonemap.nc`.
+
+Conditions are given as predicates like `l > 0` (see `Predicate`), and are
+used by the conditional temporal statistics (`where` of
+`ExtractTemporalStatistics`) and by `sampling.sample_where`
+"""
+import concurrent.futures
+import operator
+import os
+import re
+from pathlib import Path
+
+import luigi
+import numpy as np
+import xarray as xr
+
+from . import archive, backends
+from .common import _build_path, _find_number_of_blocks
+from .extraction import UCLALESOutputBlock, XArrayTarget
+from .layout import _dim_kind
+
+DEFAULT_BAND_SIZE = 10
+
+PREDICATE_OPERATORS = dict(
+    [
+        (">=", ("ge", operator.ge)),
+        ("<=", ("le", operator.le)),
+        ("==", ("eq", operator.eq)),
+        ("!=", ("ne", operator.ne)),
+        (">", ("gt", operator.gt)),
+        ("<", ("lt", operator.lt)),
+    ]
+)
+
+
+class Predicate:
+    """
+    Condition `{var_name} {op} {value}` on the values of a variable, e.g.
+    `Predicate.parse("l > 0")`
+    """
+
+    def __init__(self, var_name, op, value):
+        if op not in PREDICATE_OPERATORS:
+            raise NotImplementedError(
+                f"Unknown operator `{op}`, available are:"
+                f" {', '.join(PREDICATE_OPERATORS)}"
+            )
+        self.var_name = var_name
+        self.op = op
+        self.value = float(value)
+
+    @classmethod
+    def parse(cls, predicate):
+        if isinstance(predicate, Predicate):
+            return predicate
+        ops = "|".join(re.escape(op) for op in PREDICATE_OPERATORS)
+        m = re.match(rf"^\s*(\w+)\s*({ops})\s*(\S+)\s*$", predicate)
+        if m is None:
+            raise ValueError(
+                f"Couldn't parse the predicate `{predicate}`, e.g. use `l > 0`"
+            )
+        return cls(*m.groups())
+
+    def evaluate(self, values):
+        return PREDICATE_OPERATORS[self.op][1](values, self.value)
+
+    def may_match(self, vmin, vmax, nonzero=None):
+        """
+        Whether any values with minimum `vmin`, maximum `vmax` (and `nonzero`
+        nonzero values) could satisfy the predicate
+        """
+        v = self.value
+        if self.op == ">":
+            return vmax > v
+        elif self.op == ">=":
+            return vmax >= v
+        elif self.op == "<":
+            return vmin < v
+        elif self.op == "<=":
+            return vmin <= v
+        elif self.op == "==":
+            return (vmin <= v) & (v <= vmax)
+        elif self.op == "!=":
+            if v == 0.0 and nonzero is not None:
+                return nonzero > 0
+            return (vmin != v) | (vmax != v)
+        raise NotImplementedError(self.op)
+
+    @property
+    def slug(self):
+        """
+        Filename-safe form, e.g. `l_gt_0`
+        """
+        value = f"{self.value:g}".replace("-", "m")
+        return f"{self.var_name}_{PREDICATE_OPERATORS[self.op][0]}_{value}"
+
+    def __str__(self):
+        return f"{self.var_name} {self.op} {self.value:g}"
+
+
+def _band_starts(nz, band_size):
+    return np.arange(0, nz, band_size)
+
+
+def _block_zone_map(path, var_names, band_size):
+    """
+    Minimum, maximum and number of nonzero values of each of `var_names` in
+    the block at `path` for each timestep and band of levels (the whole
+    column for variables without a vertical dimension), read one timestep at
+    a time
+    """
+    with archive.open_netcdf(path) as fh:
+        nt = fh.dimensions["time"].size
+        var_dims = dict((v, fh.variables[v].dimensions) for v in var_names)
+
+    stats = {}
+    for v in var_names:
+        dims = var_dims[v]
+        # `time` is dropped from the dimensions when reading a timestep
+        z_axes = [
+            n
+            for (n, d) in enumerate([d for d in dims if d != "time"])
+            if _dim_kind(d) == "z"
+        ]
+        vmin, vmax, nonzero = [], [], []
+        for tn in range(nt):
+            index = tuple(tn if d == "time" else slice(None) for d in dims)
+            values = backends.reader().read_variable(path, v, index=index)
+            if len(z_axes) == 0:
+                bands = [values]
+            else:
+                values = np.moveaxis(values, z_axes[0], 0)
+                starts = _band_starts(values.shape[0], band_size)
+                bands = [values[s : s + band_size] for s in starts]
+            # missing values (NaN) are ignored, so that they don't hide the
+            # range of the other values in the band
+            vmin.append([np.fmin.reduce(b, axis=None) for b in bands])
+            vmax.append([np.fmax.reduce(b, axis=None) for b in bands])
+            nonzero.append([np.count_nonzero(b) for b in bands])
+        stats[v] = (np.array(vmin), np.array(vmax), np.array(nonzero))
+    return stats
+
+
+def _zone_map_name(var_names):
+    return "-".join(var_names)
+
+
+class BuildZoneMap(luigi.Task):
+    """
+    Build the zone map (per-block minimum, maximum and number of nonzero
+    values for each timestep and band of `band_size` levels) of `var_names`
+    in the 3D output, reading the blocks in `n_workers` worker processes
+
+    rico.00000000.nc, ... -> rico.l.zonemap.nc
+    for var l
+    """
+
+    file_prefix = luigi.Parameter()
+    source_path = luigi.Parameter(default=".")
+    var_names = luigi.ListParameter()
+    band_size = luigi.IntParameter(default=DEFAULT_BAND_SIZE)
+    n_workers = luigi.IntParameter(default=4)
+    dest_path = luigi.OptionalParameter(default=".")
+
+    def requires(self):
+        nx_b, ny_b = _find_number_of_blocks(
+            source_path=self.source_path, file_prefix=self.file_prefix, kind="3d"
+        )
+        return dict(
+            (
+                (i, j),
+                UCLALESOutputBlock(
+                    file_prefix=self.file_prefix,
+                    i=i,
+                    j=j,
+                    source_path=self.source_path,
+                    kind="3d",
+                ),
+            )
+            for i in range(nx_b)
+            for j in range(ny_b)
+        )
+
+    def run(self):
+        blocks = dict((ij, target.path) for (ij, target) in self.input().items())
+        var_names = list(self.var_names)
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.n_workers
+        ) as executor:
+            futures = dict(
+                (
+                    ij,
+                    executor.submit(_block_zone_map, path, var_names, self.band_size),
+                )
+                for (ij, path) in blocks.items()
+            )
+            block_stats = dict((ij, f.result()) for (ij, f) in futures.items())
+
+        nx_b = max(i for (i, _) in blocks) + 1
+        ny_b = max(j for (_, j) in blocks) + 1
+        with archive.open_netcdf(blocks[(0, 0)]) as fh:
+            var_dims = dict((v, fh.variables[v].dimensions) for v in var_names)
+            dim_sizes = dict((d, fh.dimensions[d].size) for d in fh.dimensions)
+
+        ds = xr.Dataset(attrs=dict(band_size=self.band_size))
+        for v in var_names:
+            z_dims = [d for d in var_dims[v] if _dim_kind(d) == "z"]
+            band_dim = f"{z_dims[0]}_band" if len(z_dims) > 0 else f"{v}_band"
+            _, n_bands = block_stats[(0, 0)][v][0].shape
+            for n, stat in enumerate(["min", "max", "nonzero"]):
+                values = np.stack(
+                    [
+                        np.stack([block_stats[(i, j)][v][n] for j in range(ny_b)])
+                        for i in range(nx_b)
+                    ]
+                )
+                ds[f"{v}_{stat}"] = (("block_i", "block_j", "tn", band_dim), values)
+            if len(z_dims) > 0:
+                ds[f"{v}_min"].attrs["n_levels"] = dim_sizes[z_dims[0]]
+                ds.coords[band_dim] = _band_starts(
+                    n_bands * self.band_size, self.band_size
+                )
+                ds.coords[band_dim].attrs["long_name"] = "first level of band"
+
+        output_path = Path(self.output().path)
+        output_path.parent.mkdir(exist_ok=True, parents=True)
+        # written to a temporary file first so that an interrupted run doesn't
+        # leave behind an incomplete zone map
+        output_tmp_path = output_path.with_suffix(".tmp.nc")
+        try:
+            backends.writer().write_dataset(ds, str(output_tmp_path))
+            os.replace(output_tmp_path, output_path)
+        finally:
+            output_tmp_path.unlink(missing_ok=True)
+
+    def output(self):
+        p = _build_path(
+            file_prefix=self.file_prefix,
+            data_stage="zone_map",
+            data_kind="3d",
+            var_names=_zone_map_name(self.var_names),
+            dest_path=self.dest_path,
+        )
+        return XArrayTarget(str(p))
+
+
+class ZoneMap:
+    """
+    Zone map (see `BuildZoneMap`) as loaded from `path`
+    """
+
+    def __init__(self, path):
+        with xr.open_dataset(path) as ds:
+            self.ds = ds.load()
+        self.band_size = int(self.ds.attrs["band_size"])
+
+    def _may_match(self, predicate):
+        predicate = Predicate.parse(predicate)
+        v = predicate.var_name
+        if f"{v}_min" not in self.ds:
+            raise KeyError(f"The zone map doesn't include `{v}`")
+        return predicate.may_match(
+            self.ds[f"{v}_min"].values,
+            self.ds[f"{v}_max"].values,
+            self.ds[f"{v}_nonzero"].values,
+        )
+
+    def blocks_matching(self, predicate, tn=None):
+        """
+        Blocks (i, j) which could contain values satisfying `predicate` at
+        timestep `tn` (at any timestep if `tn` isn't given)
+        """
+        may_match = self._may_match(predicate)
+        if tn is not None:
+            may_match = may_match[:, :, [int(tn)]]
+        i, j = np.nonzero(may_match.any(axis=(2, 3)))
+        return list(zip(i.tolist(), j.tolist()))
+
+    def timesteps_matching(self, predicate, i, j):
+        """
+        Timesteps at which block (i, j) could contain values satisfying
+        `predicate`
+        """
+        may_match = self._may_match(predicate)[i, j]
+        return np.nonzero(may_match.any(axis=1))[0].tolist()
+
+    def levels_matching(self, predicate, i, j, tn):
+        """
+        Level indices in block (i, j) at timestep `tn` which could contain
+        values satisfying `predicate` (the bands of levels that could match)
+        """
+        predicate = Predicate.parse(predicate)
+        may_match = self._may_match(predicate)[i, j, int(tn)]
+        n_levels = self.ds[f"{predicate.var_name}_min"].attrs.get("n_levels", 1)
+        levels = [
+            np.arange(n * self.band_size, (n + 1) * self.band_size)
+            for n in np.nonzero(may_match)[0]
+        ]
+        if len(levels) == 0:
+            return np.array([], dtype=int)
+        levels = np.concatenate(levels)
+        return levels[levels < n_levels]
@@ -0,0 +1,297 @@
+# coding: utf-8
+"""
+Quick-look rendering of 2D horizontal cross-sections (e.g. `lwp` or
+`cldbase`) as one PNG frame per timestep, for example for making animations.
+Frames are read either from an extracted 2D file or directly from the per-core
+source blocks, downsampled (by averaging) to at most the target size in
+pixels and rendered in parallel worker processes with the same colour scale
+for all frames. Each worker reads and renders one timestep at a time and only
+a few timesteps are queued at once, so the memory use doesn't grow with the
+number of frames
+"""
+import argparse
+import collections
+import concurrent.futures
+import logging
+import sys
+from pathlib import Path
+
+# `imsave` writes the image directly, so no (interactive) backend is needed
+import matplotlib.image
+import netCDF4
+import numpy as np
+
+from ..output import archive
+from ..output.layout import BlockLayout, _dim_kind
+
+DEFAULT_SIZE = 512
+
+logger = logging.getLogger(__name__)
+
+
+def _fill_value(var):
+    if "_FillValue" in var.ncattrs():
+        return var.getncattr("_FillValue")
+    return netCDF4.default_fillvals.get(var.dtype.str[1:])
+
+
+class _FrameSource:
+    """
+    Timesteps of a 2D variable with dimensions (`time`, y, x) in some order,
+    read one frame at a time as a float array with dimensions (y, x) and
+    missing values as NaN
+    """
+
+    def _read(self, tn):
+        raise NotImplementedError
+
+    def read(self, tn):
+        values = np.asarray(self._read(tn), dtype=float)
+        if self.fill_value is not None:
+            values[values == self.fill_value] = np.nan
+        if self.transpose:
+            values = values.T
+        return values
+
+    def _set_dims(self, var):
+        dims = [d for d in var.dimensions if d != "time"]
+        kinds = [_dim_kind(d) for d in dims]
+        if sorted(kinds) != ["x", "y"] or "time" not in var.dimensions:
+            raise NotImplementedError(
+                f"Only (time, y, x) fields can be rendered, `{self.var_name}`"
+                f" has dimensions {var.dimensions}"
+            )
+        self.dims = var.dimensions
+        self.transpose = kinds == ["x", "y"]
+        self.fill_value = _fill_value(var)
+        self.n_frames = var.shape[var.dimensions.index("time")]
+        shape = [n for (d, n) in zip(var.dimensions, var.shape) if d != "time"]
+        self.shape = tuple(shape[::-1] if self.transpose else shape)
+
+
+class ExtractedFrames(_FrameSource):
+    """
+    Frames of `var_name` from a 2D file (e.g. as extracted by
+    `uclales.output.Extract`)
+    """
+
+    def __init__(self, path, var_name):
+        self.path = str(path)
+        self.var_name = var_name
+        with archive.open_netcdf(self.path) as fh:
+            self._set_dims(fh.variables[var_name])
+        # the missing values are masked (and set to NaN) on reading instead,
+        # since the fill value is that of the packed values
+        self.fill_value = None
+
+    def _read(self, tn):
+        # read with netCDF4 (rather than the configured backend) so that the
+        # values are unpacked and the missing values masked
+        index = tuple(tn if d == "time" else slice(None) for d in self.dims)
+        with archive.open_netcdf(self.path) as fh:
+            var = fh.variables[self.var_name]
+            var.set_auto_maskandscale(True)
+            values = var[index]
+        return np.ma.filled(np.ma.asarray(values, dtype=float), np.nan)
+
+
+class BlockFrames(_FrameSource):
+    """
+    Frames of `var_name` read directly from the per-core 2D cross-section
+    blocks in `source_path`
+    """
+
+    def __init__(self, source_path, file_prefix, var_name, orientation="xy"):
+        self.var_name = var_name
+        self.layout = BlockLayout(
+            source_path=source_path,
+            file_prefix=file_prefix,
+            kind="2d",
+            orientation=orientation,
+        )
+        with archive.open_netcdf(self.layout.block_path(0, 0)) as fh:
+            self._set_dims(fh.variables[var_name])
+        self.shape = (self.layout.ny, self.layout.nx)
+
+    def _read(self, tn):
+        return self.layout.read(self.var_name, time=tn)
+
+
+def downsample_factor(shape, size):
+    """
+    Smallest integer factor by which a frame of `shape` (ny, nx) must be
+    reduced to fit within `size` (height, width) pixels
+    """
+    return max(1, *[-(-n // s) for (n, s) in zip(shape, size)])
+
+
+def downsample(values, factor):
+    """
+    Average over `factor` x `factor` tiles (ignoring NaNs, partial tiles at
+    the edges are averaged over the points they contain)
+    """
+    if factor == 1:
+        return values
+    ny, nx = values.shape
+    pad = ((0, -ny % factor), (0, -nx % factor))
+    values = np.pad(values, pad, constant_values=np.nan)
+    tiles = values.reshape(
+        values.shape[0] // factor, factor, values.shape[1] // factor, factor
+    )
+    valid = np.isfinite(tiles)
+    count = valid.sum(axis=(1, 3))
+    total = np.where(valid, tiles, 0.0).sum(axis=(1, 3))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(count > 0, total / count, np.nan)
+
+
+def _frame_range(source, tn, factor):
+    values = downsample(source.read(tn), factor)
+    if not np.any(np.isfinite(values)):
+        return np.nan, np.nan
+    return np.nanmin(values), np.nanmax(values)
+
+
+def _render_frame(source, tn, factor, path, vmin, vmax, cmap):
+    values = downsample(source.read(tn), factor)
+    # one pixel per (downsampled) point, with `y` increasing upwards
+    matplotlib.image.imsave(
+        path, values, vmin=vmin, vmax=vmax, cmap=cmap, origin="lower"
+    )
+    return path
+
+
+def _map_streaming(executor, fn, args, max_pending):
+    """
+    Apply `fn` to each of the argument tuples `args` in `executor`, with at
+    most `max_pending` calls queued at a time. Yields the results in order
+    """
+    pending = collections.deque()
+    for fn_args in args:
+        pending.append(executor.submit(fn, *fn_args))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while len(pending) > 0:
+        yield pending.popleft().result()
+
+
+def render_frames(
+    source,
+    dest_path=".",
+    name=None,
+    size=(DEFAULT_SIZE, DEFAULT_SIZE),
+    vmin=None,
+    vmax=None,
+    cmap="viridis",
+    tns=None,
+    n_workers=4,
+):
+    """
+    Render the frames of `source` (an `ExtractedFrames` or `BlockFrames`) at
+    timesteps `tns` (all by default) as `{dest_path}/{name}.{tn:05d}.png`,
+    downsampled to fit within `size` (height, width) pixels. If `vmin` or
+    `vmax` aren't given they are found from all the frames first, so that the
+    colour scale is the same in all frames. Returns the paths of the frames
+    """
+    tns = list(range(source.n_frames) if tns is None else tns)
+    name = name if name is not None else source.var_name
+    Path(dest_path).mkdir(exist_ok=True, parents=True)
+    factor = downsample_factor(source.shape, size)
+    max_pending = 2 * n_workers
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as executor:
+        if vmin is None or vmax is None:
+            ranges = np.array(
+                list(
+                    _map_streaming(
+                        executor,
+                        _frame_range,
+                        ((source, tn, factor) for tn in tns),
+                        max_pending,
+                    )
+                )
+            )
+            vmin = np.nanmin(ranges[:, 0]) if vmin is None else vmin
+            vmax = np.nanmax(ranges[:, 1]) if vmax is None else vmax
+            logger.info(f"Colour scale for `{source.var_name}`: {vmin:g} to {vmax:g}")
+
+        args = (
+            (
+                source,
+                tn,
+                factor,
+                str(Path(dest_path) / f"{name}.{tn:05d}.png"),
+                vmin,
+                vmax,
+                cmap,
+            )
+            for tn in tns
+        )
+        paths = list(_map_streaming(executor, _render_frame, args, max_pending))
+    logger.info(f"Rendered {len(paths)} frames of `{source.var_name}` to {dest_path}")
+    return paths
+
+
+def _build_parser():
+    parser = argparse.ArgumentParser(
+        prog="uclales-quicklook",
+        description=(
+            "Render PNG frames of a 2D horizontal cross-section from an extracted"
+            " file or a directory of UCLALES per-core output"
+        ),
+    )
+    parser.add_argument("path")
+    parser.add_argument("--var-name", required=True)
+    parser.add_argument(
+        "--file-prefix", default=None, help="required when reading source blocks"
+    )
+    parser.add_argument("--orientation", default="xy")
+    parser.add_argument("--dest-path", default=".")
+    parser.add_argument(
+        "--size",
+        nargs=2,
+        type=int,
+        default=[DEFAULT_SIZE, DEFAULT_SIZE],
+        metavar=("HEIGHT", "WIDTH"),
+        help="maximum size of the frames in pixels",
+    )
+    parser.add_argument("--vmin", type=float, default=None)
+    parser.add_argument("--vmax", type=float, default=None)
+    parser.add_argument("--cmap", default="viridis")
+    parser.add_argument("--tn", nargs="+", type=int, default=None)
+    parser.add_argument("--workers", type=int, default=4)
+    return parser
+
+
+def main(argv=None):
+    parser = _build_parser()
+    args = parser.parse_args(argv)
+    # the progress of `render_frames` is shown on the command line
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    if Path(args.path).is_dir() or archive.is_archive(args.path):
+        if args.file_prefix is None:
+            parser.error("The `--file-prefix` must be given to read source blocks")
+        source = BlockFrames(
+            source_path=args.path,
+            file_prefix=args.file_prefix,
+            var_name=args.var_name,
+            orientation=args.orientation,
+        )
+    else:
+        source = ExtractedFrames(args.path, var_name=args.var_name)
+
+    render_frames(
+        source,
+        dest_path=args.dest_path,
+        size=tuple(args.size),
+        vmin=args.vmin,
+        vmax=args.vmax,
+        cmap=args.cmap,
+        tns=args.tn,
+        n_workers=args.workers,
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())